@@ -1 +1 @@
-__all__ = ["auxil","congrid","header","png","polsar","supervisedclass"]
\ No newline at end of file
+__all__ = ["auxil","bmaps","cache","congrid","executor","geotiff","header","png","polsar","supervisedclass","vrt","vvvh"]
\ No newline at end of file
@@ -643,45 +643,18 @@ def mnf(da,samples,lines,bands):
     except:
         return None            
     
-def similarity(bn0, bn1):
+def similarity(bn0, bn1, levels=0, subpixel=False):
     """Register bn1 to bn0 ,  M. Canty 2012
 bn0, bn1 and returned result are image bands      
+levels > 0: estimate on bands decimated by 2**levels, then
+            correct the shift on a central full resolution window
+subpixel:   locate the correlation peaks to sub-pixel accuracy
 Modified from Imreg.py, see http://www.lfd.uci.edu/~gohlke/:
  Copyright (c) 2011-2012, Christoph Gohlke
  Copyright (c) 2011-2012, The Regents of the University of California
  Produced at the Laboratory for Fluorescence Dynamics
  All rights reserved.    
     """
- 
-    def highpass(shape):
-        """Return highpass filter to be multiplied with fourier transform."""
-        x = np.outer(
-                        np.cos(np.linspace(-math.pi/2., math.pi/2., shape[0])),
-                        np.cos(np.linspace(-math.pi/2., math.pi/2., shape[1])))
-        return (1.0 - x) * (2.0 - x)    
-
-    def logpolar(image, angles=None, radii=None):
-        """Return log-polar transformed image and log base."""
-        shape = image.shape
-        center = shape[0] / 2, shape[1] / 2
-        if angles is None:
-            angles = shape[0]
-            if radii is None:
-                radii = shape[1]
-        theta = np.empty((angles, radii), dtype=np.float64)
-        theta.T[:] = -np.linspace(0, np.pi, angles, endpoint=False)
-#      d = radii
-        d = np.hypot(shape[0]-center[0], shape[1]-center[1])
-        log_base = 10.0 ** (math.log10(d) / (radii))
-        radius = np.empty_like(theta)
-        radius[:] = np.power(log_base, np.arange(radii,
-                                                   dtype=np.float64)) - 1.0
-        x = radius * np.sin(theta) + center[0]
-        y = radius * np.cos(theta) + center[1]
-        output = np.empty_like(x)
-        ndii.map_coordinates(image, [x, y], output=output)
-        return output, log_base
-             
     lines0,samples0 = bn0.shape
 #  make reference and warp bands same shape    
     bn1 = bn1[0:lines0,0:samples0]   
@@ -694,25 +667,46 @@ Modified from Imreg.py, see http://www.lfd.uci.edu/~gohlke/:
     bn1[idx] = 0
     idx = np.where(bn1 == 0)
     bn1[idx] = np.mean(bn1)    
+    if levels > 0:
+#      coarse estimate on decimated bands    
+        f = 2**levels
+        scale,angle,shift = similarity(_decimate(bn0,f),_decimate(bn1,f),0,subpixel)
+        shift = np.array(shift,dtype=float)*f
+#      keep scale and angle, correct the shift by phase correlation of a central
+#      full resolution window of bn0 with the coarsely warped bn1
+        h = min(lines0,1024)
+        w = min(samples0,1024)
+        r0 = (lines0-h)//2
+        c0 = (samples0-w)//2
+        A,b = warp_params(bn1.shape,scale,angle,shift,0,0)
+        win1 = _warp_window(bn1,A,b+np.dot(A,[r0,c0]),h,w)
+        ir = _phasecorr(bn0[r0:r0+h,c0:c0+w],win1)
+        t0, t1 = _peak(ir,subpixel)
+        if t0 > h // 2:
+            t0 -= h
+        if t1 > w // 2:
+            t1 -= w
+        shift += [t0,t1]
+        if not subpixel:
+            shift = np.round(shift).astype(int)
+        return (scale,angle,[shift[0],shift[1]])
 #  get scale, angle      
-    f0 = fftshift(abs(fft2(bn0)))
-    f1 = fftshift(abs(fft2(bn1)))
-    h = highpass(f0.shape)
+    f0 = _spectrum(bn0)
+    f1 = _spectrum(bn1)
+    h = _highpass(f0.shape)
     f0 *= h
     f1 *= h
     del h
-    f0, log_base = logpolar(f0)
-    f1, log_base = logpolar(f1)
-    f0 = fft2(f0)
-    f1 = fft2(f1)
-    r0 = abs(f0) * abs(f1)
-    ir = abs(ifft2((f0 * f1.conjugate()) / r0))
-    i0, i1 = np.unravel_index(np.argmax(ir), ir.shape)
+    x, y, log_base = _logpolar_grid(f0.shape)
+    f0 = ndii.map_coordinates(f0, [x, y])
+    f1 = ndii.map_coordinates(f1, [x, y])
+    ir = _phasecorr(f0,f1)
+    i0, i1 = _peak(ir,subpixel)
     angle = 180.0 * i0 / ir.shape[0]
     scale = log_base ** i1 
     if scale > 1.8:
-        ir = abs(ifft2((f1 * f0.conjugate()) / r0))
-        i0, i1 = np.unravel_index(np.argmax(ir), ir.shape)
+        ir = _phasecorr(f1,f0)
+        i0, i1 = _peak(ir,subpixel)
         angle = -180.0 * i0 / ir.shape[0]
         scale = 1.0 / (log_base ** i1)
         if scale > 1.8:
@@ -721,26 +715,126 @@ Modified from Imreg.py, see http://www.lfd.uci.edu/~gohlke/:
         angle += 180.0
     elif angle > 90.0:
         angle -= 180.0           
-#  re-scale and rotate and then get shift                   
-    bn2 = ndii.zoom(bn1, 1.0/scale)
-    bn2 = ndii.rotate(bn2, angle)
-    if bn2.shape < bn0.shape:
-        t = np.zeros_like(bn0)
-        t[:bn2.shape[0], :bn2.shape[1]] = bn2
-        bn2 = t
-    elif bn2.shape > bn0.shape:
-        bn2 = bn2[:bn0.shape[0], :bn0.shape[1]] 
-    f0 = fft2(bn0)
-    f1 = fft2(bn2)
-    ir = abs(ifft2((f0 * f1.conjugate()) / (abs(f0) * abs(f1))))
-    t0, t1 = np.unravel_index(np.argmax(ir), ir.shape)
-    if t0 > f0.shape[0] // 2:
-        t0 -= f0.shape[0]
-    if t1 > f0.shape[1] // 2:
-        t1 -= f0.shape[1]                                               
+#  re-scale and rotate (in one resampling, padded or clipped to bn0) and then get shift                   
+    A,b = warp_params(bn1.shape,scale,angle,[0,0],0,0)
+    bn2 = _warp_window(bn1,A,b,lines0,samples0)
+    ir = _phasecorr(bn0,bn2)
+    t0, t1 = _peak(ir,subpixel)
+    if t0 > lines0 // 2:
+        t0 -= lines0
+    if t1 > samples0 // 2:
+        t1 -= samples0                                               
 #  return result   
     return (scale,angle,[t0,t1])                 
 
+#  highpass filters and log-polar grids for similarity, by shape
+_grids = {}
+
+def _highpass(shape):
+    """Return highpass filter to be multiplied with fourier transform."""
+    key = ('highpass',shape)
+    if key not in _grids:
+        x = np.outer(
+                        np.cos(np.linspace(-math.pi/2., math.pi/2., shape[0])),
+                        np.cos(np.linspace(-math.pi/2., math.pi/2., shape[1])))
+        _grids[key] = (1.0 - x) * (2.0 - x)    
+    return _grids[key]
+
+def _logpolar_grid(shape):
+    """Return the log-polar sampling coordinates of an image of
+the given shape and the log base."""
+    key = ('logpolar',shape)
+    if key not in _grids:
+        center = shape[0] / 2, shape[1] / 2
+        angles = shape[0]
+        radii = shape[1]
+        theta = np.empty((angles, radii), dtype=np.float64)
+        theta.T[:] = -np.linspace(0, np.pi, angles, endpoint=False)
+        d = np.hypot(shape[0]-center[0], shape[1]-center[1])
+        log_base = 10.0 ** (math.log10(d) / (radii))
+        radius = np.empty_like(theta)
+        radius[:] = np.power(log_base, np.arange(radii,
+                                                   dtype=np.float64)) - 1.0
+        x = radius * np.sin(theta) + center[0]
+        y = radius * np.cos(theta) + center[1]
+        _grids[key] = (x, y, log_base)
+    return _grids[key]
+
+def _spectrum(bn):
+    """Return fftshift(abs(fft2(bn))) for a real band, from the
+half-plane real FFT and the conjugate symmetry of the spectrum."""
+    lines, samples = bn.shape
+    r = np.abs(np.fft.rfft2(bn))
+    n = r.shape[1]
+    f = np.empty((lines, samples))
+    f[:, :n] = r
+    if samples > n:
+        f[:, n:] = r[(-np.arange(lines)) % lines][:, samples-np.arange(n, samples)]
+    return fftshift(f)
+
+def _phasecorr(a, b):
+    """Return the phase correlation surface of the real arrays a and b."""
+    f0 = np.fft.rfft2(a)
+    f1 = np.fft.rfft2(b)
+    return abs(np.fft.irfft2((f0 * f1.conjugate()) / (abs(f0) * abs(f1)), a.shape))
+
+def _peak(ir, subpixel=False):
+    """Return the position of the maximum of the (periodic) array ir,
+optionally refined by parabolic interpolation."""
+    i0, i1 = np.unravel_index(np.argmax(ir), ir.shape)
+    if not subpixel:
+        return (i0, i1)
+    m, n = ir.shape
+    def vertex(cm, c0, cp):
+        d = cm - 2*c0 + cp
+        if d < 0:
+            return 0.5*(cm - cp)/d
+        return 0.0
+    return (i0 + vertex(ir[(i0-1) % m, i1], ir[i0, i1], ir[(i0+1) % m, i1]),
+            i1 + vertex(ir[i0, (i1-1) % n], ir[i0, i1], ir[i0, (i1+1) % n]))
+
+def _decimate(bn, f):
+    """Return bn decimated by averaging f x f blocks."""
+    lines, samples = bn.shape[0] // f, bn.shape[1] // f
+    return bn[:lines*f, :samples*f].reshape(lines, f, samples, f).mean(axis=3).mean(axis=1)
+
+def _warp_window(bn, A, b, lines, samples):
+    """Resample bn with the affine transformation (A,b) onto a
+lines x samples grid, prefiltering only the part of bn needed."""
+    p = np.dot([[0, 0], [0, samples-1], [lines-1, 0], [lines-1, samples-1]], A.T) + b
+    ya = max(int(np.floor(p[:, 0].min()))-16, 0)
+    yb = min(int(np.ceil(p[:, 0].max()))+17, bn.shape[0])
+    xa = max(int(np.floor(p[:, 1].min()))-16, 0)
+    xb = min(int(np.ceil(p[:, 1].max()))+17, bn.shape[1])
+    if ya >= yb or xa >= xb:
+        return np.zeros((lines, samples), dtype=bn.dtype)
+    return ndii.affine_transform(bn[ya:yb, xa:xb], A, b - [ya, xa], output_shape=(lines, samples))
+
+def warp_params(shape, scale, angle, shift, x1, y1):
+    """Return matrix and offset of the affine transformation from the
+pixels of the output window at (x1,y1) to an image of the given shape.
+It is the composition of ndii.zoom(.,1/scale), ndii.rotate(.,angle) 
+and ndii.shift(.,shift), including the output shapes of zoom and rotate."""
+#  zoom    
+    zshape = np.array([int(round(ii*(1.0/scale))) for ii in shape])
+    zdiv = zshape - 1.0
+    D = np.ones(2)
+    D[zdiv != 0] = (np.array(shape, dtype=float)-1)[zdiv != 0]/zdiv[zdiv != 0]
+#  rotate with reshape    
+    a = np.pi/180*angle
+    m11, m12, m21, m22 = math.cos(a), math.sin(a), -math.sin(a), math.cos(a)
+    M = np.array([[m11, m12], [m21, m22]])
+    iy, ix = zshape
+    mtrx = np.array([[m11, -m21], [-m12, m22]])
+    c = np.array([np.dot(mtrx, p) for p in ([0, 0], [0, ix], [iy, 0], [iy, ix])])
+    oy = int(c[:, 0].max()-c[:, 0].min()+0.5)
+    ox = int(c[:, 1].max()-c[:, 1].min()+0.5)
+    offset = np.array([iy/2.0-0.5, ix/2.0-0.5]) - np.dot(M, [oy/2.0-0.5, ox/2.0-0.5])
+#  shift and clip    
+    A = D[:, None]*M
+    b = D*(offset + np.dot(M, np.array([y1, x1], dtype=float)-np.asarray(shift, dtype=float)))
+    return (A, b)
+
 # ---------------------------
 # discrete wavelet transform
 # ---------------------------
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     bmaps.py
+#  Purpose:  bit-packed bitemporal change maps (bmap), one bit per interval,
+#            in memory and as an optional GeoTIFF encoding
+#  Usage:
+#    import auxil.bmaps as bmaps
+#    bmap = bmaps.zeros(n,k-1)
+#    bmaps.setbit(bmap,idx,j)
+#    bands = bmaps.unpack(bmap,k-1)
+#
+# MIT License
+#
+# Copyright (c) 2016 Mort Canty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+#  A packed bmap for n pixels and m intervals is an (n,(m+7)//8) uint8
+#  array as returned by np.packbits: interval j is bit 7-j%8 of byte j//8.
+#  Packed files have (m+7)//8 Byte bands and the metadata items
+#  BMAP_PACKED=YES and BMAP_INTERVALS=m. Unpacked files have one band
+#  per interval with 0 (no change) and non-zero (change) values.
+
+import numpy as np
+
+PACKED = 'BMAP_PACKED'
+INTERVALS = 'BMAP_INTERVALS'
+
+#  number of set bits of each byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)],dtype=np.uint8)
+
+def nbytes(intervals):
+    return (intervals+7)//8
+
+def zeros(n,intervals):
+    '''Empty packed bmap for n pixels'''
+    return np.zeros((n,nbytes(intervals)),dtype=np.uint8)
+
+def setbit(bmap,idx,j):
+    '''Flag a change in interval j for the pixels idx'''
+    bmap[idx,j//8] |= np.uint8(128>>(j%8))
+
+def grow(bmap,intervals):
+    '''Return bmap widened to hold the given number of intervals'''
+    extra = nbytes(intervals)-bmap.shape[1]
+    if extra <= 0:
+        return bmap
+    return np.concatenate((bmap,np.zeros((bmap.shape[0],extra),dtype=np.uint8)),axis=1)
+
+def pack(bands):
+    '''Packed bmap from an (n,m) array of unpacked intervals'''
+    return np.packbits(np.asarray(bands) != 0,axis=1)
+
+def unpack(bmap,intervals,value=255):
+    '''(n,intervals) array of value (change) and 0 (no change)'''
+    return np.unpackbits(bmap,axis=1)[:,:intervals]*np.uint8(value)
+
+def count(bmap):
+    '''Number of intervals with change for each pixel (frequency map)'''
+    return np.sum(POPCOUNT[bmap],axis=1,dtype=np.uint32)
+
+def mark(outDataset,intervals):
+    '''Label a dataset of packed bands'''
+    outDataset.SetMetadataItem(PACKED,'YES')
+    outDataset.SetMetadataItem(INTERVALS,str(intervals))
+
+def is_packed(inDataset):
+    return inDataset.GetMetadataItem(PACKED) == 'YES'
+
+def intervals(inDataset):
+    '''Number of intervals stored in a packed or unpacked bmap file'''
+    if is_packed(inDataset):
+        return int(inDataset.GetMetadataItem(INTERVALS))
+    return inDataset.RasterCount
+
+def read(inDataset,x0,y0,cols,rows):
+    '''Packed bmap of the block (x0,y0,cols,rows) of a packed or
+       unpacked bmap file'''
+    bands = inDataset.RasterCount
+    if is_packed(inDataset):
+        bmap = np.empty((rows*cols,bands),dtype=np.uint8)
+        for i in range(bands):
+            bmap[:,i] = inDataset.GetRasterBand(i+1).ReadAsArray(x0,y0,cols,rows).ravel()
+        return bmap
+    bmap = zeros(rows*cols,bands)
+    for j in range(bands):
+        band = inDataset.GetRasterBand(j+1).ReadAsArray(x0,y0,cols,rows).ravel()
+        setbit(bmap,np.where(band != 0),j)
+    return bmap
+
+def read_interval(inDataset,j,x0,y0,cols,rows,value=255):
+    '''Change map of interval j (0-based) as a rows x cols array of value and 0'''
+    if not is_packed(inDataset):
+        return inDataset.GetRasterBand(j+1).ReadAsArray(x0,y0,cols,rows)
+    band = inDataset.GetRasterBand(j//8+1).ReadAsArray(x0,y0,cols,rows)
+    return ((band>>(7-j%8)) & 1).astype(np.uint8)*np.uint8(value)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     cache.py
+#  Purpose:  persistent on-disk cache for arrays (lookup tables, ENL images)
+#            with size-bounded least-recently-used eviction
+#  Usage:
+#    import auxil.cache as cache
+#    key = cache.key(cache.stamp(infile),dims,7)
+#    arrays = cache.load(key)
+#    if arrays is None:
+#        ...
+#        cache.save(key,enl=enl)
+#
+# MIT License
+#
+# Copyright (c) 2016 Mort Canty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+#  The cache directory is $SARDOCKER_CACHE (default ~/.sardocker/cache),
+#  its size is bounded by $SARDOCKER_CACHE_MB megabytes (default 2000).
+#  Entries are .npz files named by their key, the file modification time
+#  records the last access. The cache is a convenience only: if the
+#  directory cannot be written, nothing is stored and every load misses.
+
+import os, hashlib
+from xml.etree import ElementTree
+import numpy as np
+
+def cache_dir():
+    return os.path.expanduser(os.environ.get('SARDOCKER_CACHE',
+                                             '~/.sardocker/cache'))
+
+def max_size():
+    '''Size bound of the cache in bytes'''
+    return int(float(os.environ.get('SARDOCKER_CACHE_MB',2000))*2**20)
+
+def stamp(fn):
+    '''Absolute path, modification time and size of file fn, for a VRT
+       followed by the stamps of the files it references'''
+    fn = os.path.abspath(fn)
+    result = [fn,os.path.getmtime(fn),os.path.getsize(fn)]
+    if fn.lower().endswith('.vrt'):
+        tree = ElementTree.parse(fn)
+        for source in tree.iter('SourceFilename'):
+            sfn = source.text.strip()
+            if source.get('relativeToVRT') == '1':
+                sfn = os.path.join(os.path.dirname(fn),sfn)
+            if os.path.exists(sfn):
+                result += stamp(sfn)
+    return result
+
+def key(*parts):
+    '''Cache key for the given parts (strings, numbers, lists)'''
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+def _path(k):
+    return os.path.join(cache_dir(),k+'.npz')
+
+def load(k):
+    '''Return a dictionary of the arrays stored under key k,
+       or None if there is no such entry'''
+    fn = _path(k)
+    try:
+        with np.load(fn) as f:
+            arrays = dict(f.items())
+        os.utime(fn,None)
+    except (IOError,OSError,ValueError):
+        return None
+    return arrays
+
+def save(k,**arrays):
+    '''Store the arrays under key k, then evict the least
+       recently used entries if the cache is too large'''
+    dirn = cache_dir()
+    try:
+        if not os.path.isdir(dirn):
+            os.makedirs(dirn)
+#      write to a temporary file so concurrent readers never see partial entries
+        tmp = os.path.join(dirn,'%s.%i.tmp'%(k,os.getpid()))
+        with open(tmp,'wb') as f:
+            np.savez(f,**arrays)
+        os.rename(tmp,_path(k))
+        evict()
+    except (IOError,OSError):
+        pass
+
+def evict(size=None):
+    '''Delete least recently used entries until the cache
+       holds at most size bytes'''
+    if size is None:
+        size = max_size()
+    dirn = cache_dir()
+    entries = []
+    for fn in os.listdir(dirn):
+        if fn.endswith('.npz'):
+            try:
+                st = os.stat(os.path.join(dirn,fn))
+                entries.append((st.st_mtime,st.st_size,fn))
+            except OSError:
+                pass
+    total = sum([e[1] for e in entries])
+    for _,nbytes,fn in sorted(entries):
+        if total <= size:
+            break
+        try:
+            os.remove(os.path.join(dirn,fn))
+            total -= nbytes
+        except OSError:
+            pass
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     executor.py
+#  Purpose:  map a function over a list of tasks with an ipyparallel
+#            cluster, a multiprocessing pool or sequentially
+#  Usage:
+#    from auxil.executor import Executor
+#    ex = Executor('auto',workers=None)
+#    results = ex.map(func,args)
+#    ex.close()
+#
+# MIT License
+#
+# Copyright (c) 2016 Mort Canty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+#  Backends:
+#
+#    ipyparallel      engines of a running ipcluster
+#    multiprocessing  a pool of worker processes on this node
+#    sequential       the calling process
+#    auto             the first of the above which is available
+#
+#  Task functions for the multiprocessing backend must be defined at
+#  module level so that they can be pickled.
+
+import multiprocessing
+from itertools import imap
+
+BACKENDS = ['auto','ipyparallel','multiprocessing','sequential']
+
+class Executor(object):
+    '''Maps functions over task lists on the chosen backend,
+       workers limits the number of engines or processes'''
+
+    def __init__(self,backend='auto',workers=None):
+        if backend not in BACKENDS:
+            raise ValueError('unknown backend: %s'%backend)
+        if workers is not None and workers < 1:
+            raise ValueError('number of workers must be positive')
+        self.backend = None
+        self.workers = workers
+        self._view = None
+        self._pool = None
+        if backend in ('auto','ipyparallel'):
+            try:
+                from ipyparallel import Client
+                c = Client()
+                ids = c.ids
+                if workers is not None:
+                    ids = ids[:workers]
+                self._view = c[ids]
+                self.workers = len(ids)
+                self.backend = 'ipyparallel'
+            except Exception as e:
+                if backend == 'ipyparallel':
+                    raise
+                print 'no ipyparallel engines (%s)'%e
+        if self.backend is None and backend in ('auto','multiprocessing'):
+            if workers is None:
+                self.workers = multiprocessing.cpu_count()
+            if self.workers > 1 or backend == 'multiprocessing':
+                self._pool = multiprocessing.Pool(self.workers)
+                self.backend = 'multiprocessing'
+        if self.backend is None:
+            self.workers = 1
+            self.backend = 'sequential'
+
+    def __str__(self):
+        if self.backend == 'sequential':
+            return 'sequential'
+        return '%s (%i workers)'%(self.backend,self.workers)
+
+    def execute(self,code):
+        '''Execute code (e.g. imports) on the ipyparallel engines'''
+        if self._view is not None:
+            self._view.execute(code,block=True)
+
+    def map(self,func,args):
+        '''Return the list of results func(arg) for arg in args'''
+        if self._view is not None:
+            return self._view.map_sync(func,args)
+        elif self._pool is not None:
+            return self._pool.map(func,args,chunksize=1)
+        else:
+            return map(func,args)
+
+    def imap(self,func,args):
+        '''Iterate over the results func(arg) for arg in args, in order,
+           as they become available'''
+        if self._view is not None:
+            return iter(self._view.map(func,args))
+        elif self._pool is not None:
+            return self._pool.imap(func,args)
+        else:
+            return imap(func,args)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     geotiff.py
+#  Purpose:  tiled, compressed GeoTIFF output with overviews for change maps
+#            and other image products, written band by band, pixel
+#            interleaved in a single pass or block by block
+#  Usage:
+#    from auxil import geotiff
+#    outDataset = geotiff.create(outfn,cols,rows,bands,GDT_Byte,inDataset1)
+#    geotiff.write(outDataset,array,x0,y0)
+#    geotiff.close(outDataset)
+#    outDataset = None
+#    geotiff.finish(outfn)
+#    geotiff.copy([(inDataset1,1),(inDataset2,1)],outDataset)
+#
+# MIT License
+#
+# Copyright (c) 2016 Mort Canty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+#  The compression is $SARDOCKER_COMPRESS (DEFLATE (default), LZW or NONE).
+#  Files are tiled in 256 x 256 blocks, multi-band files are pixel
+#  interleaved (unless requested otherwise) so that all bands of a block 
+#  are compressed together.
+#  On close, overviews are added. Once the caller has released the
+#  dataset, finish rewrites the file, unless $SARDOCKER_COG is NO, with
+#  the overviews ahead of the full resolution data (cloud-optimized
+#  layout), which is cheap for compressed maps.
+
+import os
+import numpy as np
+import gdal
+
+BLOCKSIZE = 256
+
+_types = {np.dtype(np.uint8):gdal.GDT_Byte,
+          np.dtype(np.uint16):gdal.GDT_UInt16,
+          np.dtype(np.int16):gdal.GDT_Int16,
+          np.dtype(np.uint32):gdal.GDT_UInt32,
+          np.dtype(np.int32):gdal.GDT_Int32,
+          np.dtype(np.float32):gdal.GDT_Float32,
+          np.dtype(np.float64):gdal.GDT_Float64}
+
+def compression():
+    return os.environ.get('SARDOCKER_COMPRESS','DEFLATE').upper()
+
+def options(dtype,bands,compress=None,interleave='PIXEL'):
+    '''GeoTIFF creation options for bands of GDAL type dtype'''
+    if compress is None:
+        compress = compression()
+    opts = ['TILED=YES','BLOCKXSIZE=%i'%BLOCKSIZE,'BLOCKYSIZE=%i'%BLOCKSIZE,
+            'BIGTIFF=IF_SAFER']
+    if bands > 1:
+        opts.append('INTERLEAVE=%s'%interleave)
+    if compress != 'NONE':
+        opts.append('COMPRESS=%s'%compress)
+#      horizontal differencing, floating point predictor for real types
+        if dtype in (gdal.GDT_Float32,gdal.GDT_Float64):
+            opts.append('PREDICTOR=3')
+        else:
+            opts.append('PREDICTOR=2')
+    return opts
+
+def create(outfn,cols,rows,bands,dtype,inDataset=None,compress=None,interleave='PIXEL'):
+    '''Create a tiled, compressed GeoTIFF with the georeferencing of inDataset,
+       interleave='BAND' suits files whose bands are read separately'''
+    driver = gdal.GetDriverByName('GTiff')
+    outDataset = driver.Create(outfn,cols,rows,bands,dtype,options(dtype,bands,compress,interleave))
+    if inDataset is not None:
+        geotransform = inDataset.GetGeoTransform()
+        if geotransform is not None:
+            outDataset.SetGeoTransform(geotransform)
+        projection = inDataset.GetProjection()
+        if projection is not None:
+            outDataset.SetProjection(projection)
+    return outDataset
+
+def _buffer(array,dtype):
+    array = np.asarray(array)
+#  signed bytes are written to Byte bands as their unsigned bit patterns
+#  (e.g. 255 change flags), to other bands as signed values
+    if array.dtype == np.int8:
+        if dtype == gdal.GDT_Byte:
+            array = array.view(np.uint8)
+        else:
+            array = array.astype(np.int16)
+    elif array.dtype == np.bool:
+        array = array.astype(np.uint8)
+    elif array.dtype not in _types:
+        array = array.astype(np.float64)
+    return array
+
+def write(outDataset,array,x0=0,y0=0):
+    '''Write array to the block at (x0,y0) of outDataset: a rows x cols array
+       to band 1, a list of rows x cols arrays to bands 1,2,... or a
+       rows x cols x bands array to all bands in one interleaved pass'''
+    if isinstance(array,(list,tuple)):
+        for i,a in enumerate(array):
+            outBand = outDataset.GetRasterBand(i+1)
+            outBand.WriteArray(_buffer(a,outBand.DataType),x0,y0)
+        return
+    array = _buffer(array,outDataset.GetRasterBand(1).DataType)
+    if array.ndim == 2:
+        outDataset.GetRasterBand(1).WriteArray(array,x0,y0)
+        return
+    rows,cols,bands = array.shape
+    array = np.ascontiguousarray(array)
+    itemsize = array.dtype.itemsize
+    outDataset.WriteRaster(x0,y0,cols,rows,array.tostring(),cols,rows,
+                           _types[array.dtype],range(1,bands+1),
+                           bands*itemsize,cols*bands*itemsize,itemsize)
+
+def copy(sources,outDataset,x0=0,y0=0,cols=None,rows=None):
+    '''Copy the window (x0,y0,cols,rows) of the (dataset,band) pairs in 
+       sources to bands 1,2,... of outDataset, BLOCKSIZE rows at a time
+       in the data type of the source'''
+    if cols is None:
+        cols = outDataset.RasterXSize
+    if rows is None:
+        rows = outDataset.RasterYSize
+    for i,(inDataset,band) in enumerate(sources):
+        inBand = inDataset.GetRasterBand(band)
+        outBand = outDataset.GetRasterBand(i+1)
+        for y in range(0,rows,BLOCKSIZE):
+            h = min(BLOCKSIZE,rows-y)
+            outBand.WriteArray(inBand.ReadAsArray(x0,y0+y,cols,h),0,y)
+
+def overview_levels(cols,rows):
+    '''Decimation factors down to about one block'''
+    levels = []
+    f = 2
+    while max(cols,rows) > f*BLOCKSIZE/2:
+        levels.append(f)
+        f *= 2
+    return levels
+
+def close(outDataset,resampling='NEAREST',compress=None):
+    '''Add overviews and flush outDataset, the caller must then release
+       all of its references to outDataset and pass the file name to finish()'''
+    if compress is None:
+        compress = compression()
+    cols = outDataset.RasterXSize
+    rows = outDataset.RasterYSize
+    levels = overview_levels(cols,rows)
+    if levels:
+        gdal.SetConfigOption('COMPRESS_OVERVIEW',compress)
+        if compress != 'NONE':
+            gdal.SetConfigOption('PREDICTOR_OVERVIEW',
+                '3' if outDataset.GetRasterBand(1).DataType in (gdal.GDT_Float32,gdal.GDT_Float64) else '2')
+        gdal.SetConfigOption('INTERLEAVE_OVERVIEW','PIXEL')
+        try:
+            outDataset.BuildOverviews(resampling,levels)
+        finally:
+            for name in ('COMPRESS_OVERVIEW','PREDICTOR_OVERVIEW','INTERLEAVE_OVERVIEW'):
+                gdal.SetConfigOption(name,None)
+    outDataset.FlushCache()
+
+def finish(outfn,compress=None):
+    '''Rewrite the closed file outfn in cloud-optimized layout'''
+    if os.environ.get('SARDOCKER_COG','YES').upper() == 'NO':
+        return
+    if compress is None:
+        compress = compression()
+    inDataset = gdal.Open(outfn)
+    if inDataset is None or not overview_levels(inDataset.RasterXSize,inDataset.RasterYSize):
+        return
+#  copy with the overviews placed ahead of the full resolution image
+    tmp = outfn+'.tmp.tif'
+    opts = options(inDataset.GetRasterBand(1).DataType,inDataset.RasterCount,compress)
+    driver = gdal.GetDriverByName('GTiff')
+    try:
+        copy = driver.CreateCopy(tmp,inDataset,0,opts+['COPY_SRC_OVERVIEWS=YES'])
+        copy = None
+        inDataset = None
+        if os.name == 'nt':
+            os.remove(outfn)
+        os.rename(tmp,outfn)
+    except Exception as e:
+        print 'cloud-optimized layout skipped for %s: %s'%(outfn,e)
+        inDataset = None
+        if os.path.exists(tmp):
+            os.remove(tmp)
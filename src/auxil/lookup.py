@@ -1,4 +1,5 @@
 import numpy as np
+from . import cache
 
 lu = '''
      0.000000     0.000000     0.000000
@@ -802,7 +803,18 @@ lu = '''
    0.00628805    0.0252657    0.0570974
    0.00627995    0.0252333    0.0570250'''
 
+_table = None
+
 def table():  
-    lut = map(eval,lu.split())
-    lut = np.array(lut)
-    return np.reshape(lut, (800,3))
+    '''The 800x3 lookup table, parsed once and kept in the
+       on-disk cache as binary'''
+    global _table
+    if _table is None:
+        k = cache.key('lookup',lu)
+        arrays = cache.load(k)
+        if arrays is not None:
+            _table = arrays['table']
+        else:
+            _table = np.reshape(np.array(lu.split(),dtype=float),(800,3))
+            cache.save(k,table=_table)
+    return _table.copy()
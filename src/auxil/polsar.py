@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     polsar.py
+#  Purpose:  batched determinant kernels for polarimetric matrix images
+#            in 9- 4- 3- 2- or 1-band format, and p-values of the 
+#            chi-square mixtures approximating the test statistics
+#  Usage:
+#    import auxil.polsar as polsar
+#    logdet = polsar.logdet(mat,bands)
+#    pv = polsar.chi2mix(Z,f,omega2)
+#    zc = polsar.critical_value(f,omega2,significance)
+#
+# MIT License
+#
+# Copyright (c) 2016 Mort Canty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+#  The matrix elements mat are passed as tuples of arrays (or scalars):
+#
+#    bands = 9   (k,a,rho,xsi,b,zeta)   quad pol   T11 T12 T13 T22 T23 T33
+#    bands = 4   (k,a,xsi)              dual pol   C11 C12 C22
+#    bands = 3   (k,xsi,zeta)           quad pol diagonal
+#    bands = 2   (k,xsi)                dual pol diagonal
+#    bands = 1   (k,)                   single pol
+#
+#  The off-diagonal elements a, rho, b are complex. All arithmetic is done
+#  in the precision of the inputs, so float32/complex64 matrices give
+#  float32 determinants.
+#
+#  The distributions of the test statistics Z are approximated by
+#  (1-omega2)*chi2(f) + omega2*chi2(f+4). The chi-square tails are evaluated
+#  in closed form for integer degrees of freedom up to MAXDF (a finite 
+#  series in exp(-Z/2), plus erfc for odd f), which is several times 
+#  faster than scipy.stats and accurate to about 1e-14.
+
+import numpy as np
+from scipy import special, optimize
+
+#  largest number of degrees of freedom evaluated in closed form
+MAXDF = 40
+#  the tails underflow to zero well below this value of Z/2
+XMAX = 1.0e4
+
+def scaled(mat,m=1.0,dtype=np.float64):
+    '''Return the matrix elements multiplied by m, real elements
+       as dtype and complex elements as the matching complex type'''
+    ctype = np.result_type(dtype,np.complex64)
+    result = []
+    for x in mat:
+        if np.iscomplexobj(x):
+            x = np.asarray(x,dtype=ctype)
+        else:
+            x = np.asarray(x,dtype=dtype)
+        result.append(x*x.dtype.type(m))
+    return tuple(result)
+
+def det(mat,bands,out=None):
+    '''Return the determinants of the matrix elements mat. The result
+       is written to out if given, at most two further temporaries of
+       the same size are allocated'''
+    k = mat[0]
+    if out is None:
+        dtype = np.result_type(*[np.real(x) for x in mat])
+        out = np.empty(np.shape(k),dtype=dtype)
+    if bands == 9:
+        _,a,rho,xsi,b,zeta = mat
+        ar,ai = np.real(a),np.imag(a)
+        rr,ri = np.real(rho),np.imag(rho)
+        br,bi = np.real(b),np.imag(b)
+        t1 = np.empty_like(out)
+        t2 = np.empty_like(out)
+#      k*xsi*zeta
+        np.multiply(k,xsi,out)
+        out *= zeta
+#      + 2*Re(a*b*conj(rho))
+        np.multiply(ar,br,t1)
+        np.multiply(ai,bi,t2)
+        t1 -= t2
+        t1 *= rr
+        t1 *= 2
+        out += t1
+        np.multiply(ar,bi,t1)
+        np.multiply(ai,br,t2)
+        t1 += t2
+        t1 *= ri
+        t1 *= 2
+        out += t1
+#      - xsi*|rho|^2
+        np.multiply(rr,rr,t1)
+        np.multiply(ri,ri,t2)
+        t1 += t2
+        t1 *= xsi
+        out -= t1
+#      - k*|b|^2
+        np.multiply(br,br,t1)
+        np.multiply(bi,bi,t2)
+        t1 += t2
+        t1 *= k
+        out -= t1
+#      - zeta*|a|^2
+        np.multiply(ar,ar,t1)
+        np.multiply(ai,ai,t2)
+        t1 += t2
+        t1 *= zeta
+        out -= t1
+    elif bands == 4:
+        _,a,xsi = mat
+        ar,ai = np.real(a),np.imag(a)
+        t1 = np.empty_like(out)
+#      k*xsi - |a|^2
+        np.multiply(k,xsi,out)
+        np.multiply(ar,ar,t1)
+        out -= t1
+        np.multiply(ai,ai,t1)
+        out -= t1
+    elif bands == 3:
+        _,xsi,zeta = mat
+        np.multiply(k,xsi,out)
+        out *= zeta
+    elif bands == 2:
+        _,xsi = mat
+        np.multiply(k,xsi,out)
+    elif bands == 1:
+        out[...] = k
+    else:
+        raise ValueError('incorrect number of bands: %i'%bands)
+    if out.ndim == 0:
+        return out[()]
+    return out
+
+def logdet(mat,bands,out=None,eps=None,fill=None):
+    '''Return the log-determinants of the matrix elements mat.
+       Determinants <= eps (and NaNs) are replaced by fill before
+       taking logs, by default both are the smallest positive float'''
+    d = det(mat,bands,out)
+    scalar = np.ndim(d) == 0
+    d = np.atleast_1d(d)
+    finfo = np.finfo(d.dtype)
+    if eps is None:
+        eps = finfo.tiny
+    if fill is None:
+        fill = eps
+    with np.errstate(invalid='ignore'):
+        d[~(d > eps)] = fill
+    np.minimum(d,finfo.max,d)
+    np.log(d,d)
+    if scalar:
+        return d[0]
+    return d
+
+def chi2sf(Z,f):
+    '''Return the chi-square upper tail probabilities of Z (float64) 
+       for f degrees of freedom'''
+    if f != int(f) or f < 1 or f > MAXDF:
+        return special.chdtrc(f,np.asarray(Z,dtype=np.float64))
+    m = int(f)//2
+    odd = int(f) % 2 == 1
+    x = np.array(Z,dtype=np.float64)
+    x *= 0.5
+    np.clip(x,0.0,XMAX,x)
+#  exp(-x)*sum_k x^k/k! (even f) or 
+#  erfc(sqrt(x)) + exp(-x)*sqrt(x)*sum_k x^k/(1/2*3/2*...*(k+1/2)) (odd f)
+    s = np.ones_like(x)
+    for k in range(m-1,0,-1):
+        s *= x
+        s /= k+0.5 if odd else k
+        s += 1
+    if odd:
+        r = np.sqrt(x)
+        s *= r
+        s *= 2/np.sqrt(np.pi)
+        if m == 0:
+            s[...] = 0
+    np.negative(x,x)
+    np.exp(x,x)
+    x *= s
+    if odd:
+        x += special.erfc(r)
+    return x
+
+def chi2mix(Z,f,omega2):
+    '''Return the p-values of Z under (1-omega2)*chi2(f) + omega2*chi2(f+4)'''
+    pv = chi2sf(Z,f)
+    pv *= 1.-omega2
+    pv += omega2*chi2sf(Z,f+4)
+    return pv
+
+def critical_value(f,omega2,significance):
+    '''Return the value of Z above which the p-value under 
+       (1-omega2)*chi2(f) + omega2*chi2(f+4) is less than significance'''
+    def excess(z):
+        return (1.-omega2)*special.chdtrc(f,z) + omega2*special.chdtrc(f+4,z) - significance
+    hi = special.chdtri(f+4,significance)
+    while excess(hi) > 0:
+        hi *= 2
+    return optimize.brentq(excess,0.0,hi,xtol=1e-12,rtol=4*np.finfo(float).eps)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     vrt.py
+#  Purpose:  write GDAL virtual rasters (VRT) which reference bands of
+#            existing files instead of copying them
+#  Usage:
+#    import auxil.vrt as vrt
+#    vrt.write(outfn,[(vvfile,1),(vhfile,1)],inDataset)
+#    fns = vrt.split(stackfile,2)
+#
+# MIT License
+#
+# Copyright (c) 2016 Mort Canty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+#  Sources are (filename,band) pairs, one per output band, all of the
+#  size of the reference dataset, of which a window may be selected.
+#  Source file names are written as absolute paths, so the VRT may be
+#  moved but the sources may not. A multi-band time series stack is
+#  split into virtual per-acquisition images with split().
+
+import os
+from xml.sax.saxutils import escape
+import gdal
+
+def write(outfn,sources,inDataset,dtype=None,window=None):
+    '''Write a VRT with one band for each (filename,band) in sources,
+       georeferenced like inDataset, bands of GDAL type dtype
+       (default: that of the first band of inDataset). If window =
+       (x0,y0,cols,rows) is given, only that part of the sources is used'''
+    if window is None:
+        window = (0,0,inDataset.RasterXSize,inDataset.RasterYSize)
+    x0,y0,cols,rows = window
+    if dtype is None:
+        dtype = inDataset.GetRasterBand(1).DataType
+    lines = ['<VRTDataset rasterXSize="%i" rasterYSize="%i">'%(cols,rows)]
+    projection = inDataset.GetProjection()
+    if projection:
+        lines.append('  <SRS>%s</SRS>'%escape(projection))
+    geotransform = inDataset.GetGeoTransform()
+    if geotransform is not None:
+        gt = list(geotransform)
+        gt[0] = gt[0] + x0*gt[1] + y0*gt[2]
+        gt[3] = gt[3] + x0*gt[4] + y0*gt[5]
+        lines.append('  <GeoTransform>%s</GeoTransform>'%', '.join(['%.16g'%g for g in gt]))
+    for i,(fn,band) in enumerate(sources):
+        lines += ['  <VRTRasterBand dataType="%s" band="%i">'%(gdal.GetDataTypeName(dtype),i+1),
+                  '    <SimpleSource>',
+                  '      <SourceFilename relativeToVRT="0">%s</SourceFilename>'%escape(os.path.abspath(fn)),
+                  '      <SourceBand>%i</SourceBand>'%band,
+                  '      <SrcRect xOff="%i" yOff="%i" xSize="%i" ySize="%i"/>'%(x0,y0,cols,rows),
+                  '      <DstRect xOff="0" yOff="0" xSize="%i" ySize="%i"/>'%(cols,rows),
+                  '    </SimpleSource>',
+                  '  </VRTRasterBand>']
+    lines.append('</VRTDataset>')
+    with open(outfn,'w') as f:
+        f.write('\n'.join(lines)+'\n')
+    return outfn
+
+def split(infile,bands,outdir=None,window=None):
+    '''Split a time series stack with the given number of bands per 
+       acquisition into virtual images infile_1.vrt, infile_2.vrt, ... 
+       (in outdir if given), optionally restricted to the spatial subset
+       window = (x0,y0,cols,rows), and return their filenames'''
+    inDataset = gdal.Open(infile,gdal.GA_ReadOnly)
+    nb = inDataset.RasterCount
+    if nb % bands != 0:
+        raise ValueError('%s: %i bands is not a multiple of %i'%(infile,nb,bands))
+    root,_ = os.path.splitext(os.path.abspath(infile))
+    if outdir is not None:
+        root = os.path.join(outdir,os.path.basename(root))
+    fns = []
+    for i in range(nb//bands):
+        fns.append(write('%s_%i.vrt'%(root,i+1),
+                         [(infile,i*bands+b+1) for b in range(bands)],inDataset,window=window))
+    return fns
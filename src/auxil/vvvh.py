@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     vvvh.py
+#  Purpose:  pair time series of vv and vh single pol Sentinel-1 images by
+#            acquisition and merge each pair to a 2-band image (dual pol
+#            diagonal only polarimetric matrix), shared by ingests1.py and
+#            mergevvvh.py
+#  Usage:
+#    import auxil.vvvh as vvvh
+#    vvvh.merge(path,virtual=False)
+#
+# MIT License
+#
+# Copyright (c) 2016 Mort Canty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+#  VV and VH files are named <scene>.VV_<n>.tif and <scene>.VH_<n>.tif.
+#  The acquisition is the sensing start time of the Sentinel-1 product
+#  name <scene>, e.g. S1A_IW_GRDH_1SDV_20160305T171543_20160305T171608_...,
+#  and then the series number <n>.
+
+from __future__ import absolute_import
+import os, re, time
+import gdal
+from osgeo.gdalconst import GA_ReadOnly, GDT_Float32
+from . import geotiff
+from . import vrt
+from .executor import Executor
+
+#  mission, mode, product type, level/class/polarisation, sensing start
+S1NAME = re.compile('S1[AB]_[A-Z0-9]{2}_[A-Z0-9_]{4}_[A-Z0-9]{4}_([0-9]{8}T[0-9]{6})')
+
+def acquisition(fn):
+    '''Sort key of a scene: sensing start if the filename is a Sentinel-1
+       product name, then the series number'''
+    basename = os.path.basename(fn)
+    m = S1NAME.match(basename)
+    start = m.group(1) if m else ''
+    m = re.search('_([0-9]{1,2})\.tif$',basename)
+    return (start,int(m.group(1)) if m else 0)
+
+def pairs(files):
+    '''Match VV and VH files by acquisition, in time order'''
+    vvfiles = {}
+    vhfiles = {}
+    for afile in files:
+        if re.search('\.VV_[0-9]{1,2}\.tif$',afile):
+            vvfiles.setdefault(acquisition(afile),[]).append(afile)
+        elif re.search('\.VH_[0-9]{1,2}\.tif$',afile):
+            vhfiles.setdefault(acquisition(afile),[]).append(afile)
+    if len(vvfiles) == 0:
+        raise Exception('no files found')
+    for key in sorted(set(vvfiles.keys()+vhfiles.keys())):
+        if len(vvfiles.get(key,[])) != 1 or len(vhfiles.get(key,[])) != 1:
+            raise Exception('file mismatch: %s'%', '.join(vvfiles.get(key,[])+vhfiles.get(key,[])))
+    return [(vvfiles[key][0],vhfiles[key][0]) for key in sorted(vvfiles.keys())]
+
+def merge_pair((vvfile,vhfile,outfile)):
+    '''2-band image from a VV and a VH file, a VRT if outfile ends with .vrt'''
+    inDataset1 = gdal.Open(vvfile,GA_ReadOnly)
+    inDataset2 = gdal.Open(vhfile,GA_ReadOnly)
+    if outfile.endswith('.vrt'):
+        vrt.write(outfile,[(vvfile,1),(vhfile,1)],inDataset1,GDT_Float32)
+    else:
+        cols = inDataset1.RasterXSize
+        rows = inDataset1.RasterYSize
+        outDataset = geotiff.create(outfile,cols,rows,2,GDT_Float32,inDataset1,compress='NONE')
+        geotiff.copy([(inDataset1,1),(inDataset2,1)],outDataset)
+        outDataset = None
+    inDataset1 = None
+    inDataset2 = None
+    return '%s and %s merged to %s'%(vvfile,vhfile,outfile)
+
+def call_merge_pair(args):
+    from auxil.vvvh import merge_pair
+    return merge_pair(args)
+
+def merge(path,virtual=False,backend='auto',workers=None):
+    '''Merge all VV and VH pairs in path to <scene>.VVVH_<n>.tif, or to
+       virtual images <scene>.VVVH_<n>.vrt which keep the VV and VH files'''
+    start = time.time()
+    gdal.AllRegister()
+    try:
+        os.chdir(path)
+        vvvhfiles = [(os.path.abspath(vvfile),os.path.abspath(vhfile))
+                                  for vvfile,vhfile in pairs(os.listdir(path))]
+        ext = '.vrt' if virtual else '.tif'
+        args = [(vvfile,vhfile,os.path.splitext(vvfile.replace('.VV_','.VVVH_'))[0]+ext)
+                                                 for vvfile,vhfile in vvvhfiles]
+        ex = Executor(backend,workers)
+        print 'backend: %s'%ex
+        for result in ex.imap(call_merge_pair,args):
+            print result
+        ex.close()
+#      virtual images reference the originals
+        if not virtual:
+            for vvfile,vhfile in vvvhfiles:
+                for afile in [vvfile,vhfile]:
+                    if os.path.exists(afile.replace('.tif','.tfw')):
+                        os.remove(afile.replace('.tif','.tfw'))
+                    os.remove(afile)
+        print 'elapsed time: ' + str(time.time() - start)
+    except Exception as e:
+        print 'Error %s'%e
+        return None
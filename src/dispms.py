@@ -34,6 +34,7 @@ from osgeo.gdalconst import GDT_Byte, GA_ReadOnly
 import matplotlib.pyplot as plt
 from matplotlib import cm
 import numpy as np
+import auxil.bmaps as bmaps
 
 
 def klm(fn,dims):
@@ -103,6 +104,12 @@ def klm(fn,dims):
         print 'Error: %s  Could not get image footprint'%e
         return None   
 
+def readband(inDataset,b,x0,y0,cols,rows):
+#  band b, or interval b of a bit-packed bitemporal change map    
+    if bmaps.is_packed(inDataset):
+        return bmaps.read_interval(inDataset,b-1,x0,y0,cols,rows)
+    return inDataset.GetRasterBand(b).ReadAsArray(x0,y0,cols,rows)
+
 def make_image(redband,greenband,blueband,rows,cols,enhance):
     X = np.ones((rows*cols,3),dtype=np.uint8) 
     if enhance == 'linear255':
@@ -218,7 +225,7 @@ def dispms(filename1=None,filename2=None,dims=None,DIMS=None,rgb=None,RGB=None,e
     try:                   
         cols = inDataset1.RasterXSize    
         rows = inDataset1.RasterYSize  
-        bands1 = inDataset1.RasterCount  
+        bands1 = bmaps.intervals(inDataset1)  
     except Exception as e:
         print 'Error in dispms: %s  --could not read image file'%e
         return   
@@ -227,7 +234,7 @@ def dispms(filename1=None,filename2=None,dims=None,DIMS=None,rgb=None,RGB=None,e
         try:       
             cols2 = inDataset2.RasterXSize    
             rows2 = inDataset2.RasterYSize            
-            bands2 = inDataset2.RasterCount       
+            bands2 = bmaps.intervals(inDataset2)       
         except Exception as e:
             print 'Error in dispms: %s  --could not read second image file'%e
             return       
@@ -256,9 +263,9 @@ def dispms(filename1=None,filename2=None,dims=None,DIMS=None,rgb=None,RGB=None,e
         enhance = 'linear2pc' 
     try:  
         if cls is None:
-            redband   = np.nan_to_num(inDataset1.GetRasterBand(r).ReadAsArray(x0,y0,cols,rows)) 
-            greenband = np.nan_to_num(inDataset1.GetRasterBand(g).ReadAsArray(x0,y0,cols,rows)) 
-            blueband  = np.nan_to_num(inDataset1.GetRasterBand(b).ReadAsArray(x0,y0,cols,rows))
+            redband   = np.nan_to_num(readband(inDataset1,r,x0,y0,cols,rows)) 
+            greenband = np.nan_to_num(readband(inDataset1,g,x0,y0,cols,rows)) 
+            blueband  = np.nan_to_num(readband(inDataset1,b,x0,y0,cols,rows))
         else:
             classimg = inDataset1.GetRasterBand(1).ReadAsArray(x0,y0,cols,rows).ravel()
             num_classes = np.max(classimg)
@@ -299,9 +306,9 @@ def dispms(filename1=None,filename2=None,dims=None,DIMS=None,rgb=None,RGB=None,e
             enhance = 'logarithmic'          
         try:  
             if CLS is None:
-                redband   = np.nan_to_num(inDataset2.GetRasterBand(r).ReadAsArray(x0,y0,cols,rows))
-                greenband = np.nan_to_num(inDataset2.GetRasterBand(g).ReadAsArray(x0,y0,cols,rows)) 
-                blueband  = np.nan_to_num(inDataset2.GetRasterBand(b).ReadAsArray(x0,y0,cols,rows))
+                redband   = np.nan_to_num(readband(inDataset2,r,x0,y0,cols,rows))
+                greenband = np.nan_to_num(readband(inDataset2,g,x0,y0,cols,rows)) 
+                blueband  = np.nan_to_num(readband(inDataset2,b,x0,y0,cols,rows))
             else:
                 classimg = inDataset2.GetRasterBand(1).ReadAsArray(x0,y0,cols,rows).ravel()
                 redband = classimg   
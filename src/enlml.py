@@ -34,24 +34,126 @@
 
 import auxil.auxil as auxil
 import auxil.lookup as lookup
+import auxil.polsar as polsar
+import auxil.cache as cache
 import os, sys, getopt, time
 import numpy as np
 import matplotlib.pyplot as plt
 from osgeo import gdal
 from osgeo.gdalconst import GA_ReadOnly, GDT_Float32
    
-def get_windex(j,cols):
-#  first window for row j    
-    windex = np.zeros(49,dtype=int)
-    six = np.array([0,1,2,3,4,5,6])
-    windex[0:7]   = (j-3)*cols + six
-    windex[7:14]  = (j-2)*cols + six
-    windex[14:21] = (j-1)*cols + six
-    windex[21:28] = (j)*cols   + six 
-    windex[28:35] = (j+1)*cols + six 
-    windex[35:42] = (j+2)*cols + six
-    windex[42:49] = (j+3)*cols + six
-    return windex
+def window_sums(x,w=7):
+    '''Sums over all w x w windows of the 2D array x from
+       its summed-area table (in double precision),
+       shape (rows-w+1,cols-w+1). Non-finite values count as 0'''
+    rows,cols = x.shape
+    sat = np.zeros((rows+1,cols+1),dtype=np.result_type(x,np.float64))
+    x = np.where(np.isfinite(x),x,0)
+    np.cumsum(x,axis=0,out=sat[1:,1:])
+    np.cumsum(sat[1:,1:],axis=1,out=sat[1:,1:])
+    return sat[w:,w:] - sat[:-w,w:] - sat[w:,:-w] + sat[:-w,:-w]
+
+def enl_lookup(c,lu):
+    '''ENL for each value c = <log det C> - log det <C> from the 
+       lookup table column lu, which has leading zeros and is 
+       decreasing thereafter. Equivalent to taking the last sign 
+       change of c + lu'''
+    z = np.argmax(lu > 0)
+    v = lu[z:]
+    enl = np.zeros(c.shape,dtype=np.float32)
+    idx = np.where(c < 0)
+#  number of lookup values > -c    
+    p = np.searchsorted(-v,c[idx])
+    ell = np.where(p == len(v),z,z+p)
+    ell[p == 0] = 0
+    enl[idx] = ell/10.0
+    return enl
+
+def enl_image(inDataset,x0,y0,cols,rows):
+    '''ENL image of the spatial subset of inDataset'''
+    bands = inDataset.RasterCount
+    if bands == 9:
+        print 'Quad polarimetry'  
+#      T11 (k)
+        band = inDataset.GetRasterBand(1)
+        k = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows))
+#      T12  (a)
+        band = inDataset.GetRasterBand(2)
+        a = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows))
+        band = inDataset.GetRasterBand(3)    
+        im = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows))
+        a = a + 1j*im
+#      T13  (rho)
+        band = inDataset.GetRasterBand(4)
+        rho = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows))
+        band = inDataset.GetRasterBand(5)
+        im = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows))
+        rho = rho + 1j*im     
+#      T22 (xsi)
+        band = inDataset.GetRasterBand(6)
+        xsi = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows))
+#      T23 (b)        
+        band = inDataset.GetRasterBand(7)
+        b = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows))
+        band = inDataset.GetRasterBand(8)
+        im = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows))
+        b = b + 1j*im     
+#      T33 (zeta)
+        band = inDataset.GetRasterBand(9)
+        zeta = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows))
+        det = polsar.det((k,a,rho,xsi,b,zeta),9)
+        d = 2
+    elif bands == 4:
+        print 'Dual polarimetry'  
+#      C11 (k)
+        band = inDataset.GetRasterBand(1)
+        k = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows))
+#      C12  (a)
+        band = inDataset.GetRasterBand(2)
+        a = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows))
+        band = inDataset.GetRasterBand(3)
+        im = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows))
+        a = a + 1j*im       
+#      C22 (xsi)
+        band = inDataset.GetRasterBand(4)
+        xsi = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows))
+        det = polsar.det((k,a,xsi),4)   
+        d = 1   
+    elif bands == 1:
+        print 'Single polarimetry'         
+#      C11 (k)
+        band = inDataset.GetRasterBand(1)
+        k = band.ReadAsArray(x0,y0,cols,rows)
+        det = k
+        d = 0      
+    if bands == 9:
+        mat = (k,a,rho,xsi,b,zeta)
+    elif bands == 4:
+        mat = (k,a,xsi)
+    else:
+        mat = (k,)
+    enl_ml = np.zeros((rows,cols), dtype= np.float32)
+    lu = lookup.table()[:,d]
+    print 'filtering...'
+    print 'row: ',
+    sys.stdout.flush()    
+#  7x7 window averages in strips of 256 rows 
+    for i0 in range(3,rows-3,256):
+        print '%i '%i0, 
+        sys.stdout.flush()
+        i1 = min(i0+256,rows-3)
+        slab = slice(i0-3,i1+3)
+        detC = det[slab]
+        valid = window_sums((~(detC > 0.0)).astype(np.float64)) == 0   
+        with np.errstate(divide='ignore',invalid='ignore'):
+            avlogdetC = window_sums(np.log(detC))/49
+            avC = [window_sums(x[slab])/49 for x in mat]
+            logdetavC = np.log(polsar.det(avC,bands))
+            c = avlogdetC - logdetavC 
+        c[~valid] = np.nan
+        enl_ml[i0:i1,3:cols-3] = enl_lookup(c,lu)
+    print
+    return enl_ml
 
 def main():
     usage = '''
@@ -68,13 +170,17 @@ Options:
    -h    this help
    -n    suppress graphics output
    -d    spatial subset list e.g. -d [0,0,400,400]
+   -f    force estimation, ignoring previously cached ENL images
 
 An ENL image will be written to the same directory with '_enl' appended.
+ENL images are cached (see auxil/cache.py) by input file checksum and
+subset, so repeated runs on the same image skip the estimation.
 
 ------------------------------------------------''' %sys.argv[0]
-    options,args = getopt.getopt(sys.argv[1:],'hnd:')
+    options,args = getopt.getopt(sys.argv[1:],'hnfd:')
     dims = None
     graphics = True
+    usecache = True
     for option, value in options: 
         if option == '-h':
             print usage
@@ -83,6 +189,8 @@ An ENL image will be written to the same directory with '_enl' appended.
             dims = eval(value)  
         elif option == '-n':
             graphics = False       
+        elif option == '-f':
+            usecache = False
     if len(args) != 1:
         print 'Incorrect number of arguments'
         print usage
@@ -92,6 +200,9 @@ An ENL image will be written to the same directory with '_enl' appended.
     dirn = os.path.dirname(path)
     basename = os.path.basename(infile)
     root, ext = os.path.splitext(basename)
+#  virtual (VRT) inputs cannot be written to, their ENL image is a GeoTIFF    
+    if ext.lower() == '.vrt':
+        ext = '.tif'
     outfile = dirn + '/' + root + '_enl' + ext  
     
     gdal.AllRegister()         
@@ -107,97 +218,22 @@ An ENL image will be written to the same directory with '_enl' appended.
     print '========================='
     print time.asctime()
     print 'infile:  %s'%infile   
-    if bands == 9:
-        print 'Quad polarimetry'  
-#      T11 (k)
-        band = inDataset.GetRasterBand(1)
-        k = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-#      T12  (a)
-        band = inDataset.GetRasterBand(2)
-        a = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-        band = inDataset.GetRasterBand(3)    
-        im = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-        a = a + 1j*im
-#      T13  (rho)
-        band = inDataset.GetRasterBand(4)
-        rho = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-        band = inDataset.GetRasterBand(5)
-        im = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-        rho = rho + 1j*im     
-#      T22 (xsi)
-        band = inDataset.GetRasterBand(6)
-        xsi = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()    
-#      T23 (b)        
-        band = inDataset.GetRasterBand(7)
-        b = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-        band = inDataset.GetRasterBand(8)
-        im = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-        b = b + 1j*im     
-#      T33 (zeta)
-        band = inDataset.GetRasterBand(9)
-        zeta = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()                
-        det = k*xsi*zeta + 2*np.real(a*b*np.conj(rho)) - xsi*(abs(rho)**2) - k*(abs(b)**2) - zeta*(abs(a)**2)
-        d = 2
-    elif bands == 4:
-        print 'Dual polarimetry'  
-#      C11 (k)
-        band = inDataset.GetRasterBand(1)
-        k = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-#      C12  (a)
-        band = inDataset.GetRasterBand(2)
-        a = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-        band = inDataset.GetRasterBand(3)
-        im = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-        a = a + 1j*im       
-#      C22 (xsi)
-        band = inDataset.GetRasterBand(4)
-        xsi = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel() 
-        det = k*xsi - abs(a)**2   
-        d = 1   
-    elif bands == 1:
-        print 'Single polarimetry'         
-#      C11 (k)
-        band = inDataset.GetRasterBand(1)
-        k = band.ReadAsArray(x0,y0,cols,rows).ravel() 
-        det = k
-        d = 0      
-    enl_ml = np.zeros((rows,cols), dtype= np.float32)
-    lu = lookup.table()
-    print 'filtering...'
-    print 'row: ',
-    sys.stdout.flush()    
     start = time.time()
-    for i in range(3,rows-3):
-        if i%100 == 0:
-            print '%i '%i, 
-            sys.stdout.flush()
-        windex = get_windex(i,cols)  
-        for j in range(3,cols-3):  
-            detC = det[windex]
-            if np.min(detC) > 0.0:
-                avlogdetC = np.sum(np.log(detC))/49
-                if bands == 9:
-                    k1 = np.sum(k[windex])/49
-                    a1 = np.sum(a[windex])/49
-                    rho1 = np.sum(rho[windex])/49
-                    xsi1 = np.sum(xsi[windex])/49
-                    b1 = np.sum(b[windex])/49
-                    zeta1 = np.sum(zeta[windex])/49
-                    detavC = k1*xsi1*zeta1 + 2*np.real(a1*b1*np.conj(rho1)) - xsi1*(np.abs(rho1)**2) - k1*(np.abs(b1)**2) - zeta1*(np.abs(a1)**2)
-                elif bands == 4:
-                    k1 = np.sum(k[windex])/49
-                    xsi1 = np.sum(xsi[windex])/49
-                    a1 = np.sum(a[windex])/49   
-                    detavC =  k1*xsi1 - np.abs(a1)**2
-                else:
-                    detavC = np.sum(k[windex])/49
-                logdetavC = np.log(detavC)    
-                arr =  avlogdetC - logdetavC + lu[:,d]    
-                ell = np.where(arr*np.roll(arr,1)<0)[0]
-                if ell != []:
-                    enl_ml[i,j] = float(ell[-1])/10.0
-            windex += 1
+    key = cache.key('enl',cache.stamp(infile),list(dims),7)
+    arrays = None
+    if usecache:
+        arrays = cache.load(key)
+    if arrays is not None:
+        print 'ENL image taken from cache'
+        enl_ml,ya,xa = arrays['enl'],arrays['hist'],arrays['bins']
+    else:
+        enl_ml = enl_image(inDataset,x0,y0,cols,rows)
+        ya,xa = np.histogram(enl_ml,bins=500)
+        ya[0] = 0    
+        cache.save(key,enl=enl_ml,hist=ya,bins=xa)
     driver = inDataset.GetDriver()   
+    if driver.ShortName == 'VRT':
+        driver = gdal.GetDriverByName('GTiff')
     outDataset = driver.Create(outfile,cols,rows,1,GDT_Float32)
     projection = inDataset.GetProjection()
     geotransform = inDataset.GetGeoTransform()
@@ -212,8 +248,6 @@ An ENL image will be written to the same directory with '_enl' appended.
     outBand.WriteArray(enl_ml,0,0) 
     outBand.FlushCache() 
     outDataset = None   
-    ya,xa = np.histogram(enl_ml,bins=500)
-    ya[0] = 0    
     if graphics:
         plt.plot(xa[0:-1],ya)
         plt.title('Histogram ENL for %s'%infile)
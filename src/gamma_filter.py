@@ -30,22 +30,12 @@ import os, sys, time, getopt
 import numpy as np
 from osgeo import gdal
 from osgeo.gdalconst import GDT_Float32, GA_ReadOnly
-from ipyparallel import Client
+from auxil.executor import Executor
+from tempfile import NamedTemporaryFile
 
 def gamma_filter((k,inimage,rows,cols,m)):    
-    from scipy.ndimage import zoom   
-    def get_windex(j,cols):     
-        windex = np.zeros(49,dtype=int)
-        six = np.array([0,1,2,3,4,5,6])      
-        windex[0:7]   = (j-3)*cols + six
-        windex[7:14]  = (j-2)*cols + six
-        windex[14:21] = (j-1)*cols + six
-        windex[21:28] = (j)*cols   + six 
-        windex[28:35] = (j+1)*cols + six 
-        windex[35:42] = (j+2)*cols + six
-        windex[42:49] = (j+3)*cols + six
-        return windex  
-
+    '''Gamma MAP filter band k of inimage. The image is processed in 
+       strips of 50 rows, all pixels of a strip at once'''
     templates = np.zeros((8,7,7),dtype=int)
     for j in range(7):
         templates[0,j,0:3] = 1
@@ -72,55 +62,70 @@ def gamma_filter((k,inimage,rows,cols,m)):
     edges[1] = [[0,1,1],[-1,0,1],[-1,-1,0]]
     edges[2] = [[1,1,1],[0,0,0],[-1,-1,-1]]
     edges[3] = [[1,1,0],[1,0,-1],[0,-1,-1]]        
-    result = np.copy(inimage[k])
-    arr = inimage[k].ravel()
-    zf = 3./7
-    for j in range(3,rows-3):
-        if j%50 == 0:
-            print 'band %i  row %i'%((k+1),j)
-        windex = get_windex(j,cols)
-        for i in range(3,cols-3):
-            g = inimage[k,j,i]            
-            wind = np.reshape(arr[windex],(7,7))
-#          3x3 compression             
-            w = zoom(wind,zf,order=1,prefilter=False)              
-#          get appropriate edge mask
-            es = [np.sum(edges[p]*w) for p in range(4)]
-            idx = np.argmax(es)  
-            if idx == 0:
-                if np.abs(w[1,1]-w[1,0]) < np.abs(w[1,1]-w[1,2]):
-                    edge = templates[0]
-                else:
-                    edge = templates[4]
-            elif idx == 1:
-                if np.abs(w[1,1]-w[2,0]) < np.abs(w[1,1]-w[0,2]):
-                    edge = templates[1]
-                else:
-                    edge = templates[5]                
-            elif idx == 2:
-                if np.abs(w[1,1]-w[0,1]) < np.abs(w[1,1]-w[2,1]):
-                    edge = templates[6]
-                else:
-                    edge = templates[2]  
-            elif idx == 3:
-                if np.abs(w[1,1]-w[0,0]) < np.abs(w[1,1]-w[2,2]):
-                    edge = templates[7]
-                else:
-                    edge = templates[3] 
-            wind = wind.ravel()[edge] 
-            var = np.var(wind)
-            if var > 0: 
-                mu = np.mean(wind)  
-                alpha = (1 +1.0/m)/(var/mu**2 - 1/m)
-                if alpha < 0:
-                    alpha = np.abs(alpha)
-                a = mu*(alpha-m-1)
-                x = (a+np.sqrt(4*g*m*alpha*mu+a**2))/(2*alpha)        
-                result[j,i] = x
-            windex += 1  
+    image = np.asarray(inimage[k])
+    result = np.copy(image)
+    for j0 in range(3,rows-3,50):
+        j1 = min(j0+50,rows-3)
+        print 'band %i  row %i'%((k+1),j0)
+#      pixel (dy,dx) of the 7x7 windows centered on rows j0...j1-1, cols 3...cols-4        
+        wind = lambda dy,dx: image[j0-3+dy:j1-3+dy,dx:cols-6+dx] 
+        g = wind(3,3)
+#      3x3 compression             
+        w = [[wind(3*r,3*c) for c in range(3)] for r in range(3)]   
+#      get appropriate edge mask
+        es = np.zeros((4,)+g.shape)
+        prod = np.zeros(g.shape+(9,))
+        for p in range(4):
+            for r in range(3):
+                for c in range(3):
+                    prod[:,:,3*r+c] = edges[p,r,c]*w[r][c]
+            es[p] = np.sum(prod,axis=2)
+        idx = np.argmax(es,axis=0)  
+        del es, prod
+        edge = np.zeros(g.shape,dtype=int)
+        mask = np.abs(w[1][1]-w[1][0]) < np.abs(w[1][1]-w[1][2])
+        edge = np.where(idx == 0,np.where(mask,0,4),edge)
+        mask = np.abs(w[1][1]-w[2][0]) < np.abs(w[1][1]-w[0][2])
+        edge = np.where(idx == 1,np.where(mask,1,5),edge)
+        mask = np.abs(w[1][1]-w[0][1]) < np.abs(w[1][1]-w[2][1])
+        edge = np.where(idx == 2,np.where(mask,6,2),edge)
+        mask = np.abs(w[1][1]-w[0][0]) < np.abs(w[1][1]-w[2][2])
+        edge = np.where(idx == 3,np.where(mask,7,3),edge)
+#      template statistics for the pixels using each of the 8 templates        
+        for t in range(8):
+            pix = np.where(edge == t)
+            if len(pix[0]) == 0:
+                continue
+            values = np.zeros((len(pix[0]),21))
+            for i in range(21):
+                values[:,i] = wind(templates[t,i]//7,templates[t,i]%7)[pix]
+            var = np.var(values,axis=1)
+            mu = np.mean(values,axis=1)
+            del values
+            gt = g[pix]
+            pos = np.where(var > 0)
+            var = var[pos]
+            mu = mu[pos]
+            gt = gt[pos]
+            alpha = (1 +1.0/m)/(var/mu**2 - 1/m)
+            alpha = np.abs(alpha)
+            a = mu*(alpha-m-1)
+            x = (a+np.sqrt(4*gt*m*alpha*mu+a**2))/(2*alpha)        
+            result[j0+pix[0][pos],3+pix[1][pos]] = x
                    
     return result          
 
+def call_gamma_filter((k,infn,outfn,nb,rows,cols,m)):
+    '''Filter band k of the memory-mapped image in file infn
+       and write the result in place to the one in outfn'''
+    import numpy as np
+    from gamma_filter import gamma_filter
+    inimage = np.memmap(infn,dtype=np.float64,mode='r',shape=(nb,rows,cols))
+    outimage = np.memmap(outfn,dtype=np.float32,mode='r+',shape=(nb,rows,cols))
+    outimage[k] = gamma_filter((k,inimage,rows,cols,m))
+    outimage.flush()
+    return k
+
 def main():
     usage = '''
 Usage:
@@ -135,20 +140,29 @@ Options:
 
    -h     this help
    -d     spatial subset list e.g. -d [0,0,300,300] 
+   --backend b  parallel backend for the bands: auto (default), ipyparallel, 
+                multiprocessing or sequential
+   --workers w  number of engines or worker processes (default all)
    
 enl:
 
   equivalent number of looks   
     
 ------------------------------------------------''' %sys.argv[0]
-    options,args = getopt.getopt(sys.argv[1:],'hd:')
+    options,args = getopt.getopt(sys.argv[1:],'hd:',['backend=','workers='])
     dims = None
+    backend = 'auto'
+    workers = None
     for option, value in options: 
         if option == '-h':
             print usage
             return 
         elif option == '-d':
             dims = eval(value)  
+        elif option == '--backend':
+            backend = value
+        elif option == '--workers':
+            workers = eval(value)
     if len(args) != 2:
         print 'Incorrect number of arguments'
         print usage
@@ -169,68 +183,40 @@ enl:
     root, ext = os.path.splitext(basename)
     outfile = dirn + '/' + root + '_gamma' + ext    
 #  process diagonal bands only
-    driver = inDataset.GetDriver() 
-    if bands == 9:   
-        outDataset = driver.Create(outfile,cols,rows,3,GDT_Float32)
-        inimage = np.zeros((3,rows,cols))
-        band = inDataset.GetRasterBand(1)
-        inimage[0] = band.ReadAsArray(x0,y0,cols,rows)     
-        band = inDataset.GetRasterBand(6)
-        inimage[1] = band.ReadAsArray(x0,y0,cols,rows)
-        band = inDataset.GetRasterBand(9)
-        inimage[2] = band.ReadAsArray(x0,y0,cols,rows)        
+    if bands == 9:
+        diag = [1,6,9]
     elif bands == 4:
-        outDataset = driver.Create(outfile,cols,rows,2,GDT_Float32)        
-        inimage = np.zeros((2,rows,cols))
-        band = inDataset.GetRasterBand(1)
-        inimage[0] = band.ReadAsArray(x0,y0,cols,rows)     
-        band = inDataset.GetRasterBand(4)
-        inimage[1] = band.ReadAsArray(x0,y0,cols,rows) 
+        diag = [1,4]
     else:
-        inimage = np.zeros((1,rows,cols))
-        outDataset = driver.Create(outfile,cols,rows,1,GDT_Float32)
-        inimage[0] = inDataset.GetRasterBand(1).ReadAsArray(x0,y0,cols,rows)   
+        diag = [1]
+    nb = len(diag)
+    driver = inDataset.GetDriver() 
+    outDataset = driver.Create(outfile,cols,rows,nb,GDT_Float32)
+#  input and output bands are exchanged with the workers through memory-mapped files    
+    inmm = NamedTemporaryFile(dir=dirn)
+    inimage = np.memmap(inmm.name,dtype=np.float64,mode='w+',shape=(nb,rows,cols))
+    for k in range(nb):
+        inimage[k] = inDataset.GetRasterBand(diag[k]).ReadAsArray(x0,y0,cols,rows)
+    inimage.flush()
+    outmm = NamedTemporaryFile(dir=dirn)
+    outimage = np.memmap(outmm.name,dtype=np.float32,mode='w+',shape=(nb,rows,cols))
     print '========================='
     print '    GAMMA MAP FILTER'
     print '========================='
     print time.asctime()
     print 'infile:  %s'%infile
     print 'equivalent number of looks: %f'%m    
-    try:
-        start = time.time() 
-        print 'Attempting parallel computation ...'
-        rc = Client()
-        v = rc[:]
-        v.execute('import numpy as np')
-        print 'available engines: %s'%str(rc.ids)
-        if bands == 9:      
-            print 'filtering 3 diagonal matrix element bands ...'   
-            outimage = v.map_sync(gamma_filter,[(0,inimage,rows,cols,m),
-                                                (1,inimage,rows,cols,m),
-                                                (2,inimage,rows,cols,m)])
-        elif bands == 4:
-            print 'filtering 2 diagonal matrix element bands ...' 
-            outimage = v.map_sync(gamma_filter,[(0,inimage,rows,cols,m),
-                                                (1,inimage,rows,cols,m)])
-        else:
-            print 'filtering scalar image ...'
-            outimage = gamma_filter((0,inimage,rows,cols,m))           
-    except:
-        start = time.time() 
-        print 'Failed, so computing sequentially ...'
-        if bands == 9:      
-            print 'filtering 3 diagonal matrix element bands ...'   
-            outimage = map(gamma_filter,[(0,inimage,rows,cols,m),
-                                         (1,inimage,rows,cols,m),
-                                         (2,inimage,rows,cols,m)])
-        elif bands == 4:
-            print 'filtering 2 diagonal matrix element bands ...' 
-
-            outimage = map(gamma_filter,[(0,inimage,rows,cols,m),
-                                         (1,inimage,rows,cols,m)])
-        else:
-            print 'filtering scalar image ...'
-            outimage = gamma_filter((0,inimage,rows,cols,m))                             
+    start = time.time() 
+    ex = Executor(backend,workers)
+    print 'backend: %s'%ex
+    if nb == 3:      
+        print 'filtering 3 diagonal matrix element bands ...'   
+    elif nb == 2:
+        print 'filtering 2 diagonal matrix element bands ...' 
+    else:
+        print 'filtering scalar image ...'
+    ex.map(call_gamma_filter,[(k,inmm.name,outmm.name,nb,rows,cols,m) for k in range(nb)])
+    ex.close()
     geotransform = inDataset.GetGeoTransform()
     if geotransform is not None:
         gt = list(geotransform)
@@ -240,21 +226,13 @@ enl:
     projection = inDataset.GetProjection()        
     if projection is not None:
         outDataset.SetProjection(projection) 
-    if bands == 9:
-        for k in range(3):    
-            outBand = outDataset.GetRasterBand(k+1)
-            outBand.WriteArray(outimage[k],0,0) 
-            outBand.FlushCache() 
-    elif bands == 4:
-        for k in range(2):    
-            outBand = outDataset.GetRasterBand(k+1)
-            outBand.WriteArray(outimage[k],0,0) 
-            outBand.FlushCache() 
-    else:
-        outBand = outDataset.GetRasterBand(1)
-        outBand.WriteArray(outimage,0,0) 
-        outBand.FlushCache()                     
+    for k in range(nb):    
+        outBand = outDataset.GetRasterBand(k+1)
+        outBand.WriteArray(outimage[k],0,0) 
+        outBand.FlushCache() 
     outDataset = None
+    inimage = None
+    outimage = None
     print 'result written to: '+outfile 
     print 'elapsed time: '+str(time.time()-start)                 
               
@@ -38,8 +38,29 @@
 import sys, getopt, gdal, os, re, time
 from zipfile import ZipFile
 from osgeo.gdalconst import GA_ReadOnly, GDT_Float32, GDT_Int16
+import auxil.geotiff as geotiff
+import auxil.vrt as vrt
+from auxil.executor import Executor
 
-def ingest(path,s1infile):
+def split_s1((infile,bandlist,outfile)):
+#  copy the bands in bandlist of the S1 series to outfile, a VRT if outfile ends with .vrt 
+    inDataset = gdal.Open(infile,GA_ReadOnly) 
+    if outfile.endswith('.vrt'):
+        vrt.write(outfile,[(infile,b) for b in bandlist],inDataset,GDT_Float32)
+    else:
+        cols = inDataset.RasterXSize
+        rows = inDataset.RasterYSize  
+        outDataset = geotiff.create(outfile,cols,rows,len(bandlist),GDT_Float32,inDataset,compress='NONE')
+        geotiff.copy([(inDataset,b) for b in bandlist],outDataset)
+        outDataset = None
+    inDataset = None
+    return 'created file %s'%outfile
+
+def call_split_s1(args):
+    from ingests1s2 import split_s1
+    return split_s1(args)
+
+def ingest(path,s1infile,virtual=False,backend='auto',workers=None):
     print '========================='
     print '   Ingesting S1 (and S2)'
     print '========================='
@@ -65,77 +86,38 @@ def ingest(path,s1infile):
             files1.sort()        
             bands = len(files1)
             outfn = path+'sentinel2.tif' 
-            inDataset = gdal.Open(files1[0],GA_ReadOnly)
+            inDatasets = [gdal.Open(afile,GA_ReadOnly) for afile in files1]
+            inDataset = inDatasets[0]
             cols = inDataset.RasterXSize
             rows = inDataset.RasterYSize       
-        #  ingest to a single file
-            driver = gdal.GetDriverByName('GTiff') 
-            outDataset = driver.Create(outfn,cols,rows,bands,GDT_Int16)
-            projection = inDataset.GetProjection()
-            geotransform = inDataset.GetGeoTransform()
-            if geotransform is not None:
-                outDataset.SetGeoTransform(geotransform)
-            if projection is not None:
-                outDataset.SetProjection(projection)    
-            for i in range(bands):
-                print 'writing band %i'%(i+1)
-                inDataset = gdal.Open(files1[i])
-                inBand = inDataset.GetRasterBand(1)
-                band = inBand.ReadAsArray(0,0,cols,rows)
-                outBand = outDataset.GetRasterBand(i+1)
-                outBand.WriteArray(band)
-                outBand.FlushCache()
-                inDataset = None
-                os.remove(files1[i].replace('.tif','.tfw'))
-                os.remove(files1[i])
+        #  ingest to a single file, block by block
+            print 'writing %i bands'%bands
+            outDataset = geotiff.create(outfn,cols,rows,bands,GDT_Int16,inDataset,compress='NONE')
+            geotiff.copy([(inDataset,1) for inDataset in inDatasets],outDataset)
             outDataset = None   
+            inDatasets = None
+            inDataset = None
+            for afile in files1:
+                os.remove(afile.replace('.tif','.tfw'))
+                os.remove(afile)
             print 'created file %s' %outfn
-#      ingest the SAR image to a time series of files                
+#      ingest the SAR image to a time series of files, one per acquisition                
         infile = path+s1infile
         inDataset = gdal.Open(infile,GA_ReadOnly) 
-        driver = inDataset.GetDriver() 
-        cols = inDataset.RasterXSize
-        rows = inDataset.RasterYSize  
         bands = inDataset.RasterCount      
+        inDataset = None
+        ext = '.vrt' if virtual else '.tif'
         if bands == 2:
 #          dual pol diagonal only  
-            for i in range(bands/2):
-                outfile = path+'sentinel1_VVVH_%i.tif'%(i+1)            
-                geotransform = inDataset.GetGeoTransform()
-                projection = inDataset.GetProjection()
-                outDataset = driver.Create(outfile,cols,rows,2,GDT_Float32)
-                if geotransform is not None:
-                    outDataset.SetGeoTransform(geotransform)        
-                if projection is not None:
-                    outDataset.SetProjection(projection)
-                inArray = inDataset.GetRasterBand(2*i+1).ReadAsArray(0,0,cols,rows)
-                outBand = outDataset.GetRasterBand(1)    
-                outBand.WriteArray(inArray,0,0)
-                outBand.FlushCache()
-                outBand = outDataset.GetRasterBand(2)
-                inArray = inDataset.GetRasterBand(2*i+2).ReadAsArray(0,0,cols,rows)
-                outBand.WriteArray(inArray,0,0) 
-                outBand.FlushCache()
-                outDataset = None
-                print 'created file %s'%outfile
+            args = [(infile,[2*i+1,2*i+2],path+'sentinel1_VVVH_%i'%(i+1)+ext) for i in range(bands/2)]
         else:
 #          single pol VV or VH 
-            for i in range(bands):
-                outfile = path+'sentinel1_VV_%i.tif'%(i+1)            
-                geotransform = inDataset.GetGeoTransform()
-                projection = inDataset.GetProjection()
-                outDataset = driver.Create(outfile,cols,rows,1,GDT_Float32)
-                if geotransform is not None:
-                    outDataset.SetGeoTransform(geotransform)        
-                if projection is not None:
-                    outDataset.SetProjection(projection)
-                inArray = inDataset.GetRasterBand(i+1).ReadAsArray(0,0,cols,rows)
-                outBand = outDataset.GetRasterBand(1)    
-                outBand.WriteArray(inArray,0,0)
-                outBand.FlushCache()
-                outDataset = None
-                print 'created file %s'%outfile                
-        inDataset = None   
+            args = [(infile,[i+1],path+'sentinel1_VV_%i'%(i+1)+ext) for i in range(bands)]
+        ex = Executor(backend,workers)
+        print 'backend: %s'%ex
+        for result in ex.imap(call_split_s1,args):
+            print result
+        ex.close()
         print 'elapsed time: ' + str(time.time() - start)
     except Exception as e:
         print 'Error %s'%e         
@@ -157,19 +139,33 @@ python %s [OPTIONS] PATH S1_INFILENAME
 
 Options:
 
-   -h    this help
+   -h           this help
+   --vrt        write the sentinel-1 time series as virtual images (.vrt) which
+                reference the bands of S1_INFILENAME instead of copying them
+   --backend b  parallel backend for the time series: auto (default), 
+                ipyparallel, multiprocessing or sequential
+   --workers w  number of engines or worker processes (default all)
 
 --------------------------------------------'''%sys.argv[0]
-    options,args = getopt.getopt(sys.argv[1:],'h')
-    for option,_ in options: 
+    options,args = getopt.getopt(sys.argv[1:],'h',['vrt','backend=','workers='])
+    virtual = False
+    backend = 'auto'
+    workers = None
+    for option,value in options: 
         if option == '-h':
             print usage
             return 
+        elif option == '--vrt':
+            virtual = True
+        elif option == '--backend':
+            backend = value
+        elif option == '--workers':
+            workers = eval(value)
     if len(args) != 2:              
         print 'Incorrect number of arguments'
         print usage
         sys.exit(1)   
-    ingest(args[0],args[1])
+    ingest(args[0],args[1],virtual,backend,workers)
     
     
 if __name__ == '__main__':
@@ -33,6 +33,8 @@
 import sys, getopt, gdal
 from osgeo.gdalconst import GA_ReadOnly, GDT_Byte
 import numpy as np
+import auxil.geotiff as geotiff
+import auxil.bmaps as bmaps
 
 def merge(inbmapfn1,inbmapfn2):
     incmapfn1 = inbmapfn1.replace('bmap','cmap')
@@ -46,78 +48,44 @@ def merge(inbmapfn1,inbmapfn2):
     outfmapfn = outbmapfn.replace('bmap','fmap')
 #  change map dimensions and georeferencing
     gdal.AllRegister()
-    inDataset1 = gdal.Open(inbmapfn1,GA_ReadOnly)
-    inDataset2 = gdal.Open(inbmapfn2,GA_ReadOnly)
-    geotransform = inDataset1.GetGeoTransform()
-    projection = inDataset1.GetProjection() 
-    driver = inDataset1.GetDriver()
+    inDatasets = [gdal.Open(fn,GA_ReadOnly) for fn in 
+                  [inbmapfn1,inbmapfn2,incmapfn1,incmapfn2,insmapfn1,insmapfn2]]
+    inDataset1 = inDatasets[0]
     cols = inDataset1.RasterXSize
     rows = inDataset1.RasterYSize    
-    bands = inDataset1.RasterCount 
-#  merge the VV and VH bmaps by inclusive OR
-    bmap = np.zeros((rows,cols,bands),dtype=np.int16)
-    for k in range(bands):
-        vvband = inDataset1.GetRasterBand(k+1).ReadAsArray(0,0,cols,rows)
-        vhband = inDataset2.GetRasterBand(k+1).ReadAsArray(0,0,cols,rows)
-        bmap[:,:,k] = (vvband | vhband)/255  
-    bmap = np.byte(bmap)  
-#  merged frequency map
-    fmap = np.sum(bmap,axis=2)
-#  merged last change map
-    inDataset1 = gdal.Open(incmapfn1,GA_ReadOnly)
-    inDataset2 = gdal.Open(incmapfn2,GA_ReadOnly)
-    tmp = np.zeros((rows,cols,2),dtype=np.byte)
-    tmp[:,:,0] = inDataset1.GetRasterBand(1).ReadAsArray(0,0,cols,rows)
-    tmp[:,:,1] = inDataset2.GetRasterBand(1).ReadAsArray(0,0,cols,rows)
-    cmap = np.max(tmp,axis=2)
-#  merged first change map
-    inDataset1 = gdal.Open(insmapfn1,GA_ReadOnly)
-    inDataset2 = gdal.Open(insmapfn2,GA_ReadOnly)
-    tmp[:,:,0] = inDataset1.GetRasterBand(1).ReadAsArray(0,0,cols,rows)
-    tmp[:,:,1] = inDataset2.GetRasterBand(1).ReadAsArray(0,0,cols,rows)
-    smap = np.max(tmp,axis=2)    
-#  write merged bmap to disk
-    outDataset = driver.Create(outbmapfn,cols,rows,bands,GDT_Byte)
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)        
-    if projection is not None:
-        outDataset.SetProjection(projection)
-    for k in range(bands):        
-        outBand = outDataset.GetRasterBand(k+1)
-        outBand.WriteArray(bmap[:,:,k],0,0) 
-        outBand.FlushCache()
-    print 'bmap written to %s'%outbmapfn    
-#  write merged cmap to disk
-    outDataset = driver.Create(outcmapfn,cols,rows,1,GDT_Byte)
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)        
-    if projection is not None:
-        outDataset.SetProjection(projection)   
-    outBand = outDataset.GetRasterBand(1)
-    outBand.WriteArray(cmap,0,0)
-    outBand.FlushCache()
-    print 'cmap written to %s'%outcmapfn    
-#  write merged smap to disk
-    outDataset = driver.Create(outsmapfn,cols,rows,1,GDT_Byte)
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)        
-    if projection is not None:
-        outDataset.SetProjection(projection)   
-    outBand = outDataset.GetRasterBand(1)
-    outBand.WriteArray(smap,0,0) 
-    outBand.FlushCache()
-    print 'smap written to %s'%outsmapfn   
-#  write merged fmap to disk
-    outDataset = driver.Create(outfmapfn,cols,rows,1,GDT_Byte)
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)        
-    if projection is not None:
-        outDataset.SetProjection(projection)   
-    outBand = outDataset.GetRasterBand(1)
-    outBand.WriteArray(fmap,0,0)  
-    outBand.FlushCache()
-    print 'fmap written to %s'%outfmapfn       
+    bands = bmaps.intervals(inDataset1)
+    packed = bmaps.is_packed(inDataset1)
+    outfns = [outbmapfn,outcmapfn,outsmapfn,outfmapfn]
+    outDatasets = []
+    for fn,nb in zip(outfns,[inDataset1.RasterCount,1,1,1]):
+        outDatasets.append(geotiff.create(fn,cols,rows,nb,GDT_Byte,inDataset1))
+    if packed:
+        bmaps.mark(outDatasets[0],bands)
+#  merge strip by strip, memory use does not depend on the series length
+    for y0 in range(0,rows,geotiff.BLOCKSIZE):
+        h = min(geotiff.BLOCKSIZE,rows-y0)
+        vv,vh = [bmaps.read(inDataset,0,y0,cols,h) for inDataset in inDatasets[:2]]
+#      merge the VV and VH bmaps (packed or not) by inclusive OR
+        bmap = vv | vh
+#      merged frequency map
+        fmap = bmaps.count(bmap)
+        if not packed:
+            bmap = bmaps.unpack(bmap,bands,1)
+#      merged last and first change maps
+        cmap,smap = [np.maximum(inDatasets[i].GetRasterBand(1).ReadAsArray(0,y0,cols,h),
+                                inDatasets[i+1].GetRasterBand(1).ReadAsArray(0,y0,cols,h)) for i in (2,4)]
+        for outDataset,amap in zip(outDatasets,[bmap,cmap,smap,fmap]):
+            geotiff.write(outDataset,np.reshape(amap,(h,cols,-1)),0,y0)
+#  write merged maps to disk
+    for outDataset in outDatasets:
+        geotiff.close(outDataset)
+    outDatasets = None
     outDataset = None
+    for fn,name in zip(outfns,['bmap','cmap','smap','fmap']):
+        geotiff.finish(fn)
+        print '%s written to %s'%(name,fn)
+    inDatasets = None
+    inDataset1 = None
 
 def main():
     usage = '''
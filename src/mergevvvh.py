@@ -31,67 +31,16 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-import sys, getopt, gdal, os, re, time
-from osgeo.gdalconst import GA_ReadOnly, GDT_Float32
+import sys, getopt, time
+import auxil.vvvh as vvvh
 
-def merge(path):
+def merge(path,virtual=False,backend='auto',workers=None):
     print '========================='
     print '     Merge VV and VH'
     print '========================='
     print time.asctime()  
     print 'Directory %s'%path 
-    
-    gdal.AllRegister()
-    try:
-    #  get sorted lists of VV and VH files    
-        files = os.listdir(path)
-        vvfiles = []
-        vhfiles = []
-        for afile in files:
-            if re.search('\.VV_[0-9]{1,2}\.tif',afile):   
-                vvfiles.append(afile)
-            elif re.search('\.VH_[0-9]{1,2}\.tif',afile): 
-                vhfiles.append(afile)
-        if (len(vvfiles) != len(vhfiles)) or (len(vvfiles)==0) :
-            raise Exception('file mismatch or no files found')
-        os.chdir(path)
-        vvfiles.sort()
-        vhfiles.sort()
-        inDataset1 = gdal.Open(vvfiles[0],GA_ReadOnly) 
-        driver = inDataset1.GetDriver() 
-        cols = inDataset1.RasterXSize
-        rows = inDataset1.RasterYSize        
-        for i in range(len(vvfiles)):
-            outfile = vvfiles[i].replace('VV','VVVH')
-            inDataset1 = gdal.Open(vvfiles[i],GA_ReadOnly)  
-            inDataset2 = gdal.Open(vhfiles[i],GA_ReadOnly)   
-            geotransform = inDataset1.GetGeoTransform()
-            projection = inDataset1.GetProjection()
-            outDataset = driver.Create(outfile,cols,rows,2,GDT_Float32)
-            if geotransform is not None:
-                outDataset.SetGeoTransform(geotransform)        
-            if projection is not None:
-                outDataset.SetProjection(projection)
-            inArray = inDataset1.GetRasterBand(1).ReadAsArray(0,0,cols,rows)
-            outBand = outDataset.GetRasterBand(1)    
-            outBand.WriteArray(inArray,0,0)
-            outBand.FlushCache()
-            outBand = outDataset.GetRasterBand(2)
-            inArray = inDataset2.GetRasterBand(1).ReadAsArray(0,0,cols,rows)
-            outBand.WriteArray(inArray,0,0) 
-            outBand.FlushCache()
-            print '%s and %s merged to %s'%(vvfiles[i],vhfiles[i],outfile) 
-        inDataset1 = None
-        inDataset2 = None
-        outDataset = None     
-        for i in range(len(vvfiles)):
-            os.remove(vvfiles[i].replace('.tif','.tfw'))
-            os.remove(vhfiles[i].replace('.tif','.tfw'))
-            os.remove(vvfiles[i])
-            os.remove(vhfiles[i])
-    except Exception as e:
-        print 'Error %s'%e 
-        return None     
+    vvvh.merge(path,virtual,backend,workers)
 
 def main():
     usage = '''
@@ -101,23 +50,40 @@ Usage:
 python %s [OPTIONS] PATH
 
     merge time series of vv and vh single pol SAR images in PATH
-    to a series of 2-band images (dualpol diagonal only polarimetric matrix)
+    to a series of 2-band images (dualpol diagonal only polarimetric matrix).
+    VV and VH files are paired by the sensing start in their Sentinel-1
+    product names (S1A_IW_GRDH_1SDV_YYYYMMDDTHHMMSS_...), otherwise by
+    their series number. 
     
 Options:
 
-   -h    this help
+   -h           this help
+   --vrt        write virtual images (.vrt) which reference the VV and VH files
+                instead of copying them, the VV and VH files are kept
+   --backend b  parallel backend for the image pairs: auto (default), 
+                ipyparallel, multiprocessing or sequential
+   --workers w  number of engines or worker processes (default all)
 
 --------------------------------------------'''%sys.argv[0]
-    options,args = getopt.getopt(sys.argv[1:],'h')
-    for option,_ in options: 
+    options,args = getopt.getopt(sys.argv[1:],'h',['vrt','backend=','workers='])
+    virtual = False
+    backend = 'auto'
+    workers = None
+    for option,value in options: 
         if option == '-h':
             print usage
             return 
+        elif option == '--vrt':
+            virtual = True
+        elif option == '--backend':
+            backend = value
+        elif option == '--workers':
+            workers = eval(value)
     if len(args) != 1:              
         print 'Incorrect number of arguments'
         print usage
         sys.exit(1)   
-    merge(args[0])
+    merge(args[0],virtual,backend,workers)
     
     
 if __name__ == '__main__':
@@ -31,9 +31,14 @@
 # SOFTWARE.
 
 import numpy as np
-from scipy import stats, ndimage
-import os, sys, time, getopt, gdal  
+from scipy import ndimage
+import os, sys, time, getopt, gdal, shutil, atexit
+import auxil.polsar as polsar
+import auxil.geotiff as geotiff
+import auxil.vrt as vrt
+from auxil.executor import Executor
 from osgeo.gdalconst import GA_ReadOnly, GDT_Float32, GDT_Byte
+from tempfile import mkdtemp
 
 def getmat(fn,x0,y0,cols,rows,bands):
 #  read 9- 4- or 1-band preprocessed files and return real/complex matrix elements 
@@ -89,12 +94,108 @@ def getmat(fn,x0,y0,cols,rows,bands):
         k1 = b.ReadAsArray(x0,y0,cols,rows)  
         inDataset1 = None
         return k1
+
+def omnibus(fns,m,bands,x0,y0,cols,rows,x1=0,y1=0):
+    '''Return the test statistic Z, the change probability P and the summed
+       first diagonal element k for the window (x0,y0,cols,rows) of the first
+       image and (x1,y1,cols,rows) of the others'''
+    p = {9:3,4:2,1:1}[bands]
+    n = np.float64(len(fns))      # number of images
+    eps = sys.float_info.min
+    sumlogdet = 0.0
+    k = 0.0; a = 0.0; rho = 0.0; xsi = 0.0; b = 0.0; zeta = 0.0
+    for fn in fns:
+        result = getmat(fn,x0,y0,cols,rows,bands)
+        if p==3:
+            k1,a1,rho1,xsi1,b1,zeta1 = result
+            k1 = m*np.float64(k1)
+            a1 = m*np.complex128(a1)
+            rho1 = m*np.complex128(rho1)
+            xsi1 = m*np.float64(xsi1)
+            b1 = m*np.complex128(b1)
+            zeta1 = m*np.float64(zeta1)
+            k += k1; a += a1; rho += rho1; xsi += xsi1; b += b1; zeta += zeta1 
+            logdet1 = polsar.logdet((k1,a1,rho1,xsi1,b1,zeta1),9,eps=0.0,fill=eps)
+        elif p==2:
+            k1,a1,xsi1 = result
+            k1 = m*np.float64(k1)
+            a1 = m*np.complex128(a1)
+            xsi1 = m*np.float64(xsi1)
+            k += k1; a += a1; xsi += xsi1
+            logdet1 = polsar.logdet((k1,a1,xsi1),4,eps=0.0,fill=eps)
+        elif p==1:
+            k1 = m*np.float64(result)
+            k += k1
+            logdet1 = polsar.logdet((k1,),1,eps=0.0,fill=eps)
+        x0 = x1 # subsequent files are warped to cols x rows
+        y0 = y1           
+        sumlogdet += logdet1 
+    if p==3: 
+        logdetsum = polsar.logdet((k,a,rho,xsi,b,zeta),9,eps=0.0,fill=eps)
+    elif p==2:
+        logdetsum = polsar.logdet((k,a,xsi),4,eps=0.0,fill=eps)
+    elif p==1:
+        logdetsum = polsar.logdet((k,),1,eps=0.0,fill=eps)
+    lnQ = m*(p*n*np.log(n) + sumlogdet - n*logdetsum)
+    f =(n-1)*p**2
+    rho = 1 - (2*p**2 - 1)*(n/m - 1/(m*n))/(6*(n - 1)*p)
+    omega2 = p**2*(p**2 - 1)*(n/m**2 - 1/(m*n)**2)/(24*rho**2) - p**2*(n - 1)*(1 - 1/rho)**2/4
+#  test statistic    
+    Z = -2*rho*lnQ
+#  change probability
+    P =  1.0 - polsar.chi2mix(Z,f,omega2)
+    return (Z,P,k)
+
+def omnibus_tile((fns,m,bands,medianfilter,x0,y0,tx,ty,w,h,cols,rows)):
+    '''Return Z, P and log(k) for the block (tx,ty,w,h) of the cols x rows 
+       change images whose origin is (x0,y0) in the first image'''
+#  read a halo around the block for the median filter
+    halo = 1 if medianfilter else 0
+    xa = max(tx-halo,0)
+    ya = max(ty-halo,0)
+    xb = min(tx+w+halo,cols)
+    yb = min(ty+h+halo,rows)
+    Z,P,k = omnibus(fns,m,bands,x0+xa,y0+ya,xb-xa,yb-ya,xa,ya)
+    if medianfilter:
+        P =  ndimage.filters.median_filter(P, size = (3,3))
+    dx = tx-xa
+    dy = ty-ya    
+    Z,P,k = [x[dy:dy+h,dx:dx+w] for x in (Z,P,k)]
+    return (tx,ty,w,h,Z,P,np.log(k+0.01))
+
+def call_omnibus_tile(args):
+    from omnibus import omnibus_tile
+    return omnibus_tile(args)
+
+def logk_block(fns,m,x0,y0,tx,ty,w,h):
+    '''Return log(k) for the block (tx,ty,w,h) of the change images whose
+       origin is (x0,y0) in the first image, only band 1 is read'''
+    k = 0.0
+    for fn in fns:
+        inDataset1 = gdal.Open(fn,GA_ReadOnly)
+        k += m*np.float64(inDataset1.GetRasterBand(1).ReadAsArray(x0+tx,y0+ty,w,h))
+        inDataset1 = None
+        x0 = 0 # subsequent files are warped to cols x rows
+        y0 = 0
+    return np.log(k+0.01)
+
+def cmap_image(c11,change,min1,max1):
+    '''Return the change map image bands, changes in red on the log intensity
+       c11 scaled from (min1,max1) to (0,255)'''
+    a255 = np.ones(c11.shape,dtype=np.byte)*255
+    a0 = a255*0
+    c11 = (c11-min1)*255.0/(max1-min1)  
+    c11 = np.where(c11<0,a0,c11)  
+    c11 = np.where(c11>255,a255,c11) 
+    c11 = np.where(change,a0,c11)      
+    cmap = np.where(change,a255,c11)
+    return (cmap,c11)
                        
 def main():
     usage = '''
 Usage:
 ------------------------------------------------
-    python %s [-h] [-d dims] [-s significance] [-m] infile_1,infile_2,...,infile_n outfilename enl
+    python %s [-h] [-d dims] [-s significance] [-m] [--stack b] infile_1,infile_2,...,infile_n outfilename enl
     
     Perform change detection on multi-temporal, polarimetric SAR imagery in covariance or 
     coherency matrix format.
@@ -102,10 +203,25 @@ Usage:
                   infiles are comma-separated, no blank spaces, dims applies to first infile,
                   others are assumed warped to spatial dimension dims
                   outfilename is without path (will be written to same directory as infile_1)
+                  --stack b: infile is a single time series stack with b bands per image, 
+                  which is split into temporary virtual images without copying,
+                  dims applies to all images
+                  significance may be a comma-separated list of levels, e.g. 0.01,0.005,0.001,
+                  outfilename then has one change map band per level and a change map image
+                  outfilename_<level>_cmap is written for each
+                  --tile size: process the images in blocks of size x size pixels,
+                  so that memory use is bounded by the block size
+                  --backend b: parallel backend for the blocks: auto (default), ipyparallel,
+                  multiprocessing or sequential
+                  --workers w: number of engines or worker processes (default all)
 --------------------------------------------'''%sys.argv[0]
 
-    options,args = getopt.getopt(sys.argv[1:],'hmd:s:')
+    options,args = getopt.getopt(sys.argv[1:],'hmd:s:',['stack=','tile=','backend=','workers='])
     dims = None
+    stack = None
+    tile = None
+    backend = 'auto'
+    workers = None
     medianfilter = False
     significance = 0.01
     for option, value in options: 
@@ -118,15 +234,34 @@ Usage:
             dims = eval(value)  
         elif option == '-s':
             significance = eval(value)           
+        elif option == '--stack':
+            stack = eval(value)
+        elif option == '--tile':
+            tile = eval(value)
+        elif option == '--backend':
+            backend = value
+        elif option == '--workers':
+            workers = eval(value)
     if len(args) != 3:
         print 'Incorrect number of arguments'
         print usage
         sys.exit(1)        
+    if isinstance(significance,(list,tuple)):
+#      decreasing, so that change at a level implies change at the preceding ones        
+        levels = sorted(significance,reverse=True)
+    else:
+        levels = [significance]
     fns = args[0].split(',')
+#  outputs go to the directory of the first input file    
+    dirn = os.path.dirname(os.path.abspath(fns[0]))
+    if stack is not None:
+#      virtual images of the stack are scratch files of this run        
+        tmpdir = mkdtemp(prefix='omnibus_')
+        atexit.register(shutil.rmtree,tmpdir,True)
+        fns = vrt.split(fns[0],stack,outdir=tmpdir,window=dims)
+        dims = None
     outfn = args[1]
     m = np.float64(eval(args[2])) # equivalent number of looks
-    n = np.float64(len(fns))      # number of images
-    eps = sys.float_info.min
     print '==============================================='
     print 'Multi-temporal Complex Wishart Change Detection'
     print '==============================================='
@@ -153,115 +288,94 @@ Usage:
     print 'first (reference) filename:  %s'%fns[0]
     print 'number of looks: %f'%m 
 #  output file
-    path = os.path.abspath(fns[0])    
-    dirn = os.path.dirname(path)
     outfn = dirn + '/' + outfn 
+    basename = os.path.basename(outfn)
+    name, ext = os.path.splitext(basename)
+    if len(levels) > 1:
+        outfns1 = [outfn.replace(name,name+'_%g_cmap'%level) for level in levels]
+    else:
+        outfns1 = [outfn.replace(name,name+'_cmap')]
     start = time.time()
-    sumlogdet = 0.0
-    k = 0.0; a = 0.0; rho = 0.0; xsi = 0.0; b = 0.0; zeta = 0.0
-    for fn in fns:
-        print 'ingesting: %s'%fn
-        result = getmat(fn,x0,y0,cols,rows,bands)
-        if p==3:
-            k1,a1,rho1,xsi1,b1,zeta1 = result
-            k1 = m*np.float64(k1)
-            a1 = m*np.complex128(a1)
-            rho1 = m*np.complex128(rho1)
-            xsi1 = m*np.float64(xsi1)
-            b1 = m*np.complex128(b1)
-            zeta1 = m*np.float64(zeta1)
-            k += k1; a += a1; rho += rho1; xsi += xsi1; b += b1; zeta += zeta1 
-            det1 = k1*xsi1*zeta1 + 2*np.real(a1*b1*np.conj(rho1)) - xsi1*(abs(rho1)**2) - k1*(abs(b1)**2) - zeta1*(abs(a1)**2)  
-        elif p==2:
-            k1,a1,xsi1 = result
-            k1 = m*np.float64(k1)
-            a1 = m*np.complex128(a1)
-            xsi1 = m*np.float64(xsi1)
-            k += k1; a += a1; xsi += xsi1
-            det1 = k1*xsi1 - abs(a1)**2
-        elif p==1:
-            k1 = m*np.float64(result)
-            k += k1
-            det1 = k1
-        x0 = 0 # subsequent files are warped to cols x rows
-        y0 = 0           
-        idx = np.where(det1 <= 0.0)
-        det1[idx] = eps 
-        sumlogdet += np.log(det1) 
-    if p==3: 
-        detsum = k*xsi*zeta + 2*np.real(a*b*np.conj(rho)) - xsi*(abs(rho)**2) - k*(abs(b)**2) - zeta*(abs(a)**2) 
-    elif p==2:
-        detsum = k*xsi - abs(a)**2
-    elif p==1:
-        detsum = k  
-    idx = np.where(detsum <= 0.0)
-    detsum[idx] = eps 
-    logdetsum = np.log(detsum)
-    lnQ = m*(p*n*np.log(n) + sumlogdet - n*logdetsum)
-    f =(n-1)*p**2
-    rho = 1 - (2*p**2 - 1)*(n/m - 1/(m*n))/(6*(n - 1)*p)
-    omega2 = p**2*(p**2 - 1)*(n/m**2 - 1/(m*n)**2)/(24*rho**2) - p**2*(n - 1)*(1 - 1/rho)**2/4
-#  test statistic    
-    Z = -2*rho*lnQ
-#  change probability
-    P =  (1.-omega2)*stats.chi2.cdf(Z,[f])+omega2*stats.chi2.cdf(Z,[f+4])
-    if medianfilter:
-        P =  ndimage.filters.median_filter(P, size = (3,3))  # for noisy satellite data
-#  change map
-    a255 = np.ones((rows,cols),dtype=np.byte)*255
-    a0 = a255*0
-    c11 = np.log(k+0.01) 
-    min1 =np.min(c11)
-    max1 = np.max(c11)
-    c11 = (c11-min1)*255.0/(max1-min1)  
-    c11 = np.where(c11<0,a0,c11)  
-    c11 = np.where(c11>255,a255,c11) 
-    c11 = np.where(P>(1.0-significance),a0,c11)      
-    cmap = np.where(P>(1.0-significance),a255,c11)
-    cmap0 = np.where(P>(1.0-significance),a255,a0)
-#  write to file system        
-    driver = inDataset1.GetDriver()  
-#    driver = gdal.GetDriverByName('ENVI')  
-    outDataset = driver.Create(outfn,cols,rows,3,GDT_Float32)
-    geotransform = inDataset2.GetGeoTransform()
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)
-    projection = inDataset2.GetProjection()        
-    if projection is not None:
-        outDataset.SetProjection(projection) 
-    outBand = outDataset.GetRasterBand(1)
-    outBand.WriteArray(Z,0,0) 
-    outBand.FlushCache() 
-    outBand = outDataset.GetRasterBand(2)
-    outBand.WriteArray(P,0,0) 
-    outBand.FlushCache() 
-    outBand = outDataset.GetRasterBand(3)
-    outBand.WriteArray(cmap0,0,0) 
-    outBand.FlushCache()     
+    if tile is None:
+        for fn in fns:
+            print 'ingesting: %s'%fn
+        Z,P,k = omnibus(fns,m,bands,x0,y0,cols,rows)
+        if medianfilter:
+            P =  ndimage.filters.median_filter(P, size = (3,3))  # for noisy satellite data
+#      number of significance levels at which change is detected        
+        changes = np.zeros((rows,cols),dtype=np.uint8)
+        for level in levels:
+            changes += P>(1.0-level)
+        logk = np.log(k+0.01) 
+        min1 = np.min(logk)
+        max1 = np.max(logk)
+        step = rows
+#      write to file system        
+        outDataset = geotiff.create(outfn,cols,rows,2+len(levels),GDT_Float32,inDataset2)
+        a255 = np.ones((rows,cols),dtype=np.uint8)*255
+        geotiff.write(outDataset,[Z,P]+[np.where(changes>i,a255,a255*0) for i in range(len(levels))])
+    else:
+#      test statistic and change probabilities block by block, only the range
+#      of the log intensity is kept for the change map images        
+        args1 = [(fns,m,bands,medianfilter,x0,y0,tx,ty,min(tile,cols-tx),min(tile,rows-ty),cols,rows)
+                                for ty in range(0,rows,tile) for tx in range(0,cols,tile)]
+        print 'calculating change probabilities in %i blocks of %i x %i pixels ...'%(len(args1),tile,tile)
+        ex = Executor(backend,workers)
+        print 'backend: %s'%ex
+        outDataset = geotiff.create(outfn,cols,rows,2+len(levels),GDT_Float32,inDataset2)
+        min1 = np.inf
+        max1 = -np.inf
+        print 'block = ',
+        i = 0
+        for tx,ty,w,h,Z,P,c11 in ex.imap(call_omnibus_tile,args1):
+            i += 1
+            print i,
+            sys.stdout.flush()
+            change = np.zeros((h,w),dtype=np.uint8)
+            for level in levels:
+                change += P>(1.0-level)
+            a255 = np.ones((h,w),dtype=np.uint8)*255
+            geotiff.write(outDataset,[Z,P]+[np.where(change>l,a255,a255*0) for l in range(len(levels))],tx,ty)
+            min1 = min(min1,np.min(c11))
+            max1 = max(max1,np.max(c11))
+        ex.close()
+        print
+        step = geotiff.BLOCKSIZE
+    geotiff.close(outDataset,'AVERAGE')
     outDataset = None
+    geotiff.finish(outfn)
     print 'test statistic, change probabilities and change map written to: %s'%outfn 
-    basename = os.path.basename(outfn)
-    name, ext = os.path.splitext(basename)
-    outfn=outfn.replace(name,name+'_cmap')
-    outDataset = driver.Create(outfn,cols,rows,3,GDT_Byte)
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)
-    projection = inDataset1.GetProjection()        
-    if projection is not None:
-        outDataset.SetProjection(projection)     
-    outBand = outDataset.GetRasterBand(1)
-    outBand.WriteArray(cmap,0,0) 
-    outBand.FlushCache() 
-    outBand = outDataset.GetRasterBand(2)
-    outBand.WriteArray(c11,0,0) 
-    outBand.FlushCache()  
-    outBand = outDataset.GetRasterBand(3)
-    outBand.WriteArray(c11,0,0) 
-    outBand.FlushCache()  
-    outDataset = None    
+#  change map images, levels are decreasing so change at a level implies 
+#  change at all preceding ones. In tile mode the log intensity is
+#  recomputed and the change flags are read back strip by strip
+    if tile is not None:
+        inDataset = gdal.Open(outfn,GA_ReadOnly)
+    outDatasets = [geotiff.create(outfn1,cols,rows,3,GDT_Byte,inDataset2) for outfn1 in outfns1]
+    for ty in range(0,rows,step):
+        h = min(step,rows-ty)
+        if tile is None:
+            c11 = logk[ty:ty+h]
+        else:
+            c11 = logk_block(fns,m,x0,y0,0,ty,cols,h)
+        for i,outDataset in enumerate(outDatasets):
+            if tile is None:
+                change = changes[ty:ty+h]>i
+            else:
+                change = inDataset.GetRasterBand(3+i).ReadAsArray(0,ty,cols,h)>0
+            cmap,c11a = cmap_image(c11,change,min1,max1)
+            geotiff.write(outDataset,[cmap,c11a,c11a],0,ty)
+    for outDataset in outDatasets:
+        geotiff.close(outDataset)
+    outDatasets = None
+    outDataset = None
+    inDataset = None
+    for outfn1 in outfns1:
+        geotiff.finish(outfn1)
+        print 'change map image written to: %s'%outfn1  
+    logk = None
+    changes = None
     inDataset1 = None
     inDataset2 = None
-    print 'change map image written to: %s'%outfn  
     print 'elapsed time: '+str(time.time()-start)     
 # # test against Matlab   
 #     fn = '/home/mort/imagery/sar/emisar/m2rlnQ63646568'
@@ -39,13 +39,46 @@
 
 import sys, getopt
   
-def registersar(file0, file1, dims=None, outfile=None): 
+def warp_band((fn, k, A, b, rows, cols, outfn, bands)):
+    '''Resample band k of fn with the affine transformation (A,b) to the 
+       rows x cols output grid in blocks of 256 rows, reading only the part of 
+       the band each block needs, and store it in the memory-mapped file outfn'''
+    import numpy as np
+    from osgeo import gdal
+    import scipy.ndimage.interpolation as ndii
+    from osgeo.gdalconst import GA_ReadOnly
+    inDataset = gdal.Open(fn, GA_ReadOnly)
+    rows1 = inDataset.RasterYSize
+    cols1 = inDataset.RasterXSize
+    rasterBand = inDataset.GetRasterBand(k+1)
+    outimage = np.memmap(outfn,dtype=np.float32,mode='r+',shape=(bands,rows,cols))
+    for r0 in range(0,rows,256):
+        r1 = min(r0+256,rows)
+#      bounding box of the block in the target, with a margin for the spline prefilter        
+        p = np.dot([[r0,0],[r0,cols-1],[r1-1,0],[r1-1,cols-1]],A.T) + b
+        ya = max(int(np.floor(p[:,0].min()))-16,0)
+        yb = min(int(np.ceil(p[:,0].max()))+17,rows1)
+        xa = max(int(np.floor(p[:,1].min()))-16,0)
+        xb = min(int(np.ceil(p[:,1].max()))+17,cols1)
+        if ya >= yb or xa >= xb:
+            outimage[k,r0:r1,:] = 0.0
+            continue
+        bn1 = np.nan_to_num(rasterBand.ReadAsArray(xa,ya,xb-xa,yb-ya).astype(np.float32))
+        offset = b + np.dot(A,[r0,0]) - [ya,xa]
+        outimage[k,r0:r1,:] = ndii.affine_transform(bn1,A,offset,output_shape=(r1-r0,cols))
+    outimage.flush()
+    inDataset = None
+    return k
+    
+def registersar(file0, file1, dims=None, outfile=None, backend='sequential', workers=None, subpixel=False, levels=0): 
     import auxil.auxil as auxil
+    import auxil.cache as cache
     import os, time
     import numpy as np
     from osgeo import gdal
-    import scipy.ndimage.interpolation as ndii
     from osgeo.gdalconst import GA_ReadOnly, GDT_Float32
+    from auxil.executor import Executor
+    from tempfile import NamedTemporaryFile
     
     print '========================='
     print '     Register SAR'
@@ -59,6 +92,10 @@ def registersar(file0, file1, dims=None, outfile=None):
             basename = os.path.basename(file1)
             root, ext = os.path.splitext(basename)
             outfile = dirn + '/' + root + '_warp' + ext  
+    #  virtual (VRT) targets cannot be written to, they are warped to GeoTIFF
+        root, ext = os.path.splitext(outfile)
+        if ext.lower() == '.vrt':
+            outfile = root + '.tif'
         start = time.time()   
         gdal.AllRegister()
     #  reference    
@@ -70,17 +107,31 @@ def registersar(file0, file1, dims=None, outfile=None):
         if dims == None:
             dims = [0,0,cols,rows]
         x0,y0,cols,rows = dims 
+        print 'Target SAR image:\n %s' % file1      
+    #  reuse the warp parameters, or the warped image itself, if the inputs are unchanged    
+        key = cache.key('registersar',os.path.abspath(file0),os.path.abspath(file1),list(dims),subpixel,levels)
+        stamp = cache.key(cache.stamp(file0),cache.stamp(file1))
+        params = None
+        entry = cache.load(key)
+        if entry is not None and str(entry['stamp']) == stamp:
+            params = (float(entry['scale']),float(entry['angle']),list(entry['shift']))
+            if str(entry['outfile']) == os.path.abspath(outfile) and os.path.exists(outfile) \
+                              and os.path.getmtime(outfile) == float(entry['outmtime']):
+                print 'Warped image is up to date:\n %s' % outfile
+                return outfile
+            print 'reusing warp parameters'    
     #  target                   
         inDataset1 = gdal.Open(file1, GA_ReadOnly)   
         cols1 = inDataset1.RasterXSize
         rows1 = inDataset1.RasterYSize  
         bands1 = inDataset1.RasterCount
-        print 'Target SAR image:\n %s' % file1      
         if  bands != bands1:
             print 'Number of bands must be equal'
             return 0
     #  create the output file 
         driver = inDataset1.GetDriver() 
+        if driver.ShortName == 'VRT':
+            driver = gdal.GetDriverByName('GTiff')
         outDataset = driver.Create(outfile,cols,rows,bands,GDT_Float32)
         projection0 = inDataset0.GetProjection()
         geotransform0 = inDataset0.GetGeoTransform()
@@ -120,19 +171,8 @@ def registersar(file0, file1, dims=None, outfile=None):
             rasterBand = inDataset1.GetRasterBand(9)
             span1 += rasterBand.ReadAsArray(x1, y1, cols, rows)  
             span1 = np.log(np.nan_to_num(span1)+0.001)                           
-            scale, angle, shift = auxil.similarity(span0, span1)   
-    #      warp the target to the reference and clip
-            for k in range(9): 
-                rasterBand = inDataset1.GetRasterBand(k+1)
-                band = rasterBand.ReadAsArray(0, 0, cols1, rows1).astype(np.float32)
-                bn1 = np.nan_to_num(band)                  
-                bn2 = ndii.zoom(bn1, 1.0 / scale)
-                bn2 = ndii.rotate(bn2, angle)
-                bn2 = ndii.shift(bn2, shift)
-                bn = bn2[y1:y1+rows,x1:x1+cols] 
-                outBand = outDataset.GetRasterBand(k+1)
-                outBand.WriteArray(bn)
-                outBand.FlushCache()
+            if params is None:
+                params = auxil.similarity(span0, span1, levels, subpixel)   
         elif bands == 4:
     #      get warp parameters using span images         
             print 'warping 4 bands (dual pol)...' 
@@ -142,19 +182,8 @@ def registersar(file0, file1, dims=None, outfile=None):
             rasterBand = inDataset1.GetRasterBand(4)
             span1 += rasterBand.ReadAsArray(x1, y1, cols, rows)
             span1 = np.log(np.nan_to_num(span1)+0.001)                           
-            scale, angle, shift = auxil.similarity(span0, span1)   
-    #      warp the target to the reference and clip
-            for k in range(4): 
-                rasterBand = inDataset1.GetRasterBand(k+1)
-                band = rasterBand.ReadAsArray(0, 0, cols1, rows1).astype(np.float32)
-                bn1 = np.nan_to_num(band)                  
-                bn2 = ndii.zoom(bn1, 1.0 / scale)
-                bn2 = ndii.rotate(bn2, angle)
-                bn2 = ndii.shift(bn2, shift)
-                bn = bn2[y1:y1+rows,x1:x1+cols] 
-                outBand = outDataset.GetRasterBand(k+1)
-                outBand.WriteArray(bn)
-                outBand.FlushCache()           
+            if params is None:
+                params = auxil.similarity(span0, span1, levels, subpixel)   
         elif bands ==3:
     #      get warp parameters using span images         
             print 'warping 3 bands (quad pol diagonal)...' 
@@ -168,19 +197,8 @@ def registersar(file0, file1, dims=None, outfile=None):
             rasterBand = inDataset1.GetRasterBand(3)
             span1 += rasterBand.ReadAsArray(x1, y1, cols, rows)
             span1 = np.log(np.nan_to_num(span1)+0.001)                           
-            scale, angle, shift = auxil.similarity(span0, span1)   
-    #      warp the target to the reference and clip
-            for k in range(3): 
-                rasterBand = inDataset1.GetRasterBand(k+1)
-                band = rasterBand.ReadAsArray(0, 0, cols1, rows1).astype(np.float32)
-                bn1 = np.nan_to_num(band)                  
-                bn2 = ndii.zoom(bn1, 1.0 / scale)
-                bn2 = ndii.rotate(bn2, angle)
-                bn2 = ndii.shift(bn2, shift)
-                bn = bn2[y1:y1+rows,x1:x1+cols] 
-                outBand = outDataset.GetRasterBand(k+1)
-                outBand.WriteArray(bn)
-                outBand.FlushCache()            
+            if params is None:
+                params = auxil.similarity(span0, span1, levels, subpixel)   
         elif bands == 2:
     #      get warp parameters using span images         
             print 'warping 2 bands (dual pol diagonal)...' 
@@ -190,40 +208,33 @@ def registersar(file0, file1, dims=None, outfile=None):
             rasterBand = inDataset1.GetRasterBand(2)
             span1 += rasterBand.ReadAsArray(x1, y1, cols, rows)
             span1 = np.log(np.nan_to_num(span1)+0.001)                           
-            scale, angle, shift = auxil.similarity(span0, span1)   
-    #      warp the target to the reference and clip
-            for k in range(2): 
-                rasterBand = inDataset1.GetRasterBand(k+1)
-                band = rasterBand.ReadAsArray(0, 0, cols1, rows1).astype(np.float32)
-                bn1 = np.nan_to_num(band)                  
-                bn2 = ndii.zoom(bn1, 1.0 / scale)
-                bn2 = ndii.rotate(bn2, angle)
-                bn2 = ndii.shift(bn2, shift)
-                bn = bn2[y1:y1+rows,x1:x1+cols] 
-                outBand = outDataset.GetRasterBand(k+1)
-                outBand.WriteArray(bn)
-                outBand.FlushCache()            
+            if params is None:
+                params = auxil.similarity(span0, span1, levels, subpixel)   
         elif bands == 1:
     #      get warp parameters using span images         
             print 'warping 1 band (single pol)...' 
             span0 = np.log(np.nan_to_num(span0)+0.001)                                   
             span1 = np.log(np.nan_to_num(span1)+0.001)                           
-            scale, angle, shift = auxil.similarity(span0, span1)   
-    #      warp the target to the reference and clip
-            for k in range(1): 
-                rasterBand = inDataset1.GetRasterBand(k+1)
-                band = rasterBand.ReadAsArray(0, 0, cols1, rows1).astype(np.float32)
-                bn1 = np.nan_to_num(band)                  
-                bn2 = ndii.zoom(bn1, 1.0 / scale)
-                bn2 = ndii.rotate(bn2, angle)
-                bn2 = ndii.shift(bn2, shift)
-                bn = bn2[y1:y1+rows,x1:x1+cols] 
-                outBand = outDataset.GetRasterBand(k+1)
-                outBand.WriteArray(bn)
-                outBand.FlushCache()           
-        inDataset0 = None
+            if params is None:
+                params = auxil.similarity(span0, span1, levels, subpixel)   
+    #  warp the target to the reference and clip, in parallel over bands
+        scale, angle, shift = params
+        A,b = auxil.warp_params((rows1,cols1),scale,angle,shift,x1,y1)
         inDataset1 = None
+        mm = NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(outfile)))
+        outimage = np.memmap(mm.name,dtype=np.float32,mode='w+',shape=(bands,rows,cols))
+        ex = Executor(backend,workers)
+        ex.map(warp_band,[(file1,k,A,b,rows,cols,mm.name,bands) for k in range(bands)])
+        ex.close()
+        for k in range(bands):
+            outBand = outDataset.GetRasterBand(k+1)
+            outBand.WriteArray(outimage[k])
+            outBand.FlushCache()
+        outimage = None
+        inDataset0 = None
         outDataset = None    
+        cache.save(key,scale=scale,angle=angle,shift=shift,stamp=stamp,
+                   outfile=os.path.abspath(outfile),outmtime=os.path.getmtime(outfile))
         print 'elapsed time: ' + str(time.time() - start)  
         return outfile
     except Exception as e:
@@ -250,6 +261,10 @@ def registervnir(file0, file1, dims=None, outfile=None, targetband=4):
             basename = os.path.basename(file1)
             root, ext = os.path.splitext(basename)
             outfile = dirn + '/' + root + '_warp' + ext  
+    #  virtual (VRT) targets cannot be written to, they are warped to GeoTIFF
+        root, ext = os.path.splitext(outfile)
+        if ext.lower() == '.vrt':
+            outfile = root + '.tif'
         start = time.time()   
         gdal.AllRegister()
     #  reference    
@@ -269,6 +284,8 @@ def registervnir(file0, file1, dims=None, outfile=None, targetband=4):
         print 'Target VNIR image:\n %s' % file1  
     #  create the output file 
         driver = inDataset1.GetDriver() 
+        if driver.ShortName == 'VRT':
+            driver = gdal.GetDriverByName('GTiff')
         outDataset = driver.Create(outfile,cols,rows,bands1,GDT_Float32)
         projection0 = inDataset0.GetProjection()
         projection1 = inDataset1.GetProjection()
@@ -367,13 +384,27 @@ Options:
    -d      spatial subset list e.g. -d [0,0,500,500]
    -v      register VNIR to SAR image (default SAR to SAR)
    -b band VNIR band for warping (default 4)
+   --backend b  parallel backend for SAR bands: auto (default), ipyparallel, 
+                multiprocessing or sequential
+   --workers w  number of engines or worker processes (default all)
+   --subpixel   estimate the SAR warp to sub-pixel accuracy (default: integer shifts, which
+                leave the speckle of well aligned images untouched)
+   --levels n   estimate scale and angle of the SAR warp on spans decimated by 2**n, and
+                the shift on a central full resolution window (default 0: full resolution)
+
+SAR warp parameters are cached (see auxil/cache.py) together with the warped image,
+which is not recomputed while the reference and target files are unchanged.
    
 --------------------------------------------'''%sys.argv[0]
 
-    options,args = getopt.getopt(sys.argv[1:],'hvb:d:')
+    options,args = getopt.getopt(sys.argv[1:],'hvb:d:',['backend=','workers=','subpixel','levels='])
     dims = None
     sar = True
     targetband = 4
+    backend = 'auto'
+    workers = None
+    subpixel = False
+    levels = 0
     for option, value in options: 
         if option == '-h':
             print usage
@@ -382,8 +413,16 @@ Options:
             dims = eval(value)  
         elif option == '-v':
             sar = False      
-        elif oprion == '-b':
+        elif option == '-b':
             targetband = eval(value)            
+        elif option == '--backend':
+            backend = value
+        elif option == '--workers':
+            workers = eval(value)
+        elif option == '--subpixel':
+            subpixel = True
+        elif option == '--levels':
+            levels = eval(value)
     if len(args) != 2:
         print 'Incorrect number of arguments'
         print usage
@@ -391,7 +430,7 @@ Options:
     fn0 = args[0]
     fn1 = args[1]
     if sar:
-        outfile = registersar(fn0,fn1,dims=dims)
+        outfile = registersar(fn0,fn1,dims=dims,backend=backend,workers=workers,subpixel=subpixel,levels=levels)
     else:
         outfile = registervnir(fn0,fn1,dims=dims,targetband=targetband)    
     print 'Warped image written to: %s' % outfile  
@@ -32,174 +32,122 @@
 # SOFTWARE.
 
 import numpy as np
-from scipy import stats, ndimage
-import os, sys, time, getopt, gdal
+from scipy import ndimage
+import os, sys, time, getopt, gdal, shutil, atexit
+import auxil.polsar as polsar
+import auxil.geotiff as geotiff
+import auxil.bmaps as bmaps
+import auxil.vrt as vrt
 from subset import subset
-from ipyparallel import Client
-from osgeo.gdalconst import GA_ReadOnly, GDT_Byte
-from tempfile import NamedTemporaryFile
+from auxil.executor import Executor
+from osgeo.gdalconst import GA_ReadOnly, GDT_Byte, GDT_UInt16, GDT_Float32, GDT_Float64
+from tempfile import NamedTemporaryFile, mkdtemp
+
+#  scale of the uint16 p-value codes, p down to 1e-16 is resolved
+PVSCALE = 4000.0
+
+#  metadata items of a p-value file: number of images, input files, 
+#  equivalent number of looks, median filter YES/NO and encoding P 
+#  (p-values) or CODE (uint16 codes -PVSCALE*log10(p))
+PVIMAGES = 'PV_IMAGES'
+PVFILES = 'PV_FILES'
+PVENL = 'PV_ENL'
+PVMEDIANFILTER = 'PV_MEDIANFILTER'
+PVENCODING = 'PV_ENCODING'
 
 def call_register((fn0,fni,dims)):
     from register import registersar
     return registersar(fn0,fni,dims)
 
-def call_median_filter(pv):
-    return ndimage.filters.median_filter(pv, size = (3,3))
- 
-def PV((fns,n,cols,rows,bands)):
-    '''Return p-values for change indices R^ell_j'''    
-    
-    def getmat(fn,cols,rows,bands):
-    #  read 9- 4- 3- 2- or 1-band preprocessed polarimetric matrix files 
-    #  and return (complex) matrix elements
-        try:
-            inDataset1 = gdal.Open(fn,GA_ReadOnly)     
-            if bands == 9:
-        #      T11 (k1)
-                b = inDataset1.GetRasterBand(1)
-                k1 = b.ReadAsArray(0,0,cols,rows)
-        #      T12  (a1)
-                b = inDataset1.GetRasterBand(2)
-                a1 = b.ReadAsArray(0,0,cols,rows)
-                b = inDataset1.GetRasterBand(3)    
-                im = b.ReadAsArray(0,0,cols,rows)
-                a1 = (a1 + 1j*im)
-        #      T13  (rho1)
-                b = inDataset1.GetRasterBand(4)
-                rho1 = b.ReadAsArray(0,0,cols,rows)
-                b = inDataset1.GetRasterBand(5)
-                im = b.ReadAsArray(0,0,cols,rows)
-                rho1 = (rho1 + 1j*im)      
-        #      T22 (xsi1)
-                b = inDataset1.GetRasterBand(6)
-                xsi1 = b.ReadAsArray(0,0,cols,rows)    
-        #      T23 (b1)        
-                b = inDataset1.GetRasterBand(7)
-                b1 = b.ReadAsArray(0,0,cols,rows)
-                b = inDataset1.GetRasterBand(8)
-                im = b.ReadAsArray(0,0,cols,rows)
-                b1 = (b1 + 1j*im)      
-        #      T33 (zeta1)
-                b = inDataset1.GetRasterBand(9)
-                zeta1 = b.ReadAsArray(0,0,cols,rows) 
-                result = (k1,a1,rho1,xsi1,b1,zeta1)             
-            elif bands == 4:
-        #      C11 (k1)
-                b = inDataset1.GetRasterBand(1)
-                k1 = b.ReadAsArray(0,0,cols,rows)
-        #      C12  (a1)
-                b = inDataset1.GetRasterBand(2)
-                a1 = b.ReadAsArray(0,0,cols,rows)
-                b = inDataset1.GetRasterBand(3)
-                im = b.ReadAsArray(0,0,cols,rows)
-                a1 = (a1 + 1j*im)        
-        #      C22 (xsi1)
-                b = inDataset1.GetRasterBand(4)
-                xsi1 = b.ReadAsArray(0,0,cols,rows)   
-                result = (k1,a1,xsi1)
-            elif bands == 3:
-        #      T11 (k1)
-                b = inDataset1.GetRasterBand(1)
-                k1 = b.ReadAsArray(0,0,cols,rows)
-        #      T22 (xsi1)
-                b = inDataset1.GetRasterBand(2)
-                xsi1 = b.ReadAsArray(0,0,cols,rows)    
-        #      T33 (zeta1)
-                b = inDataset1.GetRasterBand(3)
-                zeta1 = b.ReadAsArray(0,0,cols,rows) 
-                result = (k1,xsi1,zeta1)          
-            elif bands == 2:
-        #      C11 (k1)
-                b = inDataset1.GetRasterBand(1)
-                k1 = b.ReadAsArray(0,0,cols,rows)    
-        #      C22 (xsi1)
-                b = inDataset1.GetRasterBand(2)
-                xsi1 = b.ReadAsArray(0,0,cols,rows)  
-                result = (k1,xsi1)         
-            elif bands == 1:        
-        #      C11 (k1)
-                b = inDataset1.GetRasterBand(1)
-                k1 = b.ReadAsArray(0,0,cols,rows) 
-                result = (k1,)
-            inDataset1 = None
-            return result
-        except Exception as e:
-            print 'Error: %s  -- Could not read file'%e
-            sys.exit(1)   
-    
-    j = np.float64(len(fns))
-    eps = sys.float_info.min
-    k = 0.0; a = 0.0; rho = 0.0; xsi = 0.0; b = 0.0; zeta = 0.0
-    for fn in fns:
-        result = getmat(fn,cols,rows,bands)
-        if bands==9:
-            k1,a1,rho1,xsi1,b1,zeta1 = result
-            k1 = n*np.float64(k1)
-            a1 = n*np.complex128(a1)
-            rho1 = n*np.complex128(rho1)
-            xsi1 = n*np.float64(xsi1)
-            b1 = n*np.complex128(b1)
-            zeta1 = n*np.float64(zeta1)
-            k += k1; a += a1; rho += rho1; xsi += xsi1; b += b1; zeta += zeta1  
-        elif bands==4:
-            k1,a1,xsi1 = result
-            k1 = n*np.float64(k1)
-            a1 = n*np.complex128(a1)
-            xsi1 = n*np.float64(xsi1)
-            k += k1; a += a1; xsi += xsi1
-        elif bands==3:
-            k1,xsi1,zeta1 = result
-            k1 = n*np.float64(k1)
-            xsi1 = n*np.float64(xsi1)
-            zeta1 = n*np.float64(zeta1)
-            k += k1; xsi += xsi1; zeta += zeta1  
-        elif bands==2:
-            k1,xsi1 = result
-            k1 = n*np.float64(k1)
-            xsi1 = n*np.float64(xsi1)
-            k += k1; xsi += xsi1
-        elif bands==1:
-            k1 = n*np.float64(result[0])
-            k += k1              
-    if bands==9: 
-        p = 3
-        detsumj = k*xsi*zeta + 2*np.real(a*b*np.conj(rho)) - xsi*(abs(rho)**2) - k*(abs(b)**2) - zeta*(abs(a)**2) 
-        k -= k1; a -= a1; rho -= rho1; xsi -= xsi1; b -= b1; zeta -= zeta1 
-        detsumj1 = k*xsi*zeta + 2*np.real(a*b*np.conj(rho)) - xsi*(abs(rho)**2) - k*(abs(b)**2) - zeta*(abs(a)**2)
-        detj = k1*xsi1*zeta1 + 2*np.real(a1*b1*np.conj(rho1)) - xsi1*(abs(rho1)**2) - k1*(abs(b1)**2) - zeta1*(abs(a1)**2)
-    elif bands==4:
-        p = 2
-        detsumj = k*xsi - abs(a)**2 
-        k -= k1; a -= a1; xsi -= xsi1
-        detsumj1 = k*xsi - abs(a)**2
-        detj = k1*xsi1 - abs(a1)**2
-    elif bands==3:
+def getmat(fn,x0,y0,cols,rows,bands):
+#  read 9- 4- 3- 2- or 1-band preprocessed polarimetric matrix files 
+#  and return (complex) matrix elements
+    try:
+        inDataset1 = gdal.Open(fn,GA_ReadOnly)     
+        if bands == 9:
+    #      T11 (k1)
+            b = inDataset1.GetRasterBand(1)
+            k1 = b.ReadAsArray(x0,y0,cols,rows)
+    #      T12  (a1)
+            b = inDataset1.GetRasterBand(2)
+            a1 = b.ReadAsArray(x0,y0,cols,rows)
+            b = inDataset1.GetRasterBand(3)    
+            im = b.ReadAsArray(x0,y0,cols,rows)
+            a1 = (a1 + 1j*im)
+    #      T13  (rho1)
+            b = inDataset1.GetRasterBand(4)
+            rho1 = b.ReadAsArray(x0,y0,cols,rows)
+            b = inDataset1.GetRasterBand(5)
+            im = b.ReadAsArray(x0,y0,cols,rows)
+            rho1 = (rho1 + 1j*im)      
+    #      T22 (xsi1)
+            b = inDataset1.GetRasterBand(6)
+            xsi1 = b.ReadAsArray(x0,y0,cols,rows)    
+    #      T23 (b1)        
+            b = inDataset1.GetRasterBand(7)
+            b1 = b.ReadAsArray(x0,y0,cols,rows)
+            b = inDataset1.GetRasterBand(8)
+            im = b.ReadAsArray(x0,y0,cols,rows)
+            b1 = (b1 + 1j*im)      
+    #      T33 (zeta1)
+            b = inDataset1.GetRasterBand(9)
+            zeta1 = b.ReadAsArray(x0,y0,cols,rows) 
+            result = (k1,a1,rho1,xsi1,b1,zeta1)             
+        elif bands == 4:
+    #      C11 (k1)
+            b = inDataset1.GetRasterBand(1)
+            k1 = b.ReadAsArray(x0,y0,cols,rows)
+    #      C12  (a1)
+            b = inDataset1.GetRasterBand(2)
+            a1 = b.ReadAsArray(x0,y0,cols,rows)
+            b = inDataset1.GetRasterBand(3)
+            im = b.ReadAsArray(x0,y0,cols,rows)
+            a1 = (a1 + 1j*im)        
+    #      C22 (xsi1)
+            b = inDataset1.GetRasterBand(4)
+            xsi1 = b.ReadAsArray(x0,y0,cols,rows)   
+            result = (k1,a1,xsi1)
+        elif bands == 3:
+    #      T11 (k1)
+            b = inDataset1.GetRasterBand(1)
+            k1 = b.ReadAsArray(x0,y0,cols,rows)
+    #      T22 (xsi1)
+            b = inDataset1.GetRasterBand(2)
+            xsi1 = b.ReadAsArray(x0,y0,cols,rows)    
+    #      T33 (zeta1)
+            b = inDataset1.GetRasterBand(3)
+            zeta1 = b.ReadAsArray(x0,y0,cols,rows) 
+            result = (k1,xsi1,zeta1)          
+        elif bands == 2:
+    #      C11 (k1)
+            b = inDataset1.GetRasterBand(1)
+            k1 = b.ReadAsArray(x0,y0,cols,rows)    
+    #      C22 (xsi1)
+            b = inDataset1.GetRasterBand(2)
+            xsi1 = b.ReadAsArray(x0,y0,cols,rows)  
+            result = (k1,xsi1)         
+        elif bands == 1:        
+    #      C11 (k1)
+            b = inDataset1.GetRasterBand(1)
+            k1 = b.ReadAsArray(x0,y0,cols,rows) 
+            result = (k1,)
+        inDataset1 = None
+        return result
+    except Exception as e:
+        print 'Error: %s  -- Could not read file'%e
+        sys.exit(1)   
+
+def pvalues(j,n,bands,logdetsumj,logdetsumj1,logdetj,levels=None):
+    '''Return p-values for change index R^ell_j from the log-determinants
+       of the sums over images ell..j and ell..j-1 and of image j, or if a
+       list of significance levels is given the change masks p-value <= 
+       level, one row for each level'''
+    if (bands==9) or (bands==3):
         p = 3
-        detsumj = k*xsi*zeta 
-        k -= k1; xsi -= xsi1;  zeta -= zeta1 
-        detsumj1 = k*xsi*zeta 
-        detj = k1*xsi1*zeta1
-    elif bands==2:
+    elif (bands==4) or (bands==2):
         p = 2
-        detsumj = k*xsi
-        k -= k1; xsi -= xsi1
-        detsumj1 = k*xsi
-        detj = k1*xsi1
-    elif bands==1:
+    else:
         p = 1
-        detsumj = k  
-        k -= k1
-        detsumj1 = k
-        detj = k1    
-    detsumj = np.nan_to_num(detsumj)    
-    detsumj = np.where(detsumj <= eps,eps,detsumj)
-    logdetsumj = np.log(detsumj)
-    detsumj1 = np.nan_to_num(detsumj1)
-    detsumj1 = np.where(detsumj1 <= eps,eps,detsumj1)
-    logdetsumj1 = np.log(detsumj1)
-    detj = np.nan_to_num(detj)
-    detj = np.where(detj <= eps,eps,detj)
-    logdetj = np.log(detj)
 #  test statistic
     lnRj = n*( p*( j*np.log(j)-(j-1)*np.log(j-1.) ) + (j-1)*logdetsumj1 + logdetj - j*logdetsumj )  
     if (bands==9) or (bands==4) or (bands==1):
@@ -213,29 +161,370 @@ def PV((fns,n,cols,rows,bands)):
     omega2j = -(f/4.)*(1.-1./rhoj)**2 + (1./(24.*n*n))*p*p*(p*p-1)*(1+(2.*j-1)/(j*(j-1))**2)/rhoj**2     
 #  return p-values  
     Z = -2*rhoj*lnRj
-    return 1.0 - ((1.-omega2j)*stats.chi2.cdf(Z,[f])+omega2j*stats.chi2.cdf(Z,[f+4]))
+    if levels is not None:
+#      the p-value decreases with Z, so only the critical values are needed    
+        zc = [polsar.critical_value(f,omega2j,significance) for significance in levels]
+        return np.less_equal.outer(zc,Z)
+    return polsar.chi2mix(Z,f,omega2j)
 
-def change_maps(pvarray,significance):
-    k = pvarray.shape[0]+1
-    n = pvarray.shape[2]
+class PVStream(object):
+    '''Running sums of the Wishart matrix elements for every ell segment.
+       Images are added one at a time and each call returns the p-values 
+       of the new column of change indices R^ell_j, one for each segment
+       in self.starts (ell = 1...j-1 unless segments have been pruned),
+       or their change masks if a list of significance levels is given'''
+    def __init__(self,n,bands,dtype=np.float64,levels=None):
+        self.n = n
+        self.bands = bands
+        self.dtype = dtype
+        self.levels = levels
+#      number of images added        
+        self.count = 0
+#      first image of each segment, its summed matrix elements and their log-determinants        
+        self.starts = []
+        self.sums = []
+        self.logdets = []
+        
+    def add(self,mat):
+        n = self.n
+        bands = self.bands
+        mat = polsar.scaled(mat,n,self.dtype)
+        logdetj = polsar.logdet(mat,bands)
+        logdetsumj = np.empty_like(logdetj)
+        pvs = []
+        for ell in range(len(self.sums)):
+            s = self.sums[ell]
+            for i in range(len(s)):
+                s[i] += mat[i]
+            polsar.logdet(s,bands,out=logdetsumj)    
+            j = np.float64(self.count - self.starts[ell] + 1)
+            pvs.append(pvalues(j,n,bands,logdetsumj,self.logdets[ell],logdetj,self.levels))
+#          recycle the previous log-determinant as the next output buffer            
+            self.logdets[ell],logdetsumj = logdetsumj,self.logdets[ell]
+        self.starts.append(self.count)
+        self.sums.append(list(mat))
+        self.logdets.append(logdetj)
+        self.count += 1
+        return pvs        
+        
+    def prune(self,keep):
+        '''Drop the segments whose first image is not in keep'''
+        idx = [ell for ell in range(len(self.starts)) if self.starts[ell] in keep]
+        self.starts = [self.starts[ell] for ell in idx]
+        self.sums = [self.sums[ell] for ell in idx]
+        self.logdets = [self.logdets[ell] for ell in idx]
+ 
+def encode_pv(pv):
+    '''Quantize p-values to uint16 significance codes -PVSCALE*log10(p)'''
+    with np.errstate(divide='ignore',invalid='ignore'):
+        code = -PVSCALE*np.log10(pv)
+    code = np.where(code == code,code,0.0)    
+    return np.uint16(np.round(np.clip(code,0,65535)))
+
+def decode_pv(code):
+    '''Return the p-values for uint16 significance codes'''
+    return 10.0**(-np.float64(code)/PVSCALE)    
+
+def pv_stream(fns,n,x0,y0,cols,rows,bands,pvarray,medianfilter=False,inner=None,verbose=True,levels=None):
+    '''Read each image exactly once and store p-values for all change 
+       indices R^ell_j in pvarray[ell,j,:]. If inner = (dx,dy,w,h) is given, 
+       only that part of the (median filtered) window is stored. A 4-d
+       pvarray holds the bit-packed change masks pvarray[level,ell,j,:] 
+       for the significance levels'''
+    if pvarray.ndim != 4:
+        levels = None
+    for i,pvs in enumerate(pv_columns(fns,n,x0,y0,cols,rows,bands,medianfilter,inner,verbose,levels)):
+        for ell in range(len(pvs)):
+            if pvarray.ndim == 4:
+                pvarray[:,ell,i,:] = np.packbits(pvs[ell],axis=1)
+            elif pvarray.dtype == np.uint16:
+                pvarray[ell,i,:] = encode_pv(pvs[ell])
+            else:    
+                pvarray[ell,i,:] = pvs[ell]
+                
+def pv_memmap(pvfn,pvtype,k,n,mode='r+',nlevels=1):
+    '''Return the memory-mapped p-value array for k images of n pixels,
+       for pvtype 'bit' the change masks for nlevels significance levels, 
+       packed 8 pixels per byte'''
+    if pvtype == 'bit':
+        return np.memmap(pvfn,dtype=np.uint8,mode=mode,shape=(nlevels,k-1,k-1,(n+7)//8))
+    return np.memmap(pvfn,dtype=np.dtype(pvtype),mode=mode,shape=(k-1,k-1,n))
+
+def pv_strip((fns,n,bands,medianfilter,y0,h,cols,rows,pvfn,pvtype,levels)):
+    '''Store the p-values of rows y0...y0+h-1 in place in the memory-mapped
+       p-value array in file pvfn. The strip is read with a halo of 1 row 
+       for the median filter. Packed strips must start at a multiple of
+       8 pixels'''
+    k = len(fns)
+    pvarray = pv_memmap(pvfn,pvtype,k,rows*cols,nlevels=len(levels))
+    if medianfilter:
+        ya = max(y0-1,0)
+        yb = min(y0+h+1,rows)
+    else:
+        ya,yb = y0,y0+h
+    if pvtype == 'bit':
+        strip = pvarray[...,y0*cols//8:((y0+h)*cols+7)//8]
+    else:
+        strip = pvarray[...,y0*cols:(y0+h)*cols]
+    pv_stream(fns,n,0,ya,cols,yb-ya,bands,strip,medianfilter,(0,y0-ya,cols,h),False,levels)
+    pvarray.flush()
+    return y0
+
+def call_pv_strip(args):
+    from sar_seq import pv_strip
+    return pv_strip(args)
+            
+def pv_columns(fns,n,x0,y0,cols,rows,bands,medianfilter=False,inner=None,verbose=True,levels=None):
+    '''Generate the columns [p(R^ell_j) for ell = 1...j] of p-values, 
+       j = 2...k, reading each image exactly once, or of change masks 
+       if a list of significance levels is given'''
+    stream = PVStream(n,bands,levels=levels)
+    if verbose:
+        print 'image = ',
+        sys.stdout.flush()  
+    for i in range(len(fns)):
+        if verbose:
+            print i+1,
+            sys.stdout.flush() 
+        pvs = filter_pvs(stream.add(getmat(fns[i],x0,y0,cols,rows,bands)),cols,rows,medianfilter,inner)
+        if i > 0:    
+            yield pvs
+
+def filter_pvs(pvs,cols,rows,medianfilter=False,inner=None):
+    '''Median filter (optionally) the p-value images in the list pvs
+       and crop them to inner = (dx,dy,w,h). The median filtered change
+       masks are the masks of the median filtered p-values'''
+    if inner is None:
+        inner = (0,0,cols,rows)
+    dx,dy,w,h = inner    
+    for ell in range(len(pvs)):
+#      p-values or one change mask per significance level        
+        shape = np.shape(pvs[ell])[:1] if np.ndim(pvs[ell]) == 3 else ()
+        pv = np.reshape(pvs[ell],shape+(rows,cols))
+        if medianfilter:
+            pv = ndimage.filters.median_filter(pv, size = (1,)*len(shape)+(3,3))
+        pvs[ell] = np.reshape(pv[...,dy:dy+h,dx:dx+w],shape+(-1,))
+    return pvs
+            
+def change_maps_tile((fns,n,bands,levels,medianfilter,x0,y0,w,h,cols,rows)):
+    '''Return the change maps at each of the significance levels for the 
+       block (x0,y0,w,h) of a cols x rows image'''
+#  read a halo around the block for the median filter
+    halo = 1 if medianfilter else 0
+    xa = max(x0-halo,0)
+    ya = max(y0-halo,0)
+    xb = min(x0+w+halo,cols)
+    yb = min(y0+h+halo,rows)
+    k = len(fns)
+    maps = [init_maps(w*h,k) for level in levels]
+    pvs = pv_columns(fns,n,xa,ya,xb-xa,yb-ya,bands,medianfilter,inner=(x0-xa,y0-ya,w,h),verbose=False,
+                                                                                     levels=levels)
+    idx = np.arange(w*h)
+    for j,pvj in enumerate(pvs):
+        pvj = np.array(pvj)
+        for i,significance in enumerate(levels):
+#          thresholding only needs the test for the current segment of each pixel        
+            update_maps(maps[i],pvj[:,i,:][maps[i][0],idx],j,significance)
+    return (x0,y0,w,h,maps)
+
+def call_change_maps_tile(args):
+    from sar_seq import change_maps_tile
+    return change_maps_tile(args)
+    
+def init_maps(n,k):
+    '''Return empty cmap, smap, fmap and bmap for n pixels, k images'''
 #  map of most recent change occurrences
     cmap = np.zeros(n,dtype=np.byte)    
 #  map of first change occurrence
     smap = np.zeros(n,dtype=np.byte)
 #  change frequency map 
     fmap = np.zeros(n,dtype=np.byte)
-#  bitemporal change maps
-    bmap = np.zeros((n,k-1),dtype=np.byte)  
-    for ell in range(k-1):
-        for j in range(ell,k-1):
-            pv = pvarray[ell,j,:]
-            idx = np.where( (pv <= significance) & (cmap == ell) )
-            fmap[idx] += 1 
-            cmap[idx] = j+1 
-            bmap[idx,j] = 255 
-            if ell==0:
-                smap[idx] = j+1             
+#  bitemporal change maps, one bit per interval
+    bmap = bmaps.zeros(n,k-1)  
     return (cmap,smap,fmap,bmap)
+
+def update_maps(maps,pv,j,significance):
+    '''Advance the change maps over interval j, pv[i] is the p-value (or 
+       change mask) of the test R^ell_j for the segment ell = cmap[i] at 
+       which pixel i stands'''
+    cmap,smap,fmap,bmap = maps
+    if pv.dtype == np.bool:
+        idx = np.where(pv)
+    elif pv.dtype == np.uint16:
+        idx = np.where(pv >= encode_pv(significance))
+    else:
+        idx = np.where(pv <= significance)
+    first = idx[0][cmap[idx] == 0]     
+    fmap[idx] += 1 
+    cmap[idx] = j+1 
+    bmaps.setbit(bmap,idx,j) 
+    smap[first] = j+1 
+
+def change_maps(pvarray,significance,n=None):
+    '''Walk the (ell,j) triangle of p-values as a per-pixel state machine
+       over the time axis and return cmap, smap, fmap and bmap. A uint8 
+       pvarray holds packed change masks for n pixels'''
+    k = pvarray.shape[0]+1
+    if pvarray.dtype != np.uint8:
+        n = pvarray.shape[2]
+    maps = init_maps(n,k)
+    idx = np.arange(n)
+    for j in range(k-1):
+        pvj = pvarray[:j+1,j,:]
+        if pvarray.dtype == np.uint8:
+            pvj = np.unpackbits(pvj,axis=1)[:,:n].astype(np.bool)
+        update_maps(maps,pvj[maps[0],idx],j,significance)
+    return maps
+
+def pv_band(ell,j):
+    '''Band of a p-value file holding pvarray[ell,j,:], ell <= j'''
+    return j*(j+1)//2+ell+1
+
+def save_pvarray(pvfn,pvarray,cols,rows,inDataset1,infns,n,medianfilter):
+    '''Write the p-values pvarray[ell,j,:], ell <= j, to the tiled, compressed
+       GeoTIFF pvfn, one band per test, with the processing parameters as metadata'''
+    k = pvarray.shape[0]+1
+    dtype = {np.dtype(np.float64):GDT_Float64,np.dtype(np.float32):GDT_Float32,
+             np.dtype(np.uint16):GDT_UInt16}[pvarray.dtype]
+    outDataset = geotiff.create(pvfn,cols,rows,k*(k-1)//2,dtype,inDataset1,interleave='BAND')
+    outDataset.SetMetadataItem(PVIMAGES,str(k))
+    outDataset.SetMetadataItem(PVFILES,','.join(infns))
+    outDataset.SetMetadataItem(PVENL,repr(float(n)))
+    outDataset.SetMetadataItem(PVMEDIANFILTER,'YES' if medianfilter else 'NO')
+    outDataset.SetMetadataItem(PVENCODING,'CODE' if pvarray.dtype == np.uint16 else 'P')
+    for y0 in range(0,rows,geotiff.BLOCKSIZE):
+        h = min(geotiff.BLOCKSIZE,rows-y0)
+        for j in range(k-1):
+            for ell in range(j+1):
+                pv = np.reshape(pvarray[ell,j,y0*cols:(y0+h)*cols],(h,cols))
+                outDataset.GetRasterBand(pv_band(ell,j)).WriteArray(pv,0,y0)
+    outDataset.FlushCache()
+    outDataset = None
+
+def read_pvarray(inDataset,y0,h):
+    '''Return the p-value array [ell,j,:] for the rows y0...y0+h-1 of a 
+       p-value file'''
+    k = int(inDataset.GetMetadataItem(PVIMAGES))
+    cols = inDataset.RasterXSize
+    pvarray = None
+    for j in range(k-1):
+        for ell in range(j+1):
+            pv = inDataset.GetRasterBand(pv_band(ell,j)).ReadAsArray(0,y0,cols,h).ravel()
+            if pvarray is None:
+                pvarray = np.zeros((k-1,k-1,h*cols),dtype=pv.dtype)
+            pvarray[ell,j,:] = pv
+    return pvarray
+
+def save_state(statefn,infns,stream,maps,cols,rows,significance,medianfilter):
+    '''Write the running sums of the segments still in use, the change maps
+       and the processing parameters to the online state file statefn'''
+    arrays = dict(infns=np.array(infns),n=stream.n,bands=stream.bands,count=stream.count,
+                  starts=np.array(stream.starts),cols=cols,rows=rows,
+                  significance=significance,medianfilter=medianfilter)
+    for name,a in zip(['cmap','smap','fmap','bmap'],maps):
+        arrays[name] = a
+    for ell in range(len(stream.starts)):
+        arrays['logdet_%i'%ell] = stream.logdets[ell]
+        for i,x in enumerate(stream.sums[ell]):
+            arrays['sum_%i_%i'%(ell,i)] = x
+#  replace the old state only when the new one is complete            
+    tmp = statefn+'.tmp'
+    with open(tmp,'wb') as f:
+        np.savez(f,**arrays)
+    os.rename(tmp,statefn)
+
+def load_state(statefn):
+    '''Return the input file names, PVStream, change maps and parameters
+       stored in the online state file statefn'''
+    with np.load(statefn) as f:
+        stream = PVStream(np.float64(f['n']),int(f['bands']),levels=[float(f['significance'])])
+        stream.count = int(f['count'])
+        stream.starts = list(f['starts'])
+        for ell in range(len(stream.starts)):
+            stream.logdets.append(f['logdet_%i'%ell])
+            i = 0
+            s = []
+            while 'sum_%i_%i'%(ell,i) in f:
+                s.append(f['sum_%i_%i'%(ell,i)])
+                i += 1
+            stream.sums.append(s)    
+        maps = tuple([f[name] for name in ['cmap','smap','fmap','bmap']])
+        params = (int(f['cols']),int(f['rows']),float(f['significance']),bool(f['medianfilter']))
+        infns = list(f['infns'])
+    return infns,stream,maps,params    
+
+def change_maps_online(infns,fns,n,cols,rows,bands,significance,medianfilter,statefn):
+    '''Append the images fns (registered versions of infns) which are not yet 
+       recorded in the state file statefn to the sequential change detection.
+       Only the new column of p-values is calculated for each image. Returns 
+       the change maps for all images and saves the updated state'''
+    if os.path.exists(statefn):
+        done,stream,maps,params = load_state(statefn)
+        if params != (cols,rows,significance,medianfilter) or stream.n != n or stream.bands != bands:
+            raise ValueError('state file %s was made with different dimensions or parameters'%statefn)
+        if infns[:len(done)] != done:
+            raise ValueError('state file %s is for a different image sequence'%statefn)
+    else:
+        done = []
+        stream = PVStream(n,bands,levels=[significance])
+        maps = init_maps(rows*cols,1)
+    print 'images already processed: %i'%len(done)
+    print 'image = ',
+    sys.stdout.flush()    
+    idx = np.arange(rows*cols)
+    for i in range(len(done),len(fns)):
+        print i+1,
+        sys.stdout.flush() 
+        pvs = filter_pvs(stream.add(getmat(fns[i],0,0,cols,rows,bands)),cols,rows,medianfilter)
+        if i > 0:
+            cmap,smap,fmap,bmap = maps
+            maps = (cmap,smap,fmap,bmaps.grow(bmap,i))
+#          change masks of the test for the current segment of each pixel            
+            pos = np.searchsorted(stream.starts[:-1],cmap)
+            pv = np.empty(rows*cols,dtype=pvs[0].dtype)
+            for ell in range(len(pvs)):
+                sel = np.where(pos == ell)
+                pv[sel] = pvs[ell][0][sel]
+            update_maps(maps,pv,i-1,significance)
+#          segments at which no pixel stands will never be tested again            
+            stream.prune(set(np.unique(maps[0])))
+    print    
+    save_state(statefn,infns,stream,maps,cols,rows,significance,medianfilter)
+    return maps
+
+def map_outfns(outfn,levels):
+    '''Output file names for each significance level'''
+    if len(levels) == 1:
+        return [outfn]
+    root,ext = os.path.splitext(outfn)
+    return [root+'_%g'%level+ext for level in levels]
+
+def create_maps(outfn,cols,rows,k,inDataset1,packbmap=False):
+    '''Create the cmap, smap, fmap and bmap output files, the bmap
+       with one bit per interval if packbmap is set'''
+    basename = os.path.basename(outfn)
+    name, _ = os.path.splitext(basename)
+    outfns = []
+    outDatasets = []
+    for suffix,bands in [('_cmap',1),('_smap',1),('_fmap',1),('_bmap',bmaps.nbytes(k-1) if packbmap else k-1)]:
+        outfn1 = outfn.replace(name,name+suffix)
+        outDataset = geotiff.create(outfn1,cols,rows,bands,GDT_Byte,inDataset1)
+        if packbmap and suffix == '_bmap':
+            bmaps.mark(outDataset,k-1)
+        outfns.append(outfn1)
+        outDatasets.append(outDataset)
+    return (outfns,outDatasets)
+
+def write_maps(outDatasets,maps,x0,y0,cols,rows):
+    '''Write the change maps for the block (x0,y0,cols,rows)'''
+    cmap,smap,fmap,bmap = maps
+    for outDataset,amap in zip(outDatasets[:3],[cmap,smap,fmap]):
+        geotiff.write(outDataset,np.reshape(amap,(rows,cols)),x0,y0)
+    outDataset = outDatasets[3]
+    if not bmaps.is_packed(outDataset):
+        bmap = bmaps.unpack(bmap,outDataset.RasterCount)
+#  all bitemporal maps in one pixel interleaved pass    
+    geotiff.write(outDataset,np.reshape(bmap,(rows,cols,-1)),x0,y0)
                        
 def main():  
     usage = '''
@@ -252,7 +541,30 @@ Options:
   -m           run 3x3 median filter on p-values prior to thresholding (e.g. for noisy satellite data)  
   -d  dims     files are to be co-registered to a subset dims = [x0,y0,rows,cols] of the first image, otherwise
                it is assumed that the images are co-registered and have identical spatial dimensions  
-  -s  signif   significance level for change detection (default 0.01)
+  -s  signif   significance level for change detection (default 0.01), or a comma-separated list
+               of levels, e.g. 0.01,0.005,0.001, for which the change maps are made in one pass 
+               and written to outfile_<level>_cmap etc.
+  --tile size  process the images in blocks of size x size pixels and write the change maps
+               block by block, so that memory use is bounded by the block size
+  --pvtype t   storage type of the p-value array: bit (default) stores only the change masks at the
+               significance level(s), packed 8 pixels per byte, comparing the test statistics with
+               critical values instead of evaluating p-values. float64, float32 or uint16 (quantized 
+               significance code -4000*log10(p), relative resolution 0.03%%) store the full p-values
+  --backend b  parallel backend for co-registration, p-value strips and blocks: auto (default), ipyparallel,
+               multiprocessing or sequential
+  --workers w  number of engines or worker processes (default all)
+  --packbmap   write the bitemporal maps with one bit per interval (metadata BMAP_PACKED, BMAP_INTERVALS)
+               instead of one 0/255 band per interval
+  --stack b    infiles is a single co-registered time series stack with b bands per image, which is
+               split into virtual images without copying (temporary, named infile:1, ... in the 
+               p-value and state files), dims only selects a subset 
+  --state file online mode: keep the running sums and change maps in file (created if it does not exist),
+               images appended to a previously processed list are added without recalculating the 
+               earlier p-values (not with --tile) 
+  --pvfile f   keep the p-values in f, a tiled, compressed GeoTIFF with one band per test (float32
+               unless --pvtype is given) and the input files, enl and median filtering as metadata, 
+               from which sar_seq_maps.py makes change maps at any significance level without 
+               recalculation (not with --tile or --state)
 
 infiles:
 
@@ -268,10 +580,18 @@ enl:
 
 -------------------------------------------------'''%sys.argv[0]
 
-    options,args = getopt.getopt(sys.argv[1:],'hmd:s:')
+    options,args = getopt.getopt(sys.argv[1:],'hmd:s:',['tile=','pvtype=','backend=','workers=','state=','packbmap','stack=','pvfile='])
     medianfilter = False
     dims = None
     significance = 0.01
+    tile = None
+    pvtype = 'bit'
+    backend = 'auto'
+    workers = None
+    statefn = None
+    packbmap = False
+    stack = None
+    pvfn = None
     for option, value in options: 
         if option == '-h':
             print usage
@@ -282,11 +602,61 @@ enl:
             dims = eval(value)
         elif option == '-s':
             significance = eval(value) 
+        elif option == '--tile':
+            tile = eval(value)
+        elif option == '--pvtype':
+            pvtype = value
+        elif option == '--backend':
+            backend = value
+        elif option == '--workers':
+            workers = eval(value)
+        elif option == '--stack':
+            stack = eval(value)
+        elif option == '--packbmap':
+            packbmap = True
+        elif option == '--state':
+            statefn = os.path.abspath(value)
+        elif option == '--pvfile':
+            pvfn = os.path.abspath(value)
     if len(args) != 3:              
         print 'Incorrect number of arguments'
         print usage
         sys.exit(1)        
+    if statefn is not None and tile is not None:
+        print 'Error: --state cannot be combined with --tile'
+        sys.exit(1)
+    if pvfn is not None:
+        if statefn is not None or tile is not None:
+            print 'Error: --pvfile cannot be combined with --state or --tile'
+            sys.exit(1)
+        if pvtype == 'bit':
+#          the p-values themselves are needed            
+            pvtype = 'float32'    
+    if isinstance(significance,(list,tuple)):
+#      decreasing, so that change at a level implies change at the preceding ones        
+        levels = sorted(significance,reverse=True)
+    else:
+        levels = [significance]
+    if statefn is not None and len(levels) > 1:
+        print 'Error: --state takes a single significance level'
+        sys.exit(1)
     fns = args[0].split(',')    
+#  outputs go to the directory of the first input file    
+    dirn = os.path.dirname(os.path.abspath(fns[0]))
+    infns = list(fns)
+    if stack is not None or dims is not None:
+#      virtual images of the stack or reference subset are scratch files of this run  
+        tmpdir = mkdtemp(prefix='sar_seq_')
+        atexit.register(shutil.rmtree,tmpdir,True)
+    if stack is not None:
+#      virtual images of the stack, already co-registered        
+        try:
+            fns = vrt.split(fns[0],stack,outdir=tmpdir,window=dims)
+        except Exception as e:
+            print 'Error: %s  -- Could not split stack'%e
+            sys.exit(1)
+        infns = ['%s:%i'%(os.path.abspath(infns[0]),i+1) for i in range(len(fns))]
+        dims = None    
     outfn = args[1]
     n = np.float64(eval(args[2])) # equivalent number of looks
     k = len(fns)                  # number of images
@@ -304,21 +674,15 @@ enl:
     if dims is not None:
 #  images are not yet co-registered, so subset first image and register the others
         _,_,cols,rows = dims
-        fn0 = subset(fns[0],dims)
+#      the reference subset is a virtual image        
+        fn0 = subset(fns[0],dims,outfile=os.path.join(tmpdir,'reference_sub.vrt'),virtual=True)
         args1 = [(fns[0],fns[i],dims) for i in range(1,k)]
-        try:
-            print ' \nattempting parallel execution of co-registration ...' 
-            start1 = time.time()  
-            c = Client()
-            print 'available engines %s'%str(c.ids)
-            v = c[:]   
-            fns = v.map_sync(call_register,args1)
-            print 'elapsed time for co-registration: '+str(time.time()-start1) 
-        except Exception as e: 
-            start1 = time.time()
-            print '%s \nFailed, so running sequential co-registration ...'%e
-            fns = map(call_register,args1)  
-            print 'elapsed time for co-registration: '+str(time.time()-start)
+        ex = Executor(backend,workers)
+        print ' \nco-registration with backend %s ...'%ex 
+        start1 = time.time()  
+        fns = ex.map(call_register,args1)
+        ex.close()
+        print 'elapsed time for co-registration: '+str(time.time()-start1) 
         fns.insert(0,fn0)  
 #      point inDataset1 to the subset image for correct georefrerencing         
         inDataset1 = gdal.Open(fn0,GA_ReadOnly)           
@@ -329,104 +693,91 @@ enl:
     print 'First (reference) filename:  %s'%fns[0]
     print 'number of images: %i'%k
     print 'equivalent number of looks: %f'%n
-    print 'significance level: %f'%significance
+    print 'significance level: %s'%', '.join(['%f'%level for level in levels])
 #  output file
-    path = os.path.abspath(fns[0])    
-    dirn = os.path.dirname(path)
     outfn = dirn + '/' + outfn 
-#  create temporary, memory-mapped array of change indices p(Ri<ri)
-    mm = NamedTemporaryFile()
-    pvarray = np.memmap(mm.name,dtype=np.float64,mode='w+',shape=(k-1,k-1,rows*cols))  
-    print 'pre-calculating Rj and p-values ...' 
-    start1 = time.time() 
-    try:
-        print 'attempting parallel calculation ...' 
-        c = Client()
-        print 'available engines %s'%str(c.ids)
-        v = c[:]   
-        v.execute('import numpy as np')
-        v.execute('from osgeo.gdalconst import GA_ReadOnly')
-        v.execute('import sys, gdal')
-        v.execute('from scipy import stats, ndimage')
-        print 'ell = ',
+#  output files and datasets for each significance level        
+    outputs = [create_maps(fn,cols,rows,k,inDataset1,packbmap) for fn in map_outfns(outfn,levels)]
+    if statefn is not None:
+        print 'updating change maps with state file %s ...'%statefn
+        start1 = time.time()
+        try:
+            maps = change_maps_online(infns,fns,n,cols,rows,bands,significance,medianfilter,statefn)
+        except ValueError as e:
+            print 'Error: %s'%e
+            sys.exit(1)
+        print 'elapsed time for change maps: '+str(time.time()-start1)    
+        write_maps(outputs[0][1],maps,0,0,cols,rows)
+    elif tile is None:
+#      create temporary, memory-mapped array of change indices p(Ri<ri)
+        mm = NamedTemporaryFile(dir=dirn)
+        pvarray = pv_memmap(mm.name,pvtype,k,rows*cols,'w+',len(levels))
+        print 'pre-calculating Rj and p-values ...' 
+        start1 = time.time() 
+        ex = Executor(backend,workers)
+        if ex.workers == 1:
+            pv_stream(fns,n,0,0,cols,rows,bands,pvarray,medianfilter,levels=levels)
+        else:
+#          workers write row strips in place into the memory-mapped array        
+            print 'backend: %s'%ex
+            h = -(-rows//(4*ex.workers))
+            if pvtype == 'bit':
+#              strips of packed masks start on byte boundaries                
+                h = -(-h//8)*8
+            args1 = [(fns,n,bands,medianfilter,y0,min(h,rows-y0),cols,rows,mm.name,pvtype,levels) 
+                                                               for y0 in range(0,rows,h)]
+            print 'strip = ',
+            for i,_ in enumerate(ex.imap(call_pv_strip,args1)):
+                print i+1,
+                sys.stdout.flush()
+        ex.close()
+        print '\nelapsed time for p-value calculation: '+str(time.time()-start1)    
+        if pvfn is not None:
+            save_pvarray(pvfn,pvarray,cols,rows,inDataset1,infns,n,medianfilter)
+            print 'p-values written to: %s'%pvfn
+#      only thresholding is repeated for each significance level        
+        for i,significance in enumerate(levels):
+            if pvtype == 'bit':
+                maps = change_maps(pvarray[i],significance,rows*cols)
+            else:
+                maps = change_maps(pvarray,significance)
+            write_maps(outputs[i][1],maps,0,0,cols,rows)
+    else:
+#      change maps block by block    
+        args1 = [(fns,n,bands,levels,medianfilter,x0,y0,min(tile,cols-x0),min(tile,rows-y0),cols,rows) 
+                                for y0 in range(0,rows,tile) for x0 in range(0,cols,tile)]
+        print 'calculating change maps in %i blocks of %i x %i pixels ...'%(len(args1),tile,tile)
+        start1 = time.time()
+        ex = Executor(backend,workers)
+        print 'backend: %s'%ex
+        results = ex.imap(call_change_maps_tile,args1)
+        print 'block = ',
         sys.stdout.flush()      
-        for i in range(k-1):  
-            print i+1,  
-            sys.stdout.flush()              
-            args1 = [(fns[i:j+2],n,cols,rows,bands) for j in range(i,k-1)]         
-            pvs = v.map_sync(PV,args1) 
-            if medianfilter:
-                pvs = v.map_sync(call_median_filter,pvs)           
-            for j in range(i,k-1):
-                pvarray[i,j,:] = pvs[j-i].ravel() 
-    except Exception as e: 
-        print '%s \nfailed, so running sequential calculation ...'%e  
-        print 'ell= ',
-        sys.stdout.flush()  
-        for i in range(k-1):        
-            print i+1,   
-            sys.stdout.flush()             
-            args1 = [(fns[i:j+2],n,cols,rows,bands) for j in range(i,k-1)]                         
-            pvs = map(PV,args1)            
-            if medianfilter:
-                pvs = map(call_median_filter,pvs)
-            for j in range(i,k-1):
-                pvarray[i,j,:] = pvs[j-i].ravel() 
-    print '\nelapsed time for p-value calculation: '+str(time.time()-start1)    
-    cmap,smap,fmap,bmap = change_maps(pvarray,significance)
-#  write to file system    
-    cmap = np.reshape(cmap,(rows,cols))
-    fmap = np.reshape(fmap,(rows,cols))
-    smap = np.reshape(smap,(rows,cols))
-    bmap = np.reshape(bmap,(rows,cols,k-1))
-    driver = inDataset1.GetDriver() 
-    basename = os.path.basename(outfn)
-    name, _ = os.path.splitext(basename)
-    outfn1=outfn.replace(name,name+'_cmap')
-    outDataset = driver.Create(outfn1,cols,rows,1,GDT_Byte)
-    geotransform = inDataset1.GetGeoTransform()
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)
-    projection = inDataset1.GetProjection()        
-    if projection is not None:
-        outDataset.SetProjection(projection)     
-    outBand = outDataset.GetRasterBand(1)
-    outBand.WriteArray(cmap,0,0) 
-    outBand.FlushCache() 
-    print 'most recent change map written to: %s'%outfn1  
-    outfn2=outfn.replace(name,name+'_fmap')
-    outDataset = driver.Create(outfn2,cols,rows,1,GDT_Byte)
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)      
-    if projection is not None:
-        outDataset.SetProjection(projection)     
-    outBand = outDataset.GetRasterBand(1)
-    outBand.WriteArray(fmap,0,0) 
-    outBand.FlushCache() 
-    print 'frequency map written to: %s'%outfn2     
-    outfn3=outfn.replace(name,name+'_bmap')
-    outDataset = driver.Create(outfn3,cols,rows,k-1,GDT_Byte)
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)       
-    if projection is not None:
-        outDataset.SetProjection(projection)  
-    for i in range(k-1):        
-        outBand = outDataset.GetRasterBand(i+1)
-        outBand.WriteArray(bmap[:,:,i],0,0) 
-        outBand.FlushCache() 
-    print 'bitemporal map image written to: %s'%outfn3    
-    outfn4=outfn.replace(name,name+'_smap')
-    outDataset = driver.Create(outfn4,cols,rows,1,GDT_Byte)
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)      
-    if projection is not None:
-        outDataset.SetProjection(projection)     
-    outBand = outDataset.GetRasterBand(1)
-    outBand.WriteArray(smap,0,0) 
-    outBand.FlushCache() 
-    print 'first change map written to: %s'%outfn4         
+        i = 0
+        for result in results:
+            i += 1
+            print i,
+            sys.stdout.flush()
+            x0,y0,w,h,maps = result
+            for l in range(len(levels)):
+                write_maps(outputs[l][1],maps[l],x0,y0,w,h)
+        ex.close()
+        print '\nelapsed time for change maps: '+str(time.time()-start1)           
+    for outfns,outDatasets in outputs:
+        for outDataset in outDatasets:
+            geotiff.close(outDataset)
+    allfns = [outfns for outfns,_ in outputs]
+    outputs = None    
+    outDatasets = None    
+    outDataset = None
+    for outfns in allfns:
+        for fn in outfns:
+            geotiff.finish(fn)
+        print 'most recent change map written to: %s'%outfns[0]  
+        print 'first change map written to: %s'%outfns[1]         
+        print 'frequency map written to: %s'%outfns[2]     
+        print 'bitemporal map image written to: %s'%outfns[3]    
     print 'total elapsed time: '+str(time.time()-start)   
-    outDataset = None    
     inDataset1 = None        
     
 if __name__ == '__main__':
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     sar_seq_maps.py
+#  Purpose:  Make the sequential change detection maps at any significance
+#            level(s) from the p-values kept by sar_seq.py --pvfile, without
+#            recalculating them
+#
+#  Usage:             
+#    python sar_seq_maps.py [OPTIONS] pvfile outfile
+#
+# MIT License
+# 
+# Copyright (c) 2016 Mort Canty
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os, sys, time, getopt, gdal
+import auxil.geotiff as geotiff
+from sar_seq import PVIMAGES, PVFILES, PVENL, PVMEDIANFILTER, read_pvarray, \
+                    change_maps, map_outfns, create_maps, write_maps
+from osgeo.gdalconst import GA_ReadOnly
+
+def main():  
+    usage = '''
+Usage:
+------------------------------------------------
+
+Change maps from the p-values of a sequential change detection
+
+python %s [OPTIONS] pvfile outfile
+
+Options:
+  
+  -h           this help
+  -s  signif   significance level for change detection (default 0.01), or a comma-separated list
+               of levels, e.g. 0.01,0.005,0.001, written to outfile_<level>_cmap etc.
+  --packbmap   write the bitemporal maps with one bit per interval (metadata BMAP_PACKED, BMAP_INTERVALS)
+               instead of one 0/255 band per interval
+
+pvfile:
+
+  p-value file written by sar_seq.py --pvfile
+  
+outfile:
+
+  without path (will be written to same directory as pvfile)
+
+-------------------------------------------------'''%sys.argv[0]
+
+    options,args = getopt.getopt(sys.argv[1:],'hs:',['packbmap'])
+    significance = 0.01
+    packbmap = False
+    for option, value in options: 
+        if option == '-h':
+            print usage
+            return 
+        elif option == '-s':
+            significance = eval(value) 
+        elif option == '--packbmap':
+            packbmap = True
+    if len(args) != 2:              
+        print 'Incorrect number of arguments'
+        print usage
+        sys.exit(1)        
+    if isinstance(significance,(list,tuple)):
+        levels = sorted(significance,reverse=True)
+    else:
+        levels = [significance]
+    pvfn,outfn = args
+    gdal.AllRegister()   
+    start = time.time()    
+    inDataset = gdal.Open(pvfn,GA_ReadOnly)
+    if inDataset is None or inDataset.GetMetadataItem(PVIMAGES) is None:
+        print 'Error: %s is not a p-value file'%pvfn
+        sys.exit(1)
+    cols = inDataset.RasterXSize
+    rows = inDataset.RasterYSize    
+    k = int(inDataset.GetMetadataItem(PVIMAGES))
+    print '==============================================='
+    print '     Multi-temporal SAR Change Detection'
+    print '==============================================='   
+    print time.asctime()  
+    print 'p-value file: %s'%pvfn
+    print 'input files: %s'%inDataset.GetMetadataItem(PVFILES)
+    print 'number of images: %i'%k
+    print 'equivalent number of looks: %s'%inDataset.GetMetadataItem(PVENL)
+    print 'median filtered: %s'%inDataset.GetMetadataItem(PVMEDIANFILTER)
+    print 'significance level: %s'%', '.join(['%f'%level for level in levels])
+#  output files
+    path = os.path.abspath(pvfn)    
+    dirn = os.path.dirname(path)
+    outfn = dirn + '/' + outfn 
+    outputs = [create_maps(fn,cols,rows,k,inDataset,packbmap) for fn in map_outfns(outfn,levels)]
+#  the change maps of each pixel depend only on its own p-values    
+    for y0 in range(0,rows,geotiff.BLOCKSIZE):
+        h = min(geotiff.BLOCKSIZE,rows-y0)
+        pvarray = read_pvarray(inDataset,y0,h)
+        for i,significance in enumerate(levels):
+            write_maps(outputs[i][1],change_maps(pvarray,significance),0,y0,cols,h)
+    for outfns,outDatasets in outputs:
+        for outDataset in outDatasets:
+            geotiff.close(outDataset)
+    allfns = [outfns for outfns,_ in outputs]
+    outputs = None    
+    outDatasets = None    
+    outDataset = None
+    for outfns in allfns:
+        for fn in outfns:
+            geotiff.finish(fn)
+        print 'most recent change map written to: %s'%outfns[0]  
+        print 'first change map written to: %s'%outfns[1]         
+        print 'frequency map written to: %s'%outfns[2]     
+        print 'bitemporal map image written to: %s'%outfns[3]    
+    inDataset = None        
+    print 'total elapsed time: '+str(time.time()-start)   
+    
+if __name__ == '__main__':
+    main()
@@ -31,14 +31,18 @@
 import numpy as np
 import os, sys, getopt, time
 from osgeo import gdal
-from osgeo.gdalconst import GA_ReadOnly,GDT_Float32
+from osgeo.gdalconst import GA_ReadOnly
+import auxil.geotiff as geotiff
+import auxil.vrt as vrt
 
-def subset(infile, dims=None, pos=None, outfile=None): 
+def subset(infile, dims=None, pos=None, outfile=None, virtual=False): 
     gdal.AllRegister()
     if outfile is None:
         path = os.path.dirname(infile)
         basename = os.path.basename(infile)
         root, ext = os.path.splitext(basename)
+        if virtual:
+            ext = '.vrt'
         outfile = path+'/'+root+'_sub'+ext    
     print '==========================='
     print 'Spatial/spectral subsetting'
@@ -60,32 +64,29 @@ def subset(infile, dims=None, pos=None, outfile=None):
             bands = len(pos)
         else:
             pos = range(1,bands+1)     
-    #   subset
-        G = np.zeros((rows,cols,bands)) 
-        k = 0                               
-        for b in pos:
-            band = inDataset.GetRasterBand(b)
-            G[:,:,k] = band.ReadAsArray(x0,y0,cols,rows)\
-                                  .astype(float)
-            k += 1         
-    #  write to disk       
-        driver = inDataset.GetDriver() 
-        outDataset = driver.Create(outfile,
-                    cols,rows,bands,GDT_Float32)
-        projection = inDataset.GetProjection()
-        geotransform = inDataset.GetGeoTransform()
-        if geotransform is not None:
-            gt = list(geotransform)
-            gt[0] = gt[0] + x0*gt[1]
-            gt[3] = gt[3] + y0*gt[5]
-            outDataset.SetGeoTransform(tuple(gt))
-        if projection is not None:
-            outDataset.SetProjection(projection)        
-        for k in range(bands):        
-            outBand = outDataset.GetRasterBand(k+1)
-            outBand.WriteArray(G[:,:,k],0,0) 
-            outBand.FlushCache() 
-        outDataset = None    
+#      output in the data type of the input bands
+        dtype = inDataset.GetRasterBand(pos[0]).DataType
+        if virtual or outfile.endswith('.vrt'):
+#          reference the input instead of copying it        
+            vrt.write(outfile,[(infile,b) for b in pos],inDataset,dtype,window=(x0,y0,cols,rows))
+        else:    
+            driver = inDataset.GetDriver() 
+            if driver.ShortName == 'VRT':
+                driver = gdal.GetDriverByName('GTiff')
+            outDataset = driver.Create(outfile,
+                        cols,rows,bands,dtype)
+            projection = inDataset.GetProjection()
+            geotransform = inDataset.GetGeoTransform()
+            if geotransform is not None:
+                gt = list(geotransform)
+                gt[0] = gt[0] + x0*gt[1]
+                gt[3] = gt[3] + y0*gt[5]
+                outDataset.SetGeoTransform(tuple(gt))
+            if projection is not None:
+                outDataset.SetProjection(projection)        
+#          copy block by block
+            geotiff.copy([(inDataset,b) for b in pos],outDataset,x0,y0,cols,rows)
+            outDataset = None    
         inDataset = None        
         print 'elapsed time: %s'%str(time.time()-start) 
         return outfile
@@ -108,11 +109,13 @@ Options:
    -h    this help
    -d    spatial subset list e.g. -d [0,0,500,500]
    -p    band position list e.g. -p [1,2,3,4,5,7]
+   -v    write a virtual image (.vrt) which references the input file
    
 --------------------------------------------'''%sys.argv[0]
-    options,args = getopt.getopt(sys.argv[1:],'hd:p:')
+    options,args = getopt.getopt(sys.argv[1:],'hd:p:v')
     dims = None
     pos = None
+    virtual = False
     for option, value in options: 
         if option == '-h':
             print usage
@@ -121,8 +124,10 @@ Options:
             dims = eval(value)  
         elif option == '-p':
             pos = eval(value)
+        elif option == '-v':
+            virtual = True
     infile = args[0] 
-    outfile = subset(infile,dims,pos)
+    outfile = subset(infile,dims,pos,virtual=virtual)
     print 'Subset image written to: %s' % outfile 
      
 if __name__ == '__main__':
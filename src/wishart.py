@@ -7,6 +7,7 @@
 #
 #  Usage:             
 #    python wishart.py [-d dims] [-s significance] file1 file2 outfile enl1 enl2
+#    python wishart.py [-d dims] [-s significance] --batch pairfile
 #
 # MIT License
 # 
@@ -30,49 +31,123 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+
 import numpy as np
-from scipy import stats, ndimage
+from scipy import ndimage
 import os, sys, time, getopt, gdal 
+import auxil.polsar as polsar
+import auxil.geotiff as geotiff
+from auxil.executor import Executor
+from collections import OrderedDict
 from osgeo.gdalconst import GA_ReadOnly, GDT_Float32, GDT_Byte
+from tempfile import NamedTemporaryFile
 
-                       
-def main():
-    usage = '''
-Usage:
-------------------------------------------------
-    python %s [-h] [-d dims] [-s significance] file1 file2 outfile enl1 enl2
-    outfile is without path (written to same directory as file1)
-    
-    Perform change detection on bitemporal, polarimetric SAR imagery.
---------------------------------------------'''%sys.argv[0]
+#  images opened in this process, kept for reuse by later pairs or blocks
+MAXOPEN = 8
+_datasets = OrderedDict()
 
-    options,args = getopt.getopt(sys.argv[1:],'hd:s:')
-    dims = None
-    significance = 0.01
-    for option, value in options: 
-        if option == '-h':
-            print usage
-            return 
-        elif option == '-d':
-            dims = eval(value)  
-        elif option == '-s':
-            significance = eval(value)           
-    if len(args) != 5:
-        print 'Incorrect number of arguments'
-        print usage
-        sys.exit(1)        
-    fn1 = args[0]
-    fn2 = args[1]
-    outfn = args[2]
-    m1 = np.float64(eval(args[3]))
-    m2 = np.float64(eval(args[4]))
-    print '============================================'
-    print 'Bi-temporal Complex Wishart Change Detection'
-    print '============================================'
-    print time.asctime()
-    gdal.AllRegister()       
+def opened(fn):
+    '''Return the GDAL dataset of fn, opening it only if it is not
+       among the MAXOPEN most recently used ones'''
+    inDataset = _datasets.pop(fn,None)
+    if inDataset is None:
+        inDataset = gdal.Open(fn,GA_ReadOnly)
+        if inDataset is None:
+            raise IOError('cannot open %s'%fn)
+    _datasets[fn] = inDataset
+    while len(_datasets) > MAXOPEN:
+        _datasets.popitem(last=False)
+    return inDataset
+
+def getmat(inDataset,m,x0,y0,cols,rows,dtype=np.float64):
+    '''Return the matrix elements of the window (x0,y0,cols,rows) of a 9- 4- 
+       or 1-band image multiplied by the number of looks m, real elements as 
+       dtype and complex elements as the matching complex type'''
+    def band(i):
+        return inDataset.GetRasterBand(i).ReadAsArray(x0,y0,cols,rows)
+    bands = inDataset.RasterCount
+    if bands == 9:
+#      T11 T12 T13 T22 T23 T33        
+        mat = (band(1),band(2)+1j*band(3),band(4)+1j*band(5),
+               band(6),band(7)+1j*band(8),band(9))
+    elif bands == 4:
+#      C11 C12 C22        
+        mat = (band(1),band(2)+1j*band(3),band(4))
+    else:
+#      C11        
+        mat = (band(1),)
+    return polsar.scaled(mat,m,dtype)
+
+def wishart(mat1,mat2,m1,m2,bands):
+    '''Return the test statistic Z and the change probability P
+       for the matrix elements of the two images'''
+    p = {9:3,4:2,1:1}[bands]
+    mat3 = tuple([x1+x2 for x1,x2 in zip(mat1,mat2)])
+    f = p**2
+    cst = p*((m2+m1)*np.log(m2+m1)-m2*np.log(m2)-m1*np.log(m1)) 
+    rho = 1. - (2.*p**2-1.)*(1./m2 + 1./m1 - 1./(m2+m1))/(6.*p)    
+    omega2 = -(p*p/4.)*(1. - 1./rho)**2 + p**2*(p**2-1.)*(1./m2**2 + 1./m1**2 - 1./(m2+m1)**2)/(24.*rho**2)        
+    logdet1 = polsar.logdet(mat1,bands,eps=0.0,fill=0.0000001)
+    logdet2 = polsar.logdet(mat2,bands,eps=0.0,fill=0.0000001)
+    logdet3 = polsar.logdet(mat3,bands,eps=0.0,fill=0.0000001)
+    lnQ = cst+m1*logdet1+m2*logdet2-(m2+m1)*logdet3
+#  test statistic    
+    Z = -2*rho*lnQ
+#  change probabilty
+    P =  1.0 - polsar.chi2mix(Z,f,omega2)
+    return (Z,P)
+
+def wishart_strip((fn1,fn2,m1,m2,x0,y0,ty,h,cols,rows,dtype)):
+    '''Return Z, median filtered P and log(k1) for the rows ty ... ty+h-1
+       of the cols x rows change images whose origin is (x0,y0) in file1'''
+#  read a halo of one row above and below for the median filter
+    ya = max(ty-1,0)
+    yb = min(ty+h+1,rows)
+    inDataset1 = opened(fn1)
+    mat1 = getmat(inDataset1,m1,x0,y0+ya,cols,yb-ya,dtype)
+    mat2 = getmat(opened(fn2),m2,0,ya,cols,yb-ya,dtype)
+    Z,P = wishart(mat1,mat2,m1,m2,inDataset1.RasterCount)
+    P =  ndimage.filters.median_filter(P, size = (3,3))
+    dy = ty-ya
+    c11 = np.log(mat1[0][dy:dy+h]+0.0000001) 
+    return (ty,h,Z[dy:dy+h],P[dy:dy+h],c11)
+
+def call_wishart_strip(args):
+    from wishart import wishart_strip
+    return wishart_strip(args)
+
+def cmap_image(c11,change,min1,max1):
+    '''Return the change map image bands, changes in red on the log intensity
+       c11 scaled from (min1,max1) to (0,255)'''
+    a255 = np.ones(c11.shape,dtype=np.byte)*255
+    a0 = a255*0
+    c11 = (c11-min1)*255.0/(max1-min1)  
+    c11 = np.where(c11<0,a0,c11)  
+    c11 = np.where(c11>255,a255,c11) 
+    c11 = np.where(change,a0,c11)      
+    cmap = np.where(change,a255,c11)
+    return (cmap,c11)
+
+def readpairs(fn):
+    '''Return the [file1,file2,outfile,enl1,enl2] lines of a pair file,
+       blank lines and # comments are skipped'''
+    pairs = []
+    with open(fn) as f:
+        for line in f:
+            pair = line.split('#')[0].split()
+            if not pair:
+                continue
+            if len(pair) != 5:
+                raise ValueError('%s: expected file1 file2 outfile enl1 enl2, got: %s'%(fn,line.strip()))
+            pairs.append(pair)
+    return pairs
+
+def run(fn1,fn2,outfn,m1,m2,dims=None,significance=0.01,tile=None,ex=None,dtype=np.float64):
+    '''Change detection for one pair, strips of tile rows are processed 
+       with the executor ex, otherwise the whole image at once'''
+    start = time.time()    
 #  first SAR image                 
-    inDataset1 = gdal.Open(fn1,GA_ReadOnly)     
+    inDataset1 = opened(fn1)     
     cols = inDataset1.RasterXSize
     rows = inDataset1.RasterYSize    
     bands = inDataset1.RasterCount
@@ -88,204 +163,141 @@ Usage:
     path = os.path.abspath(fn1)    
     dirn = os.path.dirname(path)
     outfn = dirn + '/' + outfn 
-        
-    start = time.time()    
-    inDataset2 = gdal.Open(fn2,GA_ReadOnly)     
+    basename = os.path.basename(outfn)
+    name, ext = os.path.splitext(basename)
+    outfn1 = outfn.replace(name,name+'_cmap')
+    inDataset2 = opened(fn2)     
     if bands == 9:
         print 'Quad polarimetry'  
-#      T11 (k1)
-        b = inDataset1.GetRasterBand(1)
-        k1 = m1*b.ReadAsArray(x0,y0,cols,rows)
-#      T12  (a1)
-        b = inDataset1.GetRasterBand(2)
-        a1 = b.ReadAsArray(x0,y0,cols,rows)
-        b = inDataset1.GetRasterBand(3)    
-        im = b.ReadAsArray(x0,y0,cols,rows)
-        a1 = m1*(a1 + 1j*im)
-#      T13  (rho1)
-        b = inDataset1.GetRasterBand(4)
-        rho1 = b.ReadAsArray(x0,y0,cols,rows)
-        b = inDataset1.GetRasterBand(5)
-        im = b.ReadAsArray(x0,y0,cols,rows)
-        rho1 = m1*(rho1 + 1j*im)      
-#      T22 (xsi1)
-        b = inDataset1.GetRasterBand(6)
-        xsi1 = m1*b.ReadAsArray(x0,y0,cols,rows)    
-#      T23 (b1)        
-        b = inDataset1.GetRasterBand(7)
-        b1 = b.ReadAsArray(x0,y0,cols,rows)
-        b = inDataset1.GetRasterBand(8)
-        im = b.ReadAsArray(x0,y0,cols,rows)
-        b1 = m1*(b1 + 1j*im)      
-#      T33 (zeta1)
-        b = inDataset1.GetRasterBand(9)
-        zeta1 = m1*b.ReadAsArray(x0,y0,cols,rows)              
-#      T11 (k2)
-        b = inDataset2.GetRasterBand(1)
-        k2 = m2*b.ReadAsArray(0,0,cols,rows)
-#      T12  (a2)
-        b = inDataset2.GetRasterBand(2)
-        a2 = b.ReadAsArray(0,0,cols,rows)
-        b = inDataset2.GetRasterBand(3)
-        im = b.ReadAsArray(0,0,cols,rows)
-        a2 = m2*(a2 + 1j*im)
-#      T13  (rho2)
-        b = inDataset2.GetRasterBand(4)
-        rho2 = b.ReadAsArray(0,0,cols,rows)
-        b = inDataset2.GetRasterBand(5)
-        im = b.ReadAsArray(0,0,cols,rows)
-        rho2 = m2*(rho2 + 1j*im)        
-#      T22 (xsi2)
-        b = inDataset2.GetRasterBand(6)
-        xsi2 = m2*b.ReadAsArray(0,0,cols,rows)    
-#      T23 (b2)        
-        b = inDataset2.GetRasterBand(7)
-        b2 = b.ReadAsArray(0,0,cols,rows)
-        b = inDataset2.GetRasterBand(8)
-        im = b.ReadAsArray(0,0,cols,rows)
-        b2 = m2*(b2 + 1j*im)        
-#      T33 (zeta2)
-        b = inDataset2.GetRasterBand(9)
-        zeta2 = m2*b.ReadAsArray(0,0,cols,rows)           
-        k3    = k1 + k2  
-        a3    = a1 + a2
-        rho3  = rho1 + rho2
-        xsi3  = xsi1 + xsi2
-        b3    = b1 + b2
-        zeta3 = zeta1 + zeta2           
-        det1 = k1*xsi1*zeta1 + 2*np.real(a1*b1*np.conj(rho1)) - xsi1*(abs(rho1)**2) - k1*(abs(b1)**2) - zeta1*(abs(a1)**2)    
-        det2 = k2*xsi2*zeta2 + 2*np.real(a2*b2*np.conj(rho2)) - xsi2*(abs(rho2)**2) - k2*(abs(b2)**2) - zeta2*(abs(a2)**2)       
-        det3 = k3*xsi3*zeta3 + 2*np.real(a3*b3*np.conj(rho3)) - xsi3*(abs(rho3)**2) - k3*(abs(b3)**2) - zeta3*(abs(a3)**2)       
-        p = 3
-        f = p**2
-        cst = p*((m2+m1)*np.log(m2+m1)-m2*np.log(m2)-m1*np.log(m1)) 
-        rho = 1. - (2.*p**2-1.)*(1./m2 + 1./m1 - 1./(m2+m1))/(6.*p)    
-        omega2 = -(p*p/4.)*(1. - 1./rho)**2 + p**2*(p**2-1.)*(1./m2**2 + 1./m1**2 - 1./(m2+m1)**2)/(24.*rho**2)        
     elif bands == 4:
         print 'Dual polarimetry'  
-#      C11 (k1)
-        b = inDataset1.GetRasterBand(1)
-        k1 = m1*b.ReadAsArray(x0,y0,cols,rows)
-#      C12  (a1)
-        b = inDataset1.GetRasterBand(2)
-        a1 = b.ReadAsArray(x0,y0,cols,rows)
-        b = inDataset1.GetRasterBand(3)
-        im = b.ReadAsArray(x0,y0,cols,rows)
-        a1 = m1*(a1 + 1j*im)        
-#      C22 (xsi1)
-        b = inDataset1.GetRasterBand(4)
-        xsi1 = m1*b.ReadAsArray(x0,y0,cols,rows)          
-#      C11 (k2)
-        b = inDataset2.GetRasterBand(1)
-        k2 = m2*b.ReadAsArray(0,0,cols,rows)
-#      C12  (a2)
-        b = inDataset2.GetRasterBand(2)
-        a2 = b.ReadAsArray(0,0,cols,rows)
-        b = inDataset2.GetRasterBand(3)
-        im = b.ReadAsArray(0,0,cols,rows)
-        a2 = m2*(a2 + 1j*im)        
-#      C22 (xsi2)
-        b = inDataset2.GetRasterBand(4)
-        xsi2 = m2*b.ReadAsArray(0,0,cols,rows)        
-        k3    = k1 + k2  
-        a3    = a1 + a2
-        xsi3  = xsi1 + xsi2       
-        det1 = k1*xsi1 - abs(a1)**2
-        det2 = k2*xsi2 - abs(a2)**2 
-        det3 = k3*xsi3 - abs(a3)**2        
-        p = 2 
-        cst = p*((m2+m1)*np.log(m2+m1)-m2*np.log(m2)-m1*np.log(m1)) 
-        f = p**2
-        rho = 1-(2*f-1)*(1./m2+1./m1-1./(m2+m1))/(6.*p)
-        omega2 = -f/4.*(1-1./rho)**2 + f*(f-1)*(1./m2**2+1./m1**2-1./(m2+m1)**2)/(24.*rho**2)  
     elif bands == 1:
         print 'Single polarimetry'         
-#      C11 (k1)
-        b = inDataset1.GetRasterBand(1)
-        k1 = m1*b.ReadAsArray(x0,y0,cols,rows) 
-#      C11 (k2)
-        b = inDataset2.GetRasterBand(1)
-        k2 = m2*b.ReadAsArray(0,0,cols,rows) 
-        k3 = k1 + k2
-        det1 = k1 
-        det2 = k2
-        det3 = k3    
-        p = 1 
-        cst = p*((m2+m1)*np.log(m2+m1)-m2*np.log(m2)-m1*np.log(m1)) 
-        f = p**2
-        rho = 1-(2.*f-1)*(1./m2+1./m1-1./(m2+m1))/(6.*p)
-        omega2 = -f/4.*(1-1./rho)**2+f*(f-1)*(1./m2**2+1./m1**2-1./(m2+m1)**2)/(24.*rho**2)  
     else:   
         print 'Incorrect number of bands'
         return   
-    idx = np.where(det1 <= 0.0)
-    det1[idx] = 0.0000001   
-    idx = np.where(det2 <= 0.0)
-    det2[idx] = 0.0000001 
-    idx = np.where(det3 <= 0.0)
-    det3[idx] = 0.0000001  
-    lnQ = cst+m1*np.log(det1)+m2*np.log(det2)-(m2+m1)*np.log(det3)
-#  test statistic    
-    Z = -2*rho*lnQ
-#  change probabilty
-    P =  (1.-omega2)*stats.chi2.cdf(Z,[f])+omega2*stats.chi2.cdf(Z,[f+4])
-    P =  ndimage.filters.median_filter(P, size = (3,3))
-#  change map
-    a255 = np.ones((rows,cols),dtype=np.byte)*255
-    a0 = a255*0
-    c11 = np.log(k1+0.0000001) 
-    min1 =np.min(c11)
-    max1 = np.max(c11)
-    c11 = (c11-min1)*255.0/(max1-min1)  
-    c11 = np.where(c11<0,a0,c11)  
-    c11 = np.where(c11>255,a255,c11) 
-    c11 = np.where(P>(1.0-significance),a0,c11)      
-    cmap = np.where(P>(1.0-significance),a255,c11)
-    cmap0 = np.where(P>(1.0-significance),a255,a0)
-#  write to file system        
-    driver = inDataset1.GetDriver()    
-    outDataset = driver.Create(outfn,cols,rows,3,GDT_Float32)
-    geotransform = inDataset2.GetGeoTransform()
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)
-    projection = inDataset2.GetProjection()        
-    if projection is not None:
-        outDataset.SetProjection(projection) 
-    outBand = outDataset.GetRasterBand(1)
-    outBand.WriteArray(Z,0,0) 
-    outBand.FlushCache() 
-    outBand = outDataset.GetRasterBand(2)
-    outBand.WriteArray(P,0,0) 
-    outBand.FlushCache()   
-    outBand = outDataset.GetRasterBand(3)
-    outBand.WriteArray(cmap0,0,0) 
-    outBand.FlushCache()     
+    outDataset = geotiff.create(outfn,cols,rows,3,GDT_Float32,inDataset2)
+    if tile is None:
+        ty,h,Z,P,logk = wishart_strip((fn1,fn2,m1,m2,x0,y0,0,rows,cols,rows,dtype))
+        changes = P>(1.0-significance)
+        a255 = np.ones((rows,cols),dtype=np.uint8)*255
+        geotiff.write(outDataset,[Z,P,np.where(changes,a255,a255*0)])
+        min1 = np.min(logk)
+        max1 = np.max(logk)
+        step = rows
+    else:
+#      test statistic and change probabilities strip by strip, the log intensity 
+#      is scaled to the full image range afterwards       
+        mm = NamedTemporaryFile(dir=dirn)
+        logk = np.memmap(mm.name,dtype=dtype,mode='w+',shape=(rows,cols))
+        mm1 = NamedTemporaryFile(dir=dirn)
+        changes = np.memmap(mm1.name,dtype=np.bool,mode='w+',shape=(rows,cols))
+        args = [(fn1,fn2,m1,m2,x0,y0,ty,min(tile,rows-ty),cols,rows,dtype) for ty in range(0,rows,tile)]
+        print 'calculating change probabilities in %i strips of %i rows ...'%(len(args),tile)
+        min1 = np.inf
+        max1 = -np.inf
+        for ty,h,Z,P,c11 in ex.imap(call_wishart_strip,args):
+            change = P>(1.0-significance)
+            a255 = np.ones((h,cols),dtype=np.uint8)*255
+            geotiff.write(outDataset,[Z,P,np.where(change,a255,a255*0)],0,ty)
+            min1 = min(min1,np.min(c11))
+            max1 = max(max1,np.max(c11))
+            logk[ty:ty+h] = c11
+            changes[ty:ty+h] = change
+        step = geotiff.BLOCKSIZE
+    geotiff.close(outDataset,'AVERAGE')
     outDataset = None
+    geotiff.finish(outfn)
     print 'test statistic, change probabilities and change map written to: %s'%outfn 
-    basename = os.path.basename(outfn)
-    name, ext = os.path.splitext(basename)
-    outfn=outfn.replace(name,name+'_cmap')
-    outDataset = driver.Create(outfn,cols,rows,3,GDT_Byte)
-    geotransform = inDataset2.GetGeoTransform()
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)
-    projection = inDataset2.GetProjection()        
-    if projection is not None:
-        outDataset.SetProjection(projection)     
-    outBand = outDataset.GetRasterBand(1)
-    outBand.WriteArray(cmap,0,0) 
-    outBand.FlushCache() 
-    outBand = outDataset.GetRasterBand(2)
-    outBand.WriteArray(c11,0,0) 
-    outBand.FlushCache()  
-    outBand = outDataset.GetRasterBand(3)
-    outBand.WriteArray(c11,0,0) 
-    outBand.FlushCache()  
+#  change map image    
+    outDataset = geotiff.create(outfn1,cols,rows,3,GDT_Byte,inDataset2)
+    for ty in range(0,rows,step):
+        cmap,c11 = cmap_image(logk[ty:ty+step],changes[ty:ty+step],min1,max1)
+        geotiff.write(outDataset,[cmap,c11,c11],0,ty)
+    geotiff.close(outDataset)
     outDataset = None    
-    inDataset1 = None
-    inDataset2 = None
-    print 'change map image written to: %s'%outfn   
+    geotiff.finish(outfn1)
+    logk = None
+    changes = None
+    print 'change map image written to: %s'%outfn1   
     print 'elapsed time: '+str(time.time()-start)  
+                       
+def main():
+    usage = '''
+Usage:
+------------------------------------------------
+    python %s [OPTIONS] file1 file2 outfile enl1 enl2
+    python %s [OPTIONS] --batch pairfile
+    outfile is without path (written to same directory as file1)
+    
+    Perform change detection on bitemporal, polarimetric SAR imagery.
+    
+    Options:
+    -h            this help
+    -d dims       spatial subset [x0,y0,cols,rows] of file1 (of every pair)
+    -s signif     significance level (default 0.01)
+    --tile rows   process the images in parallel strips of rows lines, 
+                  so that memory use is bounded by the strip size
+    --backend b   parallel backend for the strips: auto (default), ipyparallel,
+                  multiprocessing or sequential
+    --workers w   number of engines or worker processes (default all)
+    --float32     single precision arithmetic (default double)
+    --batch fn    process all pairs listed in the text file fn, one per line as
+                  file1 file2 outfile enl1 enl2, in a single run which keeps 
+                  images shared by consecutive pairs open
+--------------------------------------------'''%(sys.argv[0],sys.argv[0])
+
+    options,args = getopt.getopt(sys.argv[1:],'hd:s:',['tile=','backend=','workers=','float32','batch='])
+    dims = None
+    significance = 0.01
+    tile = None
+    backend = 'auto'
+    workers = None
+    dtype = np.float64
+    batch = None
+    for option, value in options: 
+        if option == '-h':
+            print usage
+            return 
+        elif option == '-d':
+            dims = eval(value)  
+        elif option == '-s':
+            significance = eval(value)           
+        elif option == '--tile':
+            tile = eval(value)
+        elif option == '--backend':
+            backend = value
+        elif option == '--workers':
+            workers = eval(value)
+        elif option == '--float32':
+            dtype = np.float32
+        elif option == '--batch':
+            batch = value
+    if batch is not None and len(args) == 0:
+        pairs = readpairs(batch)
+    elif batch is None and len(args) == 5:
+        pairs = [args]
+    else:
+        print 'Incorrect number of arguments'
+        print usage
+        sys.exit(1)        
+    print '============================================'
+    print 'Bi-temporal Complex Wishart Change Detection'
+    print '============================================'
+    print time.asctime()
+    gdal.AllRegister()       
+    start = time.time()
+    ex = None
+    if tile is not None:
+#      start the workers before any image is opened, so that they do not share open files        
+        ex = Executor(backend,workers)
+        print 'backend: %s'%ex
+    for fn1,fn2,outfn,m1,m2 in pairs:
+        run(fn1,fn2,outfn,np.float64(eval(m1)),np.float64(eval(m2)),dims,significance,tile,ex,dtype)
+    if ex is not None:
+        ex.close()
+    if batch is not None:
+        print '%i pairs, total elapsed time: %s'%(len(pairs),str(time.time()-start))
                 
 if __name__ == '__main__':
-    main()     
\ No newline at end of file
+    main()